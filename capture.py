@@ -0,0 +1,510 @@
+"""
+Capture file layout, all little endian:
+
+    magic   "MHCAP001"
+    blocks  tag (4 bytes), payload size (uint64), payload
+    trailer offset of the INDX block (uint64), "MHCAPEND"
+
+    STCK  stacks, see stacks.encode_stacks
+    MODL, NSTK, SMAP
+          the stacks normalized to module and offset, see normalize
+    EVNT  pid (uint64), events (uint32), codec (uint8), flags (uint8),
+          padding (2 bytes), first and last timestamp (uint64), compressed
+          columns
+    EIDX  summary of the EVNT block before it: pid (uint64), offset of the
+          block (uint64), mask of its size classes (uint64), mask of its
+          trace types (uint16), padding (2 bytes), number of distinct thread
+          ids and stack ids (uint32 each), then both sorted (uint32[])
+    RLUP  pid (uint64), interval length (float64), intervals (uint32), padding
+          (4 bytes), interval start times (float64[]), rollup.FIELDS (int64[][])
+    RSMP  pid (uint64), samples (uint32), codec (uint8), padding (3 bytes),
+          compressed resident.RESIDENT_DTYPE rows
+    INDX  one INDEX_DTYPE row per block
+
+Events are stored column by column before compression: types as bytes,
+timestamps as zigzag varint deltas, addresses XORed with the previous
+address as varints, sizes and stack ids as varints, thread ids XORed with the
+previous thread id as varints. Frees carry the size and stack id of the
+allocation they freed. Blocks written before thread ids were captured have no
+EVENT_TIDS flag and read with thread id 0. Timestamps are in the clock of the
+hooks, only blocks with the EVENT_NANOSECONDS flag can be compared to wall
+clock times and resident samples. Without the trailer, after a crash,
+the blocks are found by walking their headers.
+"""
+
+import argparse
+import lzma
+import mmap
+import struct
+import zlib
+from dataclasses import dataclass
+
+import numpy as np
+
+from normalize import NormalizedTable, Normalizer
+from resident import RESIDENT_DTYPE, gap
+from rollup import FIELDS, Rollup
+from stacks import StackTable, decode_stacks, encode_stacks, size_classes
+
+MAGIC = b"MHCAP001"
+TRAILER_MAGIC = b"MHCAPEND"
+BLOCK_HEADER = struct.Struct("<4sQ")
+EVENTS_HEADER = struct.Struct("<QIBB2xQQ")
+SUMMARY_HEADER = struct.Struct("<QQQH2xII")
+ROLLUP_HEADER = struct.Struct("<QdI4x")
+RESIDENT_HEADER = struct.Struct("<QIB3x")
+TRAILER = struct.Struct("<Q8s")
+
+# Flags of event blocks
+EVENT_TIDS = 1  # The block has a thread id column
+EVENT_NANOSECONDS = 2  # Timestamps are nanoseconds since the epoch, the clock of RSMP samples
+
+# Codec id, compress and decompress
+CODECS = {
+    "zlib": (0, zlib.compress, zlib.decompress),
+    "lzma": (1, lzma.compress, lzma.decompress),
+}
+CODEC_NAMES = {codec_id: name for name, (codec_id, _, _) in CODECS.items()}
+
+CAPTURE_DTYPE = np.dtype(
+    [
+        ("time", "<u8"),
+        ("address", "<u8"),
+        ("size", "<u8"),
+        ("stack_id", "<i8"),  # -1 for frees of untracked allocations
+        ("type", "u1"),
+        ("tid", "<u4"),
+    ]
+)
+
+INDEX_DTYPE = np.dtype(
+    [
+        ("tag", "S4"),
+        ("offset", "<u8"),
+        ("pid", "<u8"),
+        ("events", "<u4"),
+        ("first_time", "<u8"),
+        ("last_time", "<u8"),
+    ]
+)
+
+
+def encode_varints(values: np.ndarray) -> bytes:
+    values = values.astype(np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        lengths += values >= (1 << (7 * k))
+
+    offsets = np.cumsum(lengths) - lengths
+    out = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for k in range(int(lengths.max(initial=0))):
+        mask = lengths > k
+        low = (values[mask] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = (lengths[mask] > k + 1).astype(np.uint8) << 7
+        out[offsets[mask] + k] = low.astype(np.uint8) | more
+    return out.tobytes()
+
+
+def decode_varints(data: bytes) -> np.ndarray:
+    encoded = np.frombuffer(data, dtype=np.uint8)
+    if not len(encoded):
+        return np.zeros(0, dtype=np.uint64)
+
+    # The last byte of every value has the high bit clear
+    ends = np.flatnonzero(encoded < 0x80)
+    starts = np.r_[0, ends[:-1] + 1]
+    lengths = ends - starts + 1
+
+    values = (encoded[starts] & 0x7F).astype(np.uint64)
+    for k in range(1, int(lengths.max())):
+        longer = np.flatnonzero(lengths > k)
+        values[longer] |= (encoded[starts[longer] + k] & 0x7F).astype(np.uint64) << np.uint64(7 * k)
+    return values
+
+
+def zigzag(values: np.ndarray) -> np.ndarray:
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def unzigzag(values: np.ndarray) -> np.ndarray:
+    return (values >> np.uint64(1)).view(np.int64) ^ -(values & np.uint64(1)).view(np.int64)
+
+
+def columns_header(columns: int) -> struct.Struct:
+    """Length (uint32) of every compressed column, 5 columns before EVENT_TIDS"""
+    return struct.Struct(f"<{columns}I")
+
+
+def encode_events(events: np.ndarray, first_time: int) -> bytes:
+    """Columns of events, first_time is the timestamp the deltas start from"""
+    times = events["time"].astype(np.int64)
+    addresses = events["address"]
+    tids = events["tid"]
+    columns = [
+        events["type"].tobytes(),
+        encode_varints(zigzag(np.diff(times, prepend=np.int64(first_time)))),
+        encode_varints(addresses ^ np.concatenate((np.zeros(1, dtype=np.uint64), addresses[:-1]))),
+        encode_varints(events["size"]),
+        encode_varints(events["stack_id"] + 1),
+        encode_varints(tids ^ np.concatenate((np.zeros(1, dtype=np.uint32), tids[:-1]))),
+    ]
+    return columns_header(len(columns)).pack(*(len(column) for column in columns)) + b"".join(columns)
+
+
+def decode_events(data: bytes, first_time: int, flags: int = EVENT_TIDS) -> np.ndarray:
+    header = columns_header(6 if flags & EVENT_TIDS else 5)
+    lengths = header.unpack_from(data)
+    columns = []
+    offset = header.size
+    for length in lengths:
+        columns.append(data[offset : offset + length])
+        offset += length
+
+    types = np.frombuffer(columns[0], dtype=np.uint8)
+    events = np.zeros(len(types), dtype=CAPTURE_DTYPE)
+    events["type"] = types
+    events["time"] = (first_time + np.cumsum(unzigzag(decode_varints(columns[1])))).view(np.uint64)
+    events["address"] = np.bitwise_xor.accumulate(decode_varints(columns[2]))
+    events["size"] = decode_varints(columns[3])
+    events["stack_id"] = decode_varints(columns[4]).view(np.int64) - 1
+    if flags & EVENT_TIDS:
+        events["tid"] = np.bitwise_xor.accumulate(decode_varints(columns[5]))
+    return events
+
+
+def mask_of(values: np.ndarray) -> int:
+    """Bit v set for every value v in values, all below 64"""
+    return sum(1 << value for value in np.flatnonzero(np.bincount(values, minlength=64)).tolist())
+
+
+def encode_summary(pid: int, offset: int, events: np.ndarray) -> bytes:
+    """EIDX payload of the event block at offset"""
+    classes = np.minimum(size_classes(events["size"]), 63)
+    tids = np.unique(events["tid"]).astype("<u4")
+    # Stack ids are dense, counting them is cheaper than sorting
+    stack_ids = np.flatnonzero(np.bincount(events["stack_id"] + 1)[1:]).astype("<u4")
+    header = SUMMARY_HEADER.pack(pid, offset, mask_of(classes), mask_of(events["type"]), len(tids), len(stack_ids))
+    return header + tids.tobytes() + stack_ids.tobytes()
+
+
+def decode_summary(payload: memoryview) -> tuple[int, int, int, int, np.ndarray, np.ndarray]:
+    """Pid, block offset, size class mask, type mask, thread ids and stack ids of an EIDX payload"""
+    pid, offset, size_mask, type_mask, tid_count, stack_count = SUMMARY_HEADER.unpack_from(payload)
+    tids = np.frombuffer(payload, dtype="<u4", count=tid_count, offset=SUMMARY_HEADER.size)
+    stack_ids = np.frombuffer(payload, dtype="<u4", count=stack_count, offset=SUMMARY_HEADER.size + 4 * tid_count)
+    return pid, offset, size_mask, type_mask, tids, stack_ids
+
+
+@dataclass
+class PendingEvents:
+    pid: int
+    first_stack: int  # Id of the first stack in new_stacks
+    new_stacks: list[tuple[int, ...]]
+    events: np.ndarray
+    resident: np.ndarray | None = None  # RESIDENT_DTYPE samples
+
+
+class CaptureWriter:
+    """Writes the events of one or more processes to a compressed capture file"""
+
+    BLOCK_EVENTS: int = 1 << 16
+
+    def __init__(self, path: str, codec: str = "zlib", nanoseconds: bool = True):
+        self.path = path
+        self.codec_id, self.compress, _ = CODECS[codec]
+        # Whether the hooks timestamp events in nanoseconds since the epoch, not cycles or nothing
+        self.event_flags = EVENT_TIDS | (EVENT_NANOSECONDS if nanoseconds else 0)
+        self.pending: dict[int, list[np.ndarray]] = {}
+        self.pending_resident: dict[int, list[np.ndarray]] = {}
+        self.stack_tables: dict[int, StackTable] = {}
+        self.written_stacks: dict[int, int] = {}  # Number of stacks taken per pid
+        self.index: list[tuple] = []
+        self.normalizer = Normalizer()
+
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+
+    def add(self, pid: int, stacks: StackTable, records: np.ndarray, stack_ids: np.ndarray, sizes: np.ndarray):
+        """Queue a batch of records with the stack id and size of the allocation each one made or freed"""
+        events = np.empty(len(records), dtype=CAPTURE_DTYPE)
+        events["time"] = records["time"]
+        events["address"] = records["address"]
+        events["size"] = sizes
+        events["stack_id"] = stack_ids
+        events["type"] = records["type"]
+        events["tid"] = records["tid"]
+
+        self.pending.setdefault(pid, []).append(events)
+        self.stack_tables[pid] = stacks
+
+    def add_resident(self, pid: int, sample: np.ndarray):
+        """Queue a resident.ResidentSampler sample"""
+        self.pending_resident.setdefault(pid, []).append(sample)
+
+    def take(self) -> list[PendingEvents]:
+        """Hand over the queued events, cheap enough to run between drains"""
+        taken = []
+        for pid in dict.fromkeys([*self.pending, *self.pending_resident]):
+            batches = self.pending.get(pid, [])
+            events = np.concatenate(batches) if batches else np.zeros(0, dtype=CAPTURE_DTYPE)
+            new_stacks: list[tuple[int, ...]] = []
+            first = self.written_stacks.get(pid, 0)
+            if pid in self.stack_tables:
+                stacks = self.stack_tables[pid]
+                self.written_stacks[pid] = len(stacks)
+                new_stacks = stacks.stacks[first:]
+            samples = self.pending_resident.get(pid)
+            resident = np.array(samples, dtype=RESIDENT_DTYPE) if samples else None
+            taken.append(PendingEvents(pid, first, new_stacks, events, resident))
+
+        self.pending = {}
+        self.pending_resident = {}
+        return taken
+
+    def write(self, taken: list[PendingEvents]):
+        for entry in taken:
+            if entry.new_stacks:
+                self._write_block(b"STCK", encode_stacks(entry.pid, entry.first_stack, entry.new_stacks), entry.pid)
+                for tag, payload in self.normalizer.blocks(entry.pid, entry.first_stack, entry.new_stacks):
+                    self._write_block(tag, payload, entry.pid)
+
+            for start in range(0, len(entry.events), self.BLOCK_EVENTS):
+                events = entry.events[start : start + self.BLOCK_EVENTS]
+                first_time, last_time = int(events["time"].min()), int(events["time"].max())
+                header = EVENTS_HEADER.pack(entry.pid, len(events), self.codec_id, self.event_flags, first_time, last_time)
+                compressed = self.compress(encode_events(events, first_time))
+                offset = self.file.tell()
+                self._write_block(b"EVNT", header + compressed, entry.pid, len(events), first_time, last_time)
+                summary = encode_summary(entry.pid, offset, events)
+                self._write_block(b"EIDX", summary, entry.pid, len(events), first_time, last_time)
+
+            if entry.resident is not None:
+                samples = entry.resident
+                header = RESIDENT_HEADER.pack(entry.pid, len(samples), self.codec_id)
+                first_time, last_time = int(samples["time"][0]), int(samples["time"][-1])
+                compressed = self.compress(samples.tobytes())
+                self._write_block(b"RSMP", header + compressed, entry.pid, len(samples), first_time, last_time)
+
+        self.file.flush()
+
+    def close(self, rollups: dict[int, Rollup] | None = None):
+        self.write(self.take())
+
+        # The coarsest resolution covers the longest runs
+        for pid, rollup in (rollups or {}).items():
+            series = rollup.series[-1]
+            intervals = series.intervals[series.intervals >= 0]
+            if not len(intervals):
+                continue
+            count = int(intervals.max() - intervals.min()) + 1
+            times, data = series.window(series.seconds * int(intervals.max()), count)
+            header = ROLLUP_HEADER.pack(pid, series.seconds, len(times))
+            self._write_block(b"RLUP", header + times.astype("<f8").tobytes() + data.astype("<i8").tobytes(), pid)
+
+        index_offset = self.file.tell()
+        self._write_block(b"INDX", np.array(self.index, dtype=INDEX_DTYPE).tobytes(), index=False)
+        self.file.write(TRAILER.pack(index_offset, TRAILER_MAGIC))
+        self.file.close()
+
+    def _write_block(self, tag: bytes, payload: bytes, pid: int = 0, events: int = 0, first_time: int = 0, last_time: int = 0, index: bool = True):
+        if index:
+            self.index.append((tag, self.file.tell(), pid, events, first_time, last_time))
+        self.file.write(BLOCK_HEADER.pack(tag, len(payload)))
+        self.file.write(payload)
+
+
+class CaptureReader:
+    """Reads capture files, decompressing only the event blocks that are asked for"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.mem = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mem[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+
+        self.index = self._read_index()
+        self.stacks: dict[int, list[tuple[int, ...]]] = {}
+        for row in self.index[self.index["tag"] == b"STCK"]:
+            pid, first, new_stacks = decode_stacks(self._payload(int(row["offset"])))
+            pid_stacks = self.stacks.setdefault(pid, [])
+            del pid_stacks[first:]
+            pid_stacks += new_stacks
+
+        self.normalized = NormalizedTable()
+        for row in self.index[np.isin(self.index["tag"], [b"MODL", b"NSTK", b"SMAP"])]:
+            self.normalized.add_block(bytes(row["tag"]), self._payload(int(row["offset"])))
+        # Written before stacks were normalized
+        for pid, stacks in self.stacks.items():
+            if pid not in self.normalized.stack_maps:
+                self.normalized.add_unnormalized(pid, stacks)
+
+    def close(self):
+        self.mem.close()
+
+    def _payload(self, offset: int) -> memoryview:
+        _, size = BLOCK_HEADER.unpack_from(self.mem, offset)
+        start = offset + BLOCK_HEADER.size
+        return memoryview(self.mem)[start : start + size]
+
+    def _read_index(self) -> np.ndarray:
+        if len(self.mem) >= len(MAGIC) + TRAILER.size:
+            index_offset, magic = TRAILER.unpack_from(self.mem, len(self.mem) - TRAILER.size)
+            if magic == TRAILER_MAGIC:
+                return np.frombuffer(self._payload(index_offset), dtype=INDEX_DTYPE).copy()
+
+        # No trailer, the writer did not finish
+        rows = []
+        offset = len(MAGIC)
+        while offset + BLOCK_HEADER.size <= len(self.mem):
+            tag, size = BLOCK_HEADER.unpack_from(self.mem, offset)
+            if offset + BLOCK_HEADER.size + size > len(self.mem):
+                break
+            pid, events, first_time, last_time = 0, 0, 0, 0
+            if tag == b"EVNT":
+                pid, events, _, _, first_time, last_time = EVENTS_HEADER.unpack_from(self.mem, offset + BLOCK_HEADER.size)
+            elif tag == b"EIDX":
+                # Times and counts of the block it summarizes, which comes right before it
+                pid, events, first_time, last_time = rows[-1][2:]
+            elif tag == b"RSMP":
+                pid, events, _ = RESIDENT_HEADER.unpack_from(self.mem, offset + BLOCK_HEADER.size)
+            elif tag in (b"STCK", b"RLUP", b"SMAP"):
+                (pid,) = struct.unpack_from("<Q", self.mem, offset + BLOCK_HEADER.size)
+            rows.append((tag, offset, pid, events, first_time, last_time))
+            offset += BLOCK_HEADER.size + size
+        return np.array(rows, dtype=INDEX_DTYPE)
+
+    def event_blocks(self, start: int | None = None, end: int | None = None, pid: int | None = None) -> np.ndarray:
+        """Index rows of the event blocks overlapping the time range [start, end]"""
+        rows = self.index[self.index["tag"] == b"EVNT"]
+        if pid is not None:
+            rows = rows[rows["pid"] == pid]
+        if start is not None:
+            rows = rows[rows["last_time"] >= start]
+        if end is not None:
+            rows = rows[rows["first_time"] <= end]
+        return rows
+
+    def nanoseconds(self) -> bool:
+        """Whether every event block is timestamped in nanoseconds since the epoch"""
+        offsets = self.event_blocks()["offset"].tolist()
+        flags = [EVENTS_HEADER.unpack_from(self.mem, offset + BLOCK_HEADER.size)[3] for offset in offsets]
+        return bool(flags) and all(flag & EVENT_NANOSECONDS for flag in flags)
+
+    def events(self, start: int | None = None, end: int | None = None, pid: int | None = None):
+        """Yield the pid and events of every block with events in [start, end]"""
+        for row in self.event_blocks(start, end, pid):
+            block_pid, events = self.decode_block(int(row["offset"]))
+            if start is not None:
+                events = events[events["time"] >= start]
+            if end is not None:
+                events = events[events["time"] <= end]
+            yield block_pid, events
+
+    def decode_block(self, offset: int) -> tuple[int, np.ndarray]:
+        """Pid and events of the EVNT block at offset"""
+        payload = self._payload(offset)
+        pid, _, codec_id, flags, first_time, _ = EVENTS_HEADER.unpack_from(payload)
+        _, _, decompress = CODECS[CODEC_NAMES[codec_id]]
+        return pid, decode_events(decompress(payload[EVENTS_HEADER.size :]), first_time, flags)
+
+    def summaries(self):
+        """Yield the decoded payload of every EIDX block, see decode_summary"""
+        for row in self.index[self.index["tag"] == b"EIDX"]:
+            yield decode_summary(self._payload(int(row["offset"])))
+
+    def rollup(self, pid: int) -> tuple[np.ndarray, np.ndarray] | None:
+        """Start times and rollup.FIELDS of every interval of pid, if the writer was closed"""
+        rows = self.index[(self.index["tag"] == b"RLUP") & (self.index["pid"] == pid)]
+        if not len(rows):
+            return None
+
+        payload = self._payload(int(rows[-1]["offset"]))
+        _, _, count = ROLLUP_HEADER.unpack_from(payload)
+        times = np.frombuffer(payload, dtype="<f8", count=count, offset=ROLLUP_HEADER.size)
+        data = np.frombuffer(payload, dtype="<i8", offset=ROLLUP_HEADER.size + 8 * count)
+        return times, data.reshape(len(FIELDS), count)
+
+    def resident(self, pid: int) -> np.ndarray:
+        """The resident.RESIDENT_DTYPE samples of pid, in time order"""
+        rows = self.index[(self.index["tag"] == b"RSMP") & (self.index["pid"] == pid)]
+        blocks = [np.zeros(0, dtype=RESIDENT_DTYPE)]
+        for row in rows:
+            payload = self._payload(int(row["offset"]))
+            _, count, codec_id = RESIDENT_HEADER.unpack_from(payload)
+            _, _, decompress = CODECS[CODEC_NAMES[codec_id]]
+            blocks.append(np.frombuffer(decompress(payload[RESIDENT_HEADER.size :]), dtype=RESIDENT_DTYPE, count=count))
+        return np.concatenate(blocks)
+
+
+def print_info(reader: CaptureReader, path: str):
+    blocks = reader.event_blocks()
+    events = int(blocks["events"].sum())
+    size = len(reader.mem)
+
+    print(f"File: {path} ({size} bytes)")
+    print(f"Event blocks: {len(blocks)}, events: {events}")
+    if events:
+        print(f"Bytes per event: {size / events:.2f}")
+    for pid in np.unique(blocks["pid"]).tolist():
+        pid_blocks = blocks[blocks["pid"] == pid]
+        print(
+            f"  - pid {pid:<8} - {int(pid_blocks['events'].sum())} events, "
+            f"t={int(pid_blocks['first_time'].min())} - {int(pid_blocks['last_time'].max())}, "
+            f"{len(reader.stacks.get(pid, []))} stacks"
+        )
+
+        samples = reader.resident(pid)
+        if len(samples):
+            gaps = samples["rss"].astype(np.int64) - samples["live"]
+            print(
+                f"    {len(samples)} resident samples, RSS {int(samples['rss'].min())} - {int(samples['rss'].max())} bytes, "
+                f"gap to live bytes {gap(samples[0])} -> {gap(samples[-1])} bytes (max {int(gaps.max())})"
+            )
+
+
+def print_events(reader: CaptureReader, blocks):
+    """Print the events of (pid, events) pairs, like those of CaptureReader.events"""
+    from shared_buffer import TraceType
+
+    for block_pid, events in blocks:
+        stacks = reader.stacks.get(block_pid, [])
+        for time, address, size, stack_id, type, tid in events.tolist():
+            print(f"[{TraceType(type).name}] pid={block_pid} tid={tid} address={hex(address)} size={size} at t={time}")
+            if stack_id >= 0:
+                print(f"    Backtrace: {' -> '.join(hex(b) for b in stacks[stack_id])}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Inspect capture files written by the profiler.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    info_parser = subparsers.add_parser("info", help="Summarize the events in a capture file.")
+    info_parser.add_argument("file")
+
+    dump_parser = subparsers.add_parser("dump", help="Print the events in a time range.")
+    dump_parser.add_argument("file")
+    dump_parser.add_argument("-s", "--start", type=int, default=None, help="First timestamp to print.")
+    dump_parser.add_argument("-e", "--end", type=int, default=None, help="Last timestamp to print.")
+    dump_parser.add_argument("-p", "--pid", type=int, default=None, help="Only print the events of this process.")
+
+    args = parser.parse_args()
+
+    try:
+        reader = CaptureReader(args.file)
+    except (OSError, ValueError) as e:
+        print(f"Could not read capture: {e}")
+        exit(1)
+
+    if args.command == "info":
+        print_info(reader, args.file)
+    else:
+        print_events(reader, reader.events(args.start, args.end, args.pid))
+    reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Reads the churn table the hooks keep with --churn-lifetime. Allocations freed
+shortly after being made never reach the ring, the hooks only count them per
+call stack together with a histogram of their lifetimes.
+"""
+
+import mmap
+import os
+from dataclasses import dataclass, field
+
+import numpy as np
+
+# From ring_layout, shared_buffer imports this module
+from ring_layout import MOUNT_PREFIX
+
+MAX_BACKTRACES: int = 20
+LIFETIME_BUCKETS: int = 16
+
+# Start of the table, matches struct ChurnHeader in hook_lib/churn.h
+CHURN_HEAD_DTYPE = np.dtype(
+    [
+        ("sites", "<u4"),
+        ("buckets", "<u4"),
+        ("lifetime_ns", "<u8"),
+        ("pairs", "<u8"),
+        ("remote", "<u8"),
+        ("full", "<u8"),
+        ("evicted", "<u8"),
+        ("reserved", "<u8", (2,)),
+    ]
+)
+
+# Counters of one call stack, matches struct ChurnSite in hook_lib/churn.h
+CHURN_SITE_DTYPE = np.dtype(
+    [
+        ("key", "<u8"),
+        ("ready", "<u4"),
+        ("backtrace_size", "<u4"),
+        ("count", "<u8"),
+        ("bytes", "<u8"),
+        ("lifetimes", "<u8", (LIFETIME_BUCKETS,)),
+        ("backtraces", "<u8", (MAX_BACKTRACES,)),
+    ]
+)
+
+
+def lifetime_label(bucket: int) -> str:
+    """Bucket 0 holds lifetimes below 128ns, every next one is twice as long"""
+    def format(ns: int) -> str:
+        for unit, scale in (("ms", 10**6), ("us", 10**3)):
+            if ns >= scale:
+                return f"{ns / scale:g}{unit}"
+        return f"{ns}ns"
+
+    if bucket == 0:
+        return f"< {format(128)}"
+    if bucket == LIFETIME_BUCKETS - 1:
+        return f">= {format(1 << (bucket + 6))}"
+    return f"{format(1 << (bucket + 6))} - {format(1 << (bucket + 7))}"
+
+
+@dataclass
+class ChurnSite:
+    count: int
+    size: int
+    lifetimes: np.ndarray
+    backtraces: list[int]
+
+
+@dataclass
+class ChurnReport:
+    lifetime_ns: int = 0
+    pairs: int = 0
+    remote: int = 0
+    full: int = 0
+    evicted: int = 0
+    lifetimes: np.ndarray = field(default_factory=lambda: np.zeros(LIFETIME_BUCKETS, dtype=np.uint64))
+    sites: list[ChurnSite] = field(default_factory=list)
+
+    def merge(self, other: "ChurnReport", count: int):
+        self.lifetime_ns = max(self.lifetime_ns, other.lifetime_ns)
+        self.pairs += other.pairs
+        self.remote += other.remote
+        self.full += other.full
+        self.evicted += other.evicted
+        self.lifetimes = self.lifetimes + other.lifetimes
+        self.sites = sorted(self.sites + other.sites, key=lambda site: site.count, reverse=True)[:count]
+
+
+class ChurnTable:
+    """The churn table of process pid, created by the hooks when the library is loaded"""
+
+    REPORT_SITES: int = 10
+
+    def __init__(self, pid: int):
+        self.pid = pid
+
+    @staticmethod
+    def mount(pid: int) -> str:
+        return f"{MOUNT_PREFIX}{pid}.churn"
+
+    def __enter__(self):
+        try:
+            self.fd = os.open(self.mount(self.pid), os.O_RDONLY)
+        except OSError as e:
+            print(f"Failed to open churn table: {e}")
+            exit(1)
+
+        size = os.fstat(self.fd).st_size
+        self.mem = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+        self.header = np.frombuffer(self.mem, dtype=CHURN_HEAD_DTYPE, count=1)
+        sites = int(self.header["sites"][0])
+        self.sites = np.frombuffer(
+            self.mem, dtype=CHURN_SITE_DTYPE, count=sites, offset=CHURN_HEAD_DTYPE.itemsize
+        )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        del self.header, self.sites
+        self.mem.close()
+        os.close(self.fd)
+        # The hooks keep their mapping, nothing is left behind in /dev/shm
+        try:
+            os.unlink(self.mount(self.pid))
+        except FileNotFoundError:
+            pass
+
+    def report(self, count: int = REPORT_SITES) -> ChurnReport:
+        """Copy the counters, with the count sites that churned the most"""
+        header = self.header[0].copy()
+        sites = self.sites[self.sites["ready"] != 0].copy()
+
+        report = ChurnReport(
+            int(header["lifetime_ns"]),
+            int(header["pairs"]),
+            int(header["remote"]),
+            int(header["full"]),
+            int(header["evicted"]),
+            sites["lifetimes"].sum(axis=0, dtype=np.uint64),
+        )
+
+        top = np.argsort(sites["count"], kind="stable")[::-1][:count]
+        for site in sites[top]:
+            report.sites.append(
+                ChurnSite(
+                    int(site["count"]),
+                    int(site["bytes"]),
+                    site["lifetimes"],
+                    site["backtraces"][: site["backtrace_size"]].tolist(),
+                )
+            )
+        return report
@@ -1,6 +1,9 @@
 import argparse
+import os
+import re
 import sys
-from dataclasses import dataclass
+
+from code_injector import BufferSize
 
 """
 Goals of the CLI
@@ -23,9 +26,21 @@ parser.add_argument(
     "-p",
     "--pid",
     default=None,
-    required=True,
-    nargs=1,
-    help="Specify the process id of the program to profile.",
+    nargs="+",
+    help="Specify the process ids of the programs to profile.",
+)
+parser.add_argument(
+    "-pn",
+    "--process-name",
+    default=None,
+    help="Profile every process whose name matches this regular expression.",
+)
+parser.add_argument(
+    "-c",
+    "--children-of",
+    type=int,
+    default=None,
+    help="Profile every descendant of this process id.",
 )
 parser.add_argument(
     "-hf",
@@ -73,17 +88,29 @@ parser.add_argument(
     default=100000,
     help="Maximum number of allocation records the POSIX shared memory region can hold before wrapping."
 )
+parser.add_argument(
+    "--no-prefault",
+    action="store_true",
+    help="Don't fault in the pages of the shared memory region when it is created. Saves memory up front, but the first writes to each page stall the hooked process.",
+)
+parser.add_argument(
+    "--hugepages",
+    action="store_true",
+    help="Back the shared memory region with huge pages, from hugetlbfs when mounted at /dev/hugepages or transparent huge pages otherwise. Falls back to normal pages.",
+)
 parser.add_argument(
     "-pf",
     "--print-frequency",
+    type=float,
     default=5,
     help="Specify print interval (in seconds) of the current state of allocations."
 )
 parser.add_argument(
     "-rf",
     "--read-frequency",
+    type=float,
     default=0,
-    help="Specify read interval (in seconds) from the profiler ."
+    help="Longest time (in seconds) the profiler sleeps on an empty buffer when no wake-up arrives from the hooks. 0 uses the built-in default.",
 )
 parser.add_argument(
     "-o",
@@ -95,7 +122,7 @@ parser.add_argument(
     "-g",
     "--graph",
     action="store_true",
-    help="Show an interactive graph showing the current allocation size over time.",
+    help="Show an interactive graph showing the current allocation size over time. The graph runs in its own process, live_view.py opens it for a profiler that is already running.",
 )
 parser.add_argument(
     "-tw",
@@ -131,19 +158,100 @@ parser.add_argument(
     action="store_true",
     help="Enable thread-safe mode (use locks to protect shared data)"
 )
+parser.add_argument(
+    "-mf",
+    "--metrics-file",
+    default=None,
+    help="Periodically write the profiler's own health metrics (ring fill, drain rate, reader lag, drops) to this file in Prometheus text format.",
+)
+parser.add_argument(
+    "-mi",
+    "--metrics-interval",
+    type=float,
+    default=1,
+    help="Interval (in seconds) between writes of the metrics file."
+)
+parser.add_argument(
+    "-sf",
+    "--snapshot-file",
+    default=None,
+    help="Periodically append a snapshot of the live heap per call stack to this file. Inspect it with snapshot.py.",
+)
+parser.add_argument(
+    "-si",
+    "--snapshot-interval",
+    type=float,
+    default=60,
+    help="Interval (in seconds) between heap snapshots."
+)
+parser.add_argument(
+    "-la",
+    "--leak-age",
+    type=float,
+    default=600,
+    help="Allocations live for longer than this (in seconds) are reported as suspected leaks.",
+)
+parser.add_argument(
+    "-cl",
+    "--churn-lifetime",
+    type=float,
+    default=0,
+    help="Count allocations freed within this many microseconds per call stack inside the hook instead of recording them. 0 disables it.",
+)
+parser.add_argument(
+    "-os",
+    "--overhead-sampling",
+    type=int,
+    default=64,
+    help="Time one in this many hook calls of every thread to report the hooks' own overhead per phase. 1 times every call, 0 disables it.",
+)
+parser.add_argument(
+    "-ri",
+    "--resident-interval",
+    type=float,
+    default=0.1,
+    help="Seconds between samples of the targets' RSS from /proc, reported and plotted next to the requested live bytes. 0 disables them.",
+)
+parser.add_argument(
+    "--allocator-stats",
+    action="store_true",
+    help="Have the hooks add glibc's mallinfo2 counters (heap in use, free chunks, mmapped) to every resident sample. mallinfo2 walks the free lists under the allocator's locks.",
+)
+parser.add_argument(
+    "-cf",
+    "--capture-file",
+    default=None,
+    help="Write every event to this file in a compressed columnar format. Inspect it with capture.py, query it with query.py.",
+)
+parser.add_argument(
+    "--capture-codec",
+    default="zlib",
+    choices=["zlib", "lzma"],
+    help="Compression of the capture file. lzma is smaller and slower.",
+)
+parser.add_argument(
+    "-pp",
+    "--pprof-file",
+    default=None,
+    help="On exit, write a gzip compressed pprof profile with alloc and inuse space and objects per call stack.",
+)
+parser.add_argument(
+    "-ff",
+    "--folded-file",
+    default=None,
+    help="On exit, write the call stacks in collapsed (folded) format for flamegraph tools.",
+)
+parser.add_argument(
+    "-ft",
+    "--folded-type",
+    default="alloc_space",
+    choices=["alloc_objects", "alloc_space", "inuse_objects", "inuse_space"],
+    help="Value written per call stack to the folded file.",
+)
 
 args = parser.parse_args()
 
 
-@dataclass
-class BufferSize:
-    type: str
-    size: int
-
-    def __str__(self):
-        return self.type + str(self.size)
-
-
 def verify_filter_sizes(filter_size: list[int]):
     remove_sizes = []
 
@@ -156,6 +264,72 @@ def verify_filter_sizes(filter_size: list[int]):
         filter_size.remove(size)
 
 
+def get_process_children() -> dict[int, list[int]]:
+    """Map every running process id to the ids of its direct children"""
+    children: dict[int, list[int]] = {}
+
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                stat = f.read()
+        except OSError:
+            continue  # The process exited while scanning
+
+        # The name in parentheses may contain spaces, the parent id is the second field after it
+        parent = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(parent, []).append(int(entry))
+
+    return children
+
+
+def find_descendants(pid: int) -> list[int]:
+    children = get_process_children()
+    descendants: list[int] = []
+    pending = [pid]
+
+    while pending:
+        for child in children.get(pending.pop(), []):
+            descendants.append(child)
+            pending.append(child)
+
+    return sorted(descendants)
+
+
+def find_by_name(pattern: str) -> list[int]:
+    regex = re.compile(pattern)
+    pids: list[int] = []
+
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit() or int(entry) == os.getpid():
+            continue
+        try:
+            with open(f"/proc/{entry}/comm", "r") as f:
+                name = f.read().strip()
+        except OSError:
+            continue
+
+        if regex.search(name):
+            pids.append(int(entry))
+
+    return sorted(pids)
+
+
+def resolve_pids(args) -> list[int]:
+    pids: list[int] = []
+
+    if args.pid:
+        pids += map(int, args.pid)
+    if args.process_name:
+        pids += find_by_name(args.process_name)
+    if args.children_of is not None:
+        pids += find_descendants(args.children_of)
+
+    # Remove duplicates but keep the order
+    return list(dict.fromkeys(pids))
+
+
 # TODO: Fix parsing of buffer from cli
 def parse_buffer_size(args) -> BufferSize:
     if "-sb" in sys.argv or "--shm-buffer-bytes" in sys.argv:
@@ -164,8 +338,12 @@ def parse_buffer_size(args) -> BufferSize:
 
 try:
     hook_functions = args.hook_function
-    pid = int(args.pid[0])
+    pids = resolve_pids(args)
+    if not pids:
+        raise ValueError("no process to profile, use --pid, --process-name or --children-of")
     buffer_sizes = parse_buffer_size(args)
+    prefault = not args.no_prefault
+    hugepages = args.hugepages
 
     if args.filter_size:
         filter_size = list(map(int, args.filter_size))
@@ -192,6 +370,20 @@ try:
     time_window = args.time_window
     max_backtraces = args.max_backtraces
     thread_safe = args.thread_safe
+    metrics_file = args.metrics_file
+    metrics_interval = args.metrics_interval
+    snapshot_file = args.snapshot_file
+    snapshot_interval = args.snapshot_interval
+    leak_age = args.leak_age
+    churn_lifetime = args.churn_lifetime
+    overhead_sampling = args.overhead_sampling
+    resident_interval = args.resident_interval
+    allocator_stats = args.allocator_stats
+    capture_file = args.capture_file
+    capture_codec = args.capture_codec
+    pprof_file = args.pprof_file
+    folded_file = args.folded_file
+    folded_type = args.folded_type
 
     if print_frequency < 0:
         print(f"Print frequency {print_frequency} is less than zero, changed to 5.")
@@ -199,7 +391,35 @@ try:
 
     if read_frequency < 0:
         print(f"Read frequency {read_frequency} is less than zero, changed to 0.")
-        print_frequency = 0
+        read_frequency = 0
+
+    if metrics_interval <= 0:
+        print(f"Metrics interval {metrics_interval} is not positive, changed to 1.")
+        metrics_interval = 1
+
+    if snapshot_interval <= 0:
+        print(f"Snapshot interval {snapshot_interval} is not positive, changed to 60.")
+        snapshot_interval = 60
+
+    if leak_age < 0:
+        print(f"Leak age {leak_age} is less than zero, changed to 600.")
+        leak_age = 600
+
+    if churn_lifetime < 0:
+        print(f"Churn lifetime {churn_lifetime} is less than zero, changed to 0.")
+        churn_lifetime = 0
+
+    if overhead_sampling < 0:
+        print(f"Overhead sampling {overhead_sampling} is less than zero, changed to 0.")
+        overhead_sampling = 0
+
+    if resident_interval < 0:
+        print(f"Resident interval {resident_interval} is less than zero, changed to 0.")
+        resident_interval = 0
+
+    if allocator_stats and not resident_interval:
+        print("Allocator stats are only read with resident samples, --allocator-stats is ignored.")
+        allocator_stats = False
 
 except Exception as e:
     print(f"Error while parsing input arguments: {e}")
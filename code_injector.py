@@ -1,3 +1,4 @@
+import hashlib
 import os
 import shutil
 import subprocess
@@ -5,8 +6,6 @@ from dataclasses import dataclass
 from enum import Enum
 from tempfile import TemporaryDirectory
 
-import cli
-
 
 class Placeholder(str, Enum):
     ALLOC_FILTER_RANGE = "<<<ALLOC_FILTER_RANGE>>>"
@@ -16,6 +15,21 @@ class Placeholder(str, Enum):
     BACKTRACE_GLIBC = "<<<USE_BACKTRACE_GLIBC>>>"
     TIMESTAMP = "<<<TIMESTAMP>>>"
     THREAD_SAFE = "<<<THREAD_SAFE>>>"
+    TRACK_POINTER = "<<<TRACK_POINTER>>>"
+    FREE_FILTER = "<<<FREE_FILTER>>>"
+    FREE_BACKTRACE = "<<<FREE_BACKTRACE>>>"
+    CHURN_LIFETIME = "<<<CHURN_LIFETIME>>>"
+    OVERHEAD_SAMPLING = "<<<OVERHEAD_SAMPLING>>>"
+    ALLOCATOR_STATS = "<<<ALLOCATOR_STATS>>>"
+
+@dataclass
+class BufferSize:
+    type: str
+    size: int
+
+    def __str__(self):
+        return self.type + str(self.size)
+
 
 @dataclass
 class CodeEntry:
@@ -59,11 +73,13 @@ class CodeEntryFactory:
         return CodeEntry(placeholder, snippet)
 
     @staticmethod
-    def buffer_sizes(buffer: cli.BufferSize) -> CodeEntry:
+    def buffer_sizes(buffer: BufferSize, prefault: bool = True, hugepages: bool = False) -> CodeEntry:
         placeholder = Placeholder.BUFFER
         snippet = ""
         type = buffer.type
-        snippet = 'buffer("/mem_hook", 12, {}, 12 + {})'
+        # HEAD_SIZE is defined in hook_lib/ring_layout.h
+        snippet = "buffer(shm_name().c_str(), HEAD_SIZE, {}, HEAD_SIZE + {}, "
+        snippet += f"{str(prefault).lower()}, {str(hugepages).lower()})"
 
         if type == "w":
             snippet = snippet.format("sizeof(Trace) * " + str(buffer.size), {})
@@ -87,21 +103,65 @@ class CodeEntryFactory:
         snippet = f"uint32_t backtrace_size = backtrace(backtrace_buffer.begin(), {count});"
         return CodeEntry(Placeholder.BACKTRACE_GLIBC, snippet)
 
+    @staticmethod
+    def free_backtrace(backtrace: CodeEntry) -> CodeEntry:
+        """The backtrace entry, used for the free hooks"""
+        return CodeEntry(Placeholder.FREE_BACKTRACE, backtrace.snippet)
+
+    @staticmethod
+    def free_backtrace_none() -> CodeEntry:
+        snippet = "uint32_t backtrace_size{0};"
+        return CodeEntry(Placeholder.FREE_BACKTRACE, snippet)
+
+    @staticmethod
+    def track_pointer() -> CodeEntry:
+        """Remember the pointers that passed the allocation filters"""
+        snippet = "tracked.insert(ptr);"
+        return CodeEntry(Placeholder.TRACK_POINTER, snippet)
+
+    @staticmethod
+    def free_filter() -> CodeEntry:
+        """Only record frees of tracked pointers, or all once the set is full"""
+        snippet = "if (!tracked.remove(ptr) && !tracked.saturated())\nreturn false;"
+        return CodeEntry(Placeholder.FREE_FILTER, snippet)
+
     @staticmethod
     def timestamp_none() -> CodeEntry:
-        snippet = "uint64_t timestamp {0};"
+        snippet = "uint64_t timestamp {0};\nuint16_t cpu_id{Trace::NO_CPU};"
         return CodeEntry(Placeholder.TIMESTAMP, snippet)
 
     @staticmethod
     def timestamp_rdtscp() -> CodeEntry:
-        snippet = "uint64_t timestamp;\nuint32_t cpu;\n timestamp = __rdtscp(&cpu);"
+        # Linux keeps the cpu number in the low 12 bits of IA32_TSC_AUX
+        snippet = "uint64_t timestamp;\nuint32_t cpu;\n timestamp = __rdtscp(&cpu);\nuint16_t cpu_id = cpu & 0xFFF;"
         return CodeEntry(Placeholder.TIMESTAMP, snippet)
 
     @staticmethod
     def timestamp_chrono() -> CodeEntry:
-        snippet = "auto now = std::chrono::high_resolution_clock::now();\nuint64_t timestamp = std::chrono::duration_cast<std::chrono::nanoseconds>(now.time_since_epoch()).count();"
+        snippet = "auto now = std::chrono::high_resolution_clock::now();\nuint64_t timestamp = std::chrono::duration_cast<std::chrono::nanoseconds>(now.time_since_epoch()).count();\nuint16_t cpu_id{Trace::NO_CPU};"
         return CodeEntry(Placeholder.TIMESTAMP, snippet)
 
+    @staticmethod
+    def churn_lifetime(microseconds: float) -> CodeEntry:
+        """Allocations freed within this lifetime are only counted in the hook, 0 disables it"""
+        snippet = f"{round(microseconds * 1000)}ull"
+        return CodeEntry(Placeholder.CHURN_LIFETIME, snippet)
+
+    @staticmethod
+    def overhead_sampling(every: int) -> CodeEntry:
+        """Time one in every hook calls of a thread to measure the hooks themselves, 0 disables it"""
+        return CodeEntry(Placeholder.OVERHEAD_SAMPLING, f"{every}u")
+
+    @staticmethod
+    def allocator_stats(enabled: bool) -> CodeEntry:
+        """Answer the profiler's requests for the allocator's counters from mallinfo2"""
+        return CodeEntry(Placeholder.ALLOCATOR_STATS, "true" if enabled else "false")
+
+    @staticmethod
+    def defaults() -> list[CodeEntry]:
+        """Entries of the placeholders the hooks don't compile without, used when none was given"""
+        return [CodeEntryFactory.free_backtrace_none()]
+
     @staticmethod
     def thread_safe(safe: bool) -> CodeEntry:
         snippet = "true" if safe else "false"
@@ -110,9 +170,11 @@ class CodeEntryFactory:
 class CodeInjector:
     DIRECTORY: str = "hook_lib"
     LIB_NAME: str = "hook.so"
+    CACHE_BUILDS: int = 16  # Builds kept in the cache, the least recently used are removed
 
     @staticmethod
-    def inject(code_entries: list[CodeEntry]):
+    def inject(code_entries: list[CodeEntry], lib_dst: str | None = None) -> str:
+        """Build the library with the snippets, or reuse the same build from the cache. Returns its path."""
         # Get the paths and files
         project_path: str = os.path.dirname(
             os.path.abspath(__file__)
@@ -121,26 +183,101 @@ class CodeInjector:
             project_path, CodeInjector.DIRECTORY
         )  # C++ library directory
         files: list[str] = CodeInjector.get_files(lib_path)  # C++ files to be compiled
+        if lib_dst is None:
+            lib_dst = os.path.join(project_path, CodeInjector.LIB_NAME)
 
         # Copy each C++ file to a temporary directory
-        # Insert the snippets, compile, and move the library file to the running directory
+        # Insert the snippets, compile unless cached, and copy the library to lib_dst
         with TemporaryDirectory() as temp_path:
             for file in files:
                 file_name = os.path.basename(file)
                 temp_file = os.path.join(temp_path, file_name)
                 CodeInjector.copy_and_inject(file, temp_file, code_entries)
 
-            # Build the library in the temporary directory
+            # The same sources and compiler always build the same library
+            cache_dir = CodeInjector.get_cache_dir()
+            cached = os.path.join(cache_dir, f"hook-{CodeInjector.get_build_hash(temp_path)}.so")
+            if os.path.isfile(cached):
+                # Marks it as recently used for pruning
+                os.utime(cached)
+            else:
+                # Build the library in the temporary directory
+                try:
+                    subprocess.run(["make", "-C", temp_path], check=True)
+                except Exception as e:
+                    print(f"Could not build library: {e}")
+                    exit(1)
+
+                # Renamed into place, a build that was interrupted is never found in the cache
+                lib_src: str = os.path.join(temp_path, CodeInjector.LIB_NAME)
+                try:
+                    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+                    partial = cached + f".{os.getpid()}"
+                    shutil.move(lib_src, partial)
+                    os.replace(partial, cached)
+                    CodeInjector.prune_cache(cache_dir, CodeInjector.CACHE_BUILDS)
+                except OSError as e:
+                    print(f"Could not cache library: {e}")
+                    shutil.move(lib_src, lib_dst)
+                    return lib_dst
+
+        # Copied under another name and renamed, a target that has the old library loaded keeps it
+        partial = lib_dst + f".{os.getpid()}"
+        shutil.copy(cached, partial)
+        os.replace(partial, lib_dst)
+        return lib_dst
+
+    @staticmethod
+    def get_cache_dir() -> str:
+        """Per user, a directory others can write to could hand the target any library"""
+        cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(cache_home, "mem-hook")
+
+    @staticmethod
+    def prune_cache(cache_dir: str, keep: int):
+        """Remove all but the keep most recently used builds"""
+        builds = []
+        for name in os.listdir(cache_dir):
+            if name.startswith("hook-") and name.endswith(".so"):
+                path = os.path.join(cache_dir, name)
+                try:
+                    builds.append((os.stat(path).st_mtime_ns, path))
+                except FileNotFoundError:
+                    pass  # Pruned by another profiler
+
+        for _, path in sorted(builds, reverse=True)[keep:]:
             try:
-                subprocess.run(["make", "-C", temp_path], check=True)
-            except Exception as e:
-                print(f"Could not build library: {e}")
-                exit(1)
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
 
-            # Move the compiled library into the project directory
-            lib_src: str = os.path.join(temp_path, CodeInjector.LIB_NAME)
-            lib_dst: str = os.path.join(project_path, CodeInjector.LIB_NAME)
-            shutil.move(lib_src, lib_dst)
+    @staticmethod
+    def get_build_flags(dir: str) -> str:
+        """CXX and CXXFLAGS as make sees them, after overrides from the environment and MAKEFLAGS"""
+        target = "mem_hook_build_flags"
+        output = subprocess.run(
+            ["make", "-s", "-C", dir, "--eval", f"{target}: ; @echo $(CXX) $(CXXFLAGS)", target],
+            capture_output=True,
+            text=True,
+        )
+        return output.stdout.strip()
+
+    @staticmethod
+    def get_build_hash(dir: str) -> str:
+        """Hash of the injected sources, the Makefile, the flags and the compiler they are built with"""
+        digest = hashlib.sha256()
+        for file in sorted(CodeInjector.get_files(dir)):
+            digest.update(os.path.basename(file).encode() + b"\0")
+            with open(file, "rb") as f:
+                digest.update(f.read() + b"\0")
+
+        flags = CodeInjector.get_build_flags(dir)
+        digest.update(flags.encode() + b"\0")
+        compiler = shutil.which(flags.split()[0]) if flags else None
+        if compiler:
+            stat = os.stat(compiler)
+            digest.update(f"{os.path.realpath(compiler)}:{stat.st_mtime_ns}:{stat.st_size}".encode())
+        return digest.hexdigest()[:32]
 
     @staticmethod
     def get_files(dir: str) -> list[str]:
@@ -166,7 +303,9 @@ class CodeInjector:
             for code_entry in code_entries:
                 content = code_entry.inject(content)
 
-            # Clean up all placeholders
+            # Placeholders left without an entry get their default, the others are removed
+            for code_entry in CodeEntryFactory.defaults():
+                content = code_entry.inject(content)
             for _, member in Placeholder.__members__.items():
                 content = content.replace(member, "")
 
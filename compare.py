@@ -0,0 +1,207 @@
+"""
+Compares the allocation behaviour of two runs per call site, e.g. of two
+releases. Call sites are matched on their normalized stacks (see normalize),
+so captures and snapshots of different runs, or of different processes of the
+same binary, line up. With thresholds, the command exits with status 1 when a
+call site regressed past them and can gate a release.
+
+Captures are reduced block by block to counters per normalized stack, both
+sides are then joined on a 64 bit hash of the stacks. Memory use depends on
+the number of call sites, not on the size of the captures.
+"""
+
+import argparse
+from dataclasses import dataclass
+
+import numpy as np
+
+from capture import MAGIC as CAPTURE_MAGIC
+from capture import CaptureReader
+from normalize import NormalizedTable
+from shared_buffer import ALLOCATION_TYPES, print_header
+from snapshot import MAGIC as SNAPSHOT_MAGIC
+from snapshot import read_snapshots
+
+# 1 for the trace types of frees, by type
+FREES = np.ones(256, dtype=np.int64)
+FREES[ALLOCATION_TYPES] = 0
+
+# Metric, what it counts in captures and in snapshots
+METRICS: dict[str, str] = {
+    "bytes": "Bytes allocated, live bytes of snapshots",
+    "count": "Allocations, live allocations of snapshots",
+    "churn": "Allocations freed during the capture, only in captures",
+    "live": "Bytes still live at the end",
+}
+
+
+@dataclass
+class CallSites:
+    """Counters per call site of one file, sorted by key"""
+
+    keys: np.ndarray  # Hash of the normalized stack
+    counters: dict[str, np.ndarray]  # Per metric
+    stacks: np.ndarray  # A normalized stack id with the key, to describe it
+    table: NormalizedTable
+    kind: str
+
+
+def aggregate(table: NormalizedTable, counters: dict[str, np.ndarray], kind: str) -> CallSites:
+    """Sum the counters of normalized stacks with the same key, from different processes"""
+    keys, first, inverse = np.unique(table.keys(), return_index=True, return_inverse=True)
+    summed = {name: np.bincount(inverse, weights=values, minlength=len(keys)).astype(np.int64) for name, values in counters.items()}
+    return CallSites(keys, summed, first, table, kind)
+
+
+def capture_sites(path: str) -> CallSites:
+    reader = CaptureReader(path)
+    table = reader.normalized
+    counters = {name: np.zeros(table.count, dtype=np.int64) for name in METRICS}
+
+    for pid, events in reader.events():
+        stack_map = table.stack_maps.get(pid)
+        if stack_map is None:
+            continue
+        events = events[(events["stack_id"] >= 0) & (events["stack_id"] < len(stack_map))]
+
+        # Allocations and frees of every stack in one pass, frees go to the odd slots.
+        # Per block sums stay far below 2^53, so float64 weights are exact.
+        slots = 2 * stack_map[events["stack_id"]].astype(np.int64) + FREES[events["type"]]
+        counts = np.bincount(slots, minlength=2 * table.count).reshape(-1, 2)
+        sizes = np.bincount(slots, weights=events["size"].astype(np.float64), minlength=2 * table.count)
+        sizes = sizes.astype(np.int64).reshape(-1, 2)
+
+        counters["bytes"] += sizes[:, 0]
+        counters["count"] += counts[:, 0]
+        counters["churn"] += counts[:, 1]
+        counters["live"] += sizes[:, 0] - sizes[:, 1]
+
+    reader.close()
+    return aggregate(table, counters, "capture")
+
+
+def snapshot_sites(path: str) -> CallSites:
+    """Counters of the last snapshot of every process"""
+    snapshots, _, table = read_snapshots(path)
+    counters = {name: np.zeros(table.count, dtype=np.int64) for name in METRICS}
+
+    last = {snapshot.pid: snapshot for snapshot in snapshots}
+    for pid, snapshot in last.items():
+        stacks = table.stack_maps[pid][snapshot.stack_ids]
+        np.add.at(counters["bytes"], stacks, snapshot.live_bytes)
+        np.add.at(counters["count"], stacks, snapshot.live_count)
+        np.add.at(counters["live"], stacks, snapshot.live_bytes)
+
+    return aggregate(table, counters, "snapshot")
+
+
+def load_sites(path: str) -> CallSites:
+    with open(path, "rb") as f:
+        magic = f.read(len(CAPTURE_MAGIC))
+    if magic == CAPTURE_MAGIC:
+        return capture_sites(path)
+    if magic == SNAPSHOT_MAGIC:
+        return snapshot_sites(path)
+    raise ValueError(f"{path} is neither a capture nor a snapshot file")
+
+
+@dataclass
+class Comparison:
+    keys: np.ndarray
+    old: np.ndarray
+    new: np.ndarray
+    where: np.ndarray  # 0 if the site is described by the old file, 1 by the new one
+    stacks: np.ndarray  # Normalized stack id in that file
+
+    @property
+    def delta(self) -> np.ndarray:
+        return self.new - self.old
+
+    @property
+    def percent(self) -> np.ndarray:
+        """Relative change, infinite for new call sites"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            percent = 100 * self.delta / self.old
+        percent[(self.old == 0) & (self.delta > 0)] = np.inf
+        percent[(self.old == 0) & (self.delta <= 0)] = 0
+        return percent
+
+
+def compare(old: CallSites, new: CallSites, metric: str) -> Comparison:
+    """Full outer join of both files on the call site keys"""
+    keys = np.union1d(old.keys, new.keys)
+    old_index = np.searchsorted(keys, old.keys)
+    new_index = np.searchsorted(keys, new.keys)
+
+    result = Comparison(
+        keys,
+        np.zeros(len(keys), dtype=np.int64),
+        np.zeros(len(keys), dtype=np.int64),
+        np.zeros(len(keys), dtype=np.int8),
+        np.zeros(len(keys), dtype=np.int64),
+    )
+    result.old[old_index] = old.counters[metric]
+    result.new[new_index] = new.counters[metric]
+    result.stacks[old_index] = old.stacks
+    result.where[new_index] = 1
+    result.stacks[new_index] = new.stacks
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rank call sites by how much their allocations grew between two captures or snapshots.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("old", help="Capture or snapshot file of the baseline run.")
+    parser.add_argument("new", help="Capture or snapshot file of the run to check.")
+    parser.add_argument("-m", "--metric", default="bytes", choices=list(METRICS), help="What to compare per call site.")
+    parser.add_argument("-n", "--count", type=int, default=10, help="Number of call sites to show.")
+    parser.add_argument("-t", "--threshold", type=int, default=None, help="Increase of the metric allowed per call site.")
+    parser.add_argument("-tp", "--threshold-percent", type=float, default=None, help="Relative increase allowed per call site.")
+    args = parser.parse_args()
+
+    try:
+        old, new = load_sites(args.old), load_sites(args.new)
+    except (OSError, ValueError) as e:
+        print(f"Could not read input: {e}")
+        exit(2)
+
+    if args.metric == "churn" and "snapshot" in (old.kind, new.kind):
+        print("Snapshots have no churn, compare captures instead")
+        exit(2)
+
+    result = compare(old, new, args.metric)
+    delta, percent = result.delta, result.percent
+
+    # A call site regressed when its increase passes every threshold given
+    gate = args.threshold is not None or args.threshold_percent is not None
+    failed = delta > (args.threshold or 0)
+    if args.threshold_percent is not None:
+        failed &= percent > args.threshold_percent
+    failed &= gate
+
+    total_old, total_new = int(result.old.sum()), int(result.new.sum())
+    print_header("Call Site Regressions")
+    print(f"Metric: {args.metric} ({METRICS[args.metric]})")
+    print(f"Total: {total_old} -> {total_new} ({total_new - total_old:+}), {len(old.keys)} -> {len(new.keys)} call sites\n")
+
+    print(f"Top Call Sites by Increase in {args.metric.capitalize()}:")
+    for index in np.argsort(-delta, kind="stable")[: args.count].tolist():
+        if delta[index] <= 0:
+            break
+        sites = new if result.where[index] else old
+        mark = "  REGRESSION" if failed[index] else ""
+        print(
+            f"  - {int(delta[index]):+} ({percent[index]:+.1f}%), "
+            f"{int(result.old[index])} -> {int(result.new[index])}{mark}"
+        )
+        print(f"    Backtrace: {sites.table.describe(int(result.stacks[index]))}\n")
+
+    if gate:
+        print(f"{int(failed.sum())} call sites regressed past the thresholds")
+        exit(1 if failed.any() else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Finds the GOT slots of the functions an executable imports, the entries the
+hooks are written to. Only the section headers, the dynamic relocations and
+the dynamic symbols are read, instead of disassembling the whole file.
+Little endian ELF64 (x86-64) only.
+"""
+
+import mmap
+import struct
+from dataclasses import dataclass
+
+import numpy as np
+
+ELF_HEADER = struct.Struct("<16sHHIQQQIHHHHHH")
+
+SECTION_DTYPE = np.dtype(
+    [
+        ("name", "<u4"),
+        ("type", "<u4"),
+        ("flags", "<u8"),
+        ("addr", "<u8"),
+        ("offset", "<u8"),
+        ("size", "<u8"),
+        ("link", "<u4"),
+        ("info", "<u4"),
+        ("addralign", "<u8"),
+        ("entsize", "<u8"),
+    ]
+)
+RELA_DTYPE = np.dtype([("offset", "<u8"), ("info", "<u8"), ("addend", "<i8")])
+SYMBOL_DTYPE = np.dtype(
+    [
+        ("name", "<u4"),
+        ("info", "u1"),
+        ("other", "u1"),
+        ("shndx", "<u2"),
+        ("value", "<u8"),
+        ("size", "<u8"),
+    ]
+)
+
+ET_DYN = 3
+EM_X86_64 = 62
+SHT_RELA = 4
+SHT_DYNSYM = 11
+R_X86_64_GLOB_DAT = 6  # Calls through the GOT without a PLT stub, -fno-plt
+R_X86_64_JUMP_SLOT = 7
+
+
+@dataclass
+class GotSlots:
+    slots: dict[str, int]  # Function name to the address of its GOT slot in the file
+    relocatable: bool  # Position independent, the addresses are relative to the load address
+
+
+def read_got_slots(path: str) -> GotSlots:
+    with open(path, "rb") as f:
+        mem = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return parse_got_slots(mem)
+    finally:
+        mem.close()
+
+
+def parse_got_slots(data) -> GotSlots:
+    ident, type, machine, _, _, _, section_offset, _, _, _, _, section_size, sections, _ = ELF_HEADER.unpack_from(data)
+    if ident[:4] != b"\x7fELF" or ident[4] != 2 or ident[5] != 1:
+        raise ValueError("not a little endian ELF64 file")
+    if machine != EM_X86_64:
+        raise ValueError(f"relocations of machine {machine} are not supported")
+    if section_size != SECTION_DTYPE.itemsize or not sections:
+        raise ValueError("the file has no section headers")
+
+    # Copies, so no array keeps the mapping of the file exported
+    headers = np.frombuffer(data, dtype=SECTION_DTYPE, count=sections, offset=section_offset).copy()
+
+    def section(index: int, dtype: np.dtype) -> np.ndarray:
+        header = headers[index]
+        count = int(header["size"]) // dtype.itemsize
+        return np.frombuffer(data, dtype=dtype, count=count, offset=int(header["offset"])).copy()
+
+    slots: dict[str, int] = {}
+    # Jump slots first, a function also called through a GLOB_DAT slot keeps its PLT slot
+    for wanted in (R_X86_64_JUMP_SLOT, R_X86_64_GLOB_DAT):
+        for index in np.flatnonzero(headers["type"] == SHT_RELA).tolist():
+            symbol_index = int(headers[index]["link"])
+            if headers[symbol_index]["type"] != SHT_DYNSYM:
+                continue
+            symbols = section(symbol_index, SYMBOL_DTYPE)
+            strings = headers[int(headers[symbol_index]["link"])]
+            string_offset = int(strings["offset"])
+
+            relocations = section(index, RELA_DTYPE)
+            relocations = relocations[(relocations["info"] & 0xFFFFFFFF) == wanted]
+            for offset, symbol in zip(relocations["offset"].tolist(), (relocations["info"] >> 32).tolist()):
+                start = string_offset + int(symbols[symbol]["name"])
+                name = bytes(data[start : data.find(b"\0", start)]).decode()
+                slots.setdefault(name, offset)
+
+    return GotSlots(slots, type == ET_DYN)
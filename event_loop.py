@@ -0,0 +1,125 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from metrics import SchedulerMetrics
+from shared_buffer import Memtracker, SharedBuffer
+
+
+@dataclass
+class PeriodicJob:
+    """
+    A job run every interval seconds. prepare runs on the event loop and must
+    be quick, e.g. copying statistics. Its result is handed to publish, which
+    runs in the executor so slow formatting and I/O never hold up draining.
+    """
+
+    name: str
+    interval: float
+    prepare: Callable[[], Any]
+    publish: Callable[[Any], None] | None = None
+
+
+class Scheduler:
+    """
+    Runs all work of the profiler on a single asyncio loop: draining the rings,
+    periodic reports, graph frames and metrics. Everything touching the
+    Memtrackers runs on the loop thread, so no locking is needed.
+    """
+
+    DRAIN_BUDGET: float = 0.01  # Seconds a ring is drained before other jobs get a turn
+    FALLBACK_INTERVAL: float = 0.05  # Seconds to sleep on an empty ring when no wake-up arrives
+    JOB_SHARE: float = 0.25  # Share of the loop a periodic job may use before it is spaced out
+
+    def __init__(
+        self,
+        readers: list[tuple[SharedBuffer, Memtracker]],
+        drain_budget: float = DRAIN_BUDGET,
+        fallback_interval: float = FALLBACK_INTERVAL,
+        on_first_event: Callable[[float], None] | None = None,
+    ):
+        self.readers = readers
+        self.drain_budget = drain_budget
+        self.fallback_interval = fallback_interval
+        self.jobs: list[PeriodicJob] = []
+        self.metrics = SchedulerMetrics()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.on_first_event = on_first_event  # Called once with the time of the first record read
+
+    def add_job(
+        self,
+        name: str,
+        interval: float,
+        prepare: Callable[[], Any],
+        publish: Callable[[Any], None] | None = None,
+    ):
+        self.jobs.append(PeriodicJob(name, interval, prepare, publish))
+
+    def run(self):
+        """Run until interrupted with CTRL+C"""
+        try:
+            asyncio.run(self._main())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.executor.shutdown(wait=True)
+
+    async def _main(self):
+        tasks = [self._drain(reader, memtracker) for reader, memtracker in self.readers]
+        tasks += [self._run_job(job) for job in self.jobs]
+        await asyncio.gather(*tasks)
+
+    async def _drain(self, reader: SharedBuffer, memtracker: Memtracker):
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+
+        def on_notify():
+            reader.clear_notifications()
+            wakeup.set()
+
+        loop.add_reader(reader.notify_socket.fileno(), on_notify)
+        try:
+            while True:
+                if not reader.read(memtracker, time.perf_counter() + self.drain_budget):
+                    # Records are left, let the other jobs run before continuing
+                    self.metrics.budget_overruns += 1
+                    await asyncio.sleep(0)
+                    continue
+
+                if self.metrics.first_event is None and reader.first_event is not None:
+                    self.metrics.first_event = reader.first_event
+                    if self.on_first_event is not None:
+                        self.on_first_event(reader.first_event)
+
+                if not reader.prepare_wait():
+                    continue
+
+                # A wake-up can be missed if it races with prepare_wait, the timeout covers it
+                try:
+                    await asyncio.wait_for(wakeup.wait(), self.fallback_interval)
+                    self.metrics.notify_wakeups += 1
+                except asyncio.TimeoutError:
+                    self.metrics.timeout_wakeups += 1
+                wakeup.clear()
+        finally:
+            loop.remove_reader(reader.notify_socket.fileno())
+
+    async def _run_job(self, job: PeriodicJob):
+        loop = asyncio.get_running_loop()
+        delay = job.interval
+
+        while True:
+            await asyncio.sleep(delay)
+
+            start = time.perf_counter()
+            result = job.prepare()
+            elapsed = time.perf_counter() - start
+            self.metrics.job_seconds[job.name] = self.metrics.job_seconds.get(job.name, 0.0) + elapsed
+
+            if job.publish is not None:
+                await loop.run_in_executor(self.executor, job.publish, result)
+
+            # A job that is slow on the loop runs less often instead of starving the drains
+            delay = max(job.interval, elapsed / self.JOB_SHARE)
@@ -0,0 +1,151 @@
+"""
+Profiles are built from the per stack counters of StackTable, so their size
+and the time to write them depend on the number of distinct stacks and
+addresses, not on the number of events.
+"""
+
+import gzip
+import time
+
+import numpy as np
+
+from stacks import StackTable
+
+# Sample types in the order their values are written, with their unit
+SAMPLE_TYPES: list[tuple[str, str]] = [
+    ("alloc_objects", "count"),
+    ("alloc_space", "bytes"),
+    ("inuse_objects", "count"),
+    ("inuse_space", "bytes"),
+]
+
+# Field numbers of the pprof profile.proto messages that are written
+PROFILE_SAMPLE_TYPE = 1
+PROFILE_SAMPLE = 2
+PROFILE_LOCATION = 4
+PROFILE_STRING_TABLE = 6
+PROFILE_TIME_NANOS = 9
+PROFILE_DURATION_NANOS = 10
+PROFILE_PERIOD_TYPE = 11
+PROFILE_DEFAULT_SAMPLE_TYPE = 14
+VALUE_TYPE_TYPE = 1
+VALUE_TYPE_UNIT = 2
+SAMPLE_LOCATION_ID = 1
+SAMPLE_VALUE = 2
+SAMPLE_LABEL = 3
+LABEL_KEY = 1
+LABEL_NUM = 3
+LOCATION_ID = 1
+LOCATION_ADDRESS = 3
+
+
+def varint(value: int) -> bytes:
+    # Negative int64 values are written as their 64 bit two's complement
+    value &= (1 << 64) - 1
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def field_varint(field: int, value: int) -> bytes:
+    return varint(field << 3) + varint(value)
+
+
+def field_bytes(field: int, data: bytes) -> bytes:
+    return varint(field << 3 | 2) + varint(len(data)) + data
+
+
+def field_packed(field: int, values) -> bytes:
+    return field_bytes(field, b"".join(varint(int(value)) for value in values))
+
+
+def stack_counters(stacks: StackTable) -> tuple[np.ndarray, np.ndarray]:
+    """Ids of every stack that allocated and their values in SAMPLE_TYPES order"""
+    used = len(stacks)
+    ids = np.flatnonzero(stacks.alloc_count[:used])
+    values = np.stack(
+        [
+            stacks.alloc_count[ids],
+            stacks.alloc_bytes[ids],
+            stacks.live_count[ids],
+            stacks.live_bytes[ids],
+        ],
+        axis=1,
+    )
+    return ids, values
+
+
+class PprofWriter:
+    """Streams a gzip compressed pprof profile, one sample per stack and process"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.strings: dict[str, int] = {"": 0}
+        self.locations: dict[int, int] = {}  # Address -> location id
+
+    def string(self, value: str) -> int:
+        index = self.strings.get(value)
+        if index is None:
+            index = self.strings[value] = len(self.strings)
+        return index
+
+    def location(self, address: int) -> int:
+        location_id = self.locations.get(address)
+        if location_id is None:
+            location_id = self.locations[address] = len(self.locations) + 1
+        return location_id
+
+    def value_type(self, type: str, unit: str) -> bytes:
+        return field_varint(VALUE_TYPE_TYPE, self.string(type)) + field_varint(
+            VALUE_TYPE_UNIT, self.string(unit)
+        )
+
+    def write(self, stack_tables: dict[int, StackTable], duration: float):
+        pid_key = self.string("pid")
+
+        with gzip.open(self.path, "wb") as f:
+            for type, unit in SAMPLE_TYPES:
+                f.write(field_bytes(PROFILE_SAMPLE_TYPE, self.value_type(type, unit)))
+
+            for pid, stacks in stack_tables.items():
+                label = field_bytes(SAMPLE_LABEL, field_varint(LABEL_KEY, pid_key) + field_varint(LABEL_NUM, pid))
+                ids, values = stack_counters(stacks)
+                for stack_id, stack_values in zip(ids.tolist(), values.tolist()):
+                    # Locations are leaf first, like the backtraces
+                    location_ids = [self.location(address) for address in stacks.stacks[stack_id]]
+                    sample = (
+                        field_packed(SAMPLE_LOCATION_ID, location_ids)
+                        + field_packed(SAMPLE_VALUE, stack_values)
+                        + label
+                    )
+                    f.write(field_bytes(PROFILE_SAMPLE, sample))
+
+            for address, location_id in self.locations.items():
+                location = field_varint(LOCATION_ID, location_id) + field_varint(LOCATION_ADDRESS, address)
+                f.write(field_bytes(PROFILE_LOCATION, location))
+
+            f.write(field_bytes(PROFILE_PERIOD_TYPE, self.value_type("space", "bytes")))
+            f.write(field_varint(PROFILE_DEFAULT_SAMPLE_TYPE, self.string("inuse_space")))
+            f.write(field_varint(PROFILE_TIME_NANOS, time.time_ns()))
+            f.write(field_varint(PROFILE_DURATION_NANOS, int(duration * 10**9)))
+
+            # Every string has been interned by now
+            for value in self.strings:
+                f.write(field_bytes(PROFILE_STRING_TABLE, value.encode()))
+
+
+def write_folded(path: str, stack_tables: dict[int, StackTable], sample_type: str):
+    """Write collapsed stacks, root first, as read by flamegraph.pl and most flamegraph viewers"""
+    column = [type for type, _ in SAMPLE_TYPES].index(sample_type)
+
+    with open(path, "w") as f:
+        for pid, stacks in stack_tables.items():
+            ids, values = stack_counters(stacks)
+            for stack_id, value in zip(ids.tolist(), values[:, column].tolist()):
+                if value <= 0:
+                    continue
+                frames = ";".join(hex(address) for address in reversed(stacks.stacks[stack_id]))
+                f.write(f"pid {pid};{frames} {value}\n")
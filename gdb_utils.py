@@ -3,6 +3,9 @@ import subprocess
 
 
 class GdbUtils:
+    # Echoed after every command of a batch to tell their outputs apart
+    OUTPUT_SEPARATOR: str = "--mem-hook-output--"
+
     @staticmethod
     def run_gdb(pid: int, cmd: str) -> str:
         output = subprocess.run(
@@ -14,15 +17,44 @@ class GdbUtils:
             raise ValueError(f"Could not attach GDB to process {pid}")
         return output.stdout.strip()
 
+    @staticmethod
+    def run_gdb_batch(pid: int, cmds: list[str]) -> list[str]:
+        """
+        Run cmds in a single attach, which is what costs the most. Returns the
+        output of every command, empty for commands that failed.
+        """
+        separator = f"echo {GdbUtils.OUTPUT_SEPARATOR}\\n"
+        args = ["gdb", "-p", str(pid), "-batch", "-ex", separator]
+        for cmd in cmds:
+            args += ["-ex", cmd, "-ex", separator]
+        output = subprocess.run(args, capture_output=True, text=True)
+
+        # What gdb prints while attaching comes before the first separator
+        sections = output.stdout.split(GdbUtils.OUTPUT_SEPARATOR + "\n")
+        if len(sections) < 2:
+            raise ValueError(f"Could not attach GDB to process {pid}")
+        outputs = [section.strip() for section in sections[1 : len(cmds) + 1]]
+        return outputs + [""] * (len(cmds) - len(outputs))
+
+    @staticmethod
+    def parse_address(output: str) -> int | None:
+        """The value of a printed pointer, e.g. $1 = (void *) 0x7f0012345678"""
+        value_match = re.search(r"=\s.*?0x([a-fA-F0-9]+)", output)
+        return int(value_match.group(1), 16) if value_match else None
+
+    @staticmethod
+    def parse_function_address(output: str) -> int | None:
+        """The address of a printed function, e.g. $1 = {void *(size_t)} 0x7f0012345678 <malloc>"""
+        func_match = re.search(r"0x([a-fA-F0-9]+)\s<.*>", output)
+        return int(func_match.group(1), 16) if func_match else None
+
     @staticmethod
     def get_function_address(pid: int, func_name: str) -> int:
         output = GdbUtils.run_gdb(pid, f"p {func_name}")
-        func_match = re.search(r"0x([a-fA-F0-9]+)\s<.*>", output)
+        func_addr = GdbUtils.parse_function_address(output)
 
-        if not func_match:
+        if func_addr is None:
             raise ValueError(f"Could not find memory address of function {func_name}")
-
-        func_addr = int(func_match.group(1), 16)
         return func_addr
 
     @staticmethod
@@ -0,0 +1,33 @@
+#include "allocator.h"
+#include <ctime>
+#include <malloc.h>
+
+void allocator_sample(AllocatorHeader* header) {
+    // Claim the request, threads that lose the race carry on
+    uint32_t served{__atomic_load_n(&header->served, __ATOMIC_RELAXED)};
+    uint32_t const requested{__atomic_load_n(&header->requested, __ATOMIC_RELAXED)};
+    if (!__atomic_compare_exchange_n(&header->served, &served, requested, false,
+                                     __ATOMIC_ACQUIRE, __ATOMIC_RELAXED)) {
+        return;
+    }
+
+    // mallinfo2 walks the free lists of every arena under their locks, which
+    // is why it only runs when asked for
+#if __GLIBC_PREREQ(2, 33)
+    struct mallinfo2 const info{mallinfo2()};
+#else
+    struct mallinfo const info{mallinfo()}; // Wraps above 2GB
+#endif
+    timespec now{};
+    clock_gettime(CLOCK_REALTIME, &now);
+
+    // Odd before any counter changes, even again after all of them did
+    __atomic_fetch_add(&header->sequence, 1, __ATOMIC_SEQ_CST);
+    header->time = static_cast<uint64_t>(now.tv_sec) * 1000000000ull + now.tv_nsec;
+    header->arena = info.arena;
+    header->mmapped = info.hblkhd;
+    header->in_use = info.uordblks;
+    header->free = info.fordblks;
+    header->releasable = info.keepcost;
+    __atomic_fetch_add(&header->sequence, 1, __ATOMIC_RELEASE);
+}
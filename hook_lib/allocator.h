@@ -0,0 +1,34 @@
+#pragma once
+#include <cstdint>
+
+// Whether the hooks answer the profiler's requests for mallinfo2
+constexpr bool ALLOCATOR_STATS{<<<ALLOCATOR_STATS>>>};
+
+// Fourth cache line of the ring header, matches ALLOCATOR_DTYPE in resident.py.
+// The profiler bumps requested, the next hook call that sees it differ from
+// served copies the allocator's counters in. sequence is odd while they change.
+struct AllocatorHeader {
+    uint32_t requested;
+    uint32_t served;
+    uint64_t sequence;
+    uint64_t time;     // CLOCK_REALTIME nanoseconds of the copy
+    uint64_t arena;    // Bytes the arenas got from the system, without mmapped chunks
+    uint64_t mmapped;  // Bytes in chunks of their own mmap
+    uint64_t in_use;   // Bytes of the arenas in allocated chunks, headers included
+    uint64_t free;     // Bytes of the arenas in free chunks, kept for reuse
+    uint64_t releasable; // Of those, at the top of the heap and releasable with malloc_trim
+};
+
+static_assert(sizeof(AllocatorHeader) == 64, "AllocatorHeader must fill one cache line");
+
+// Copies mallinfo2 into header unless another thread is already at it
+void allocator_sample(AllocatorHeader* header);
+
+// Called by every hook after the real allocator, a load of a line the profiler
+// only writes a few times a second
+inline void allocator_poll(AllocatorHeader* header) {
+    if (ALLOCATOR_STATS && header &&
+        __atomic_load_n(&header->requested, __ATOMIC_RELAXED) != __atomic_load_n(&header->served, __ATOMIC_RELAXED)) {
+        allocator_sample(header);
+    }
+}
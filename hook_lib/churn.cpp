@@ -0,0 +1,331 @@
+#include "churn.h"
+#include <algorithm>
+#include <cstdio>
+#include <cstring>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <unistd.h>
+
+extern SharedBuffer buffer;
+
+static ChurnTable churn_table{};
+
+// Handed out to threads on their first deferred allocation, never freed
+static ChurnCache caches[CHURN_THREADS]{};
+
+// churn_clock() time after which the next hook call sweeps every cache
+static uint64_t next_sweep{0};
+
+// Number of cached allocations per pointer hash. A free whose hint is zero
+// can skip searching the caches of other threads.
+static uint32_t hints[1 << CHURN_HINT_BITS]{};
+
+// Cache of the current thread, given back when the thread exits
+struct ChurnThread {
+    ChurnCache* cache{nullptr};
+    bool attached{false};
+
+    ChurnCache* get() {
+        if (!attached) {
+            attached = true;
+            for (ChurnCache& candidate : caches) {
+                uint32_t expected{0};
+                if (__atomic_compare_exchange_n(&candidate.owned, &expected, 1, false,
+                                                __ATOMIC_SEQ_CST, __ATOMIC_RELAXED)) {
+                    cache = &candidate;
+                    break;
+                }
+            }
+        }
+        return cache;
+    }
+
+    ~ChurnThread() {
+        if (cache) {
+            cache->flush();
+            __atomic_store_n(&cache->owned, 0, __ATOMIC_SEQ_CST);
+        }
+    }
+};
+
+static thread_local ChurnThread churn_thread{};
+
+static uint32_t hint_index(uintptr_t address) {
+    return ((address >> 4) * 0x9E3779B97F4A7C15ull) >> (64 - CHURN_HINT_BITS);
+}
+
+static uint64_t stack_hash(Trace const& trace) {
+    // FNV-1a over the return addresses
+    uint64_t hash{0xcbf29ce484222325ull};
+    for (uint32_t i = 0; i < trace.backtrace_size; ++i) {
+        hash ^= reinterpret_cast<uintptr_t>(trace.backtrace_buffer[i]);
+        hash *= 0x100000001b3ull;
+    }
+    return hash ? hash : 1;
+}
+
+static uint32_t lifetime_bucket(uint64_t lifetime) {
+    // Bucket 0 holds lifetimes below 128ns, each next one twice as long
+    int const bit{63 - __builtin_clzll(lifetime | 1)};
+    return std::min<uint32_t>(std::max(bit - 6, 0), CHURN_BUCKETS - 1);
+}
+
+ChurnTable::ChurnTable() {
+    if (!CHURN_LIFETIME_NS) {
+        return;
+    }
+
+    std::string const name{shm_name() + ".churn"};
+    fd = shm_open(name.c_str(), O_CREAT | O_RDWR, 0666);
+    if (fd == -1) {
+        perror("shm_open");
+        return;
+    }
+
+    size = sizeof(ChurnHeader) + sizeof(ChurnSite) * CHURN_SITES;
+    if (ftruncate(fd, size) == -1) {
+        perror("ftruncate");
+        return;
+    }
+
+    memory = mmap(nullptr, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    if (memory == MAP_FAILED) {
+        perror("mmap");
+        memory = nullptr;
+        return;
+    }
+
+    header = reinterpret_cast<ChurnHeader*>(memory);
+    sites = reinterpret_cast<ChurnSite*>(header + 1);
+    std::memset(memory, 0, size);
+    header->sites = CHURN_SITES;
+    header->buckets = CHURN_BUCKETS;
+    header->lifetime_ns = CHURN_LIFETIME_NS;
+}
+
+ChurnTable::~ChurnTable() {
+    if (memory) {
+        munmap(memory, size);
+    }
+    if (fd != -1) {
+        close(fd);
+    }
+}
+
+bool ChurnTable::fold(Trace const& trace, uint64_t lifetime, bool remote) {
+    if (!sites) {
+        return false;
+    }
+
+    uint64_t const key{stack_hash(trace)};
+    uint32_t index{static_cast<uint32_t>(key) % CHURN_SITES};
+    for (uint32_t probe = 0; probe < 32; ++probe) {
+        ChurnSite& site{sites[index]};
+        uint64_t current{__atomic_load_n(&site.key, __ATOMIC_ACQUIRE)};
+
+        if (current == 0) {
+            uint64_t expected{0};
+            if (__atomic_compare_exchange_n(&site.key, &expected, key, false,
+                                            __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE)) {
+                site.backtrace_size = trace.backtrace_size;
+                site.backtrace_buffer = trace.backtrace_buffer;
+                __atomic_store_n(&site.ready, 1, __ATOMIC_RELEASE);
+                current = key;
+            } else {
+                current = expected;
+            }
+        }
+
+        if (current == key) {
+            __atomic_fetch_add(&site.count, 1, __ATOMIC_RELAXED);
+            __atomic_fetch_add(&site.bytes, trace.size, __ATOMIC_RELAXED);
+            __atomic_fetch_add(&site.lifetimes[lifetime_bucket(lifetime)], 1, __ATOMIC_RELAXED);
+            __atomic_fetch_add(&header->pairs, 1, __ATOMIC_RELAXED);
+            if (remote) {
+                __atomic_fetch_add(&header->remote, 1, __ATOMIC_RELAXED);
+            }
+            return true;
+        }
+        index = (index + 1) % CHURN_SITES;
+    }
+
+    __atomic_fetch_add(&header->full, 1, __ATOMIC_RELAXED);
+    return false;
+}
+
+void ChurnTable::count_evicted() {
+    if (header) {
+        __atomic_fetch_add(&header->evicted, 1, __ATOMIC_RELAXED);
+    }
+}
+
+void ChurnCache::flush() {
+    for (Entry& entry : entries) {
+        uintptr_t const address{__atomic_load_n(&entry.address, __ATOMIC_ACQUIRE)};
+        if (address && !(address & (EVICTING | CLAIMED))) {
+            evict(entry, address);
+        }
+    }
+}
+
+void ChurnCache::sweep(uint64_t now) {
+    for (Entry& entry : entries) {
+        uintptr_t const address{__atomic_load_n(&entry.address, __ATOMIC_ACQUIRE)};
+        if (address && !(address & (EVICTING | CLAIMED)) &&
+            now > __atomic_load_n(&entry.born, __ATOMIC_RELAXED) + CHURN_LIFETIME_NS) {
+            // Should the entry have been freed and reused for the same address
+            // meanwhile, it is written out early, which is only a missed fold
+            evict(entry, address);
+        }
+    }
+}
+
+void ChurnCache::expire(uint64_t now) {
+    // Entries only get older, from the oldest one on until one that can still churn.
+    // Entries a free or a sweep took are passed over.
+    while (pending) {
+        Entry& oldest{entries[first]};
+        uintptr_t const address{__atomic_load_n(&oldest.address, __ATOMIC_ACQUIRE)};
+        if (address && !(address & (EVICTING | CLAIMED))) {
+            if (now <= __atomic_load_n(&oldest.born, __ATOMIC_RELAXED) + CHURN_LIFETIME_NS) {
+                break;
+            }
+            evict(oldest, address);
+        }
+        first = (first + 1) % CHURN_CACHE;
+        --pending;
+    }
+}
+
+void ChurnCache::evict(Entry& entry, uintptr_t address) {
+    // A free or a sweep on another thread may take the entry first, then it is theirs
+    if (!__atomic_compare_exchange_n(&entry.address, &address, address | EVICTING, false,
+                                     __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE)) {
+        return;
+    }
+
+    buffer.write(entry.trace);
+    churn_table.count_evicted();
+    __atomic_store_n(&entry.address, 0, __ATOMIC_RELEASE);
+    __atomic_fetch_sub(&hints[hint_index(address)], 1, __ATOMIC_SEQ_CST);
+}
+
+bool ChurnCache::claim(Entry& entry, uintptr_t address, uint64_t now, bool remote) {
+    uintptr_t expected{address};
+    if (!__atomic_compare_exchange_n(&entry.address, &expected, address | CLAIMED, false,
+                                     __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE)) {
+        // The owner is writing the allocation to the ring, the free has to follow it
+        while (__atomic_load_n(&entry.address, __ATOMIC_ACQUIRE) == (address | EVICTING)) {
+            __builtin_ia32_pause();
+        }
+        return false;
+    }
+
+    uint64_t const lifetime{now - entry.born};
+    bool folded{false};
+    if (lifetime <= CHURN_LIFETIME_NS) {
+        folded = churn_table.fold(entry.trace, lifetime, remote);
+    }
+    if (!folded) {
+        buffer.write(entry.trace);
+        churn_table.count_evicted();
+    }
+
+    __atomic_store_n(&entry.address, 0, __ATOMIC_RELEASE);
+    __atomic_fetch_sub(&hints[hint_index(address)], 1, __ATOMIC_SEQ_CST);
+    return folded;
+}
+
+bool ChurnCache::defer(Trace const& trace, uint64_t now) {
+    uintptr_t const address{reinterpret_cast<uintptr_t>(trace.address)};
+    if (!address) {
+        return false;
+    }
+
+    expire(now);
+
+    // With every entry in use the oldest makes room
+    Entry& entry{entries[next]};
+    uintptr_t const current{__atomic_load_n(&entry.address, __ATOMIC_ACQUIRE)};
+    if (current) {
+        if (!(current & (EVICTING | CLAIMED))) {
+            evict(entry, current);
+        }
+        if (__atomic_load_n(&entry.address, __ATOMIC_ACQUIRE)) {
+            // Still being folded by a free or written out by a sweep on another thread
+            return false;
+        }
+    }
+    if (pending == CHURN_CACHE) {
+        first = (first + 1) % CHURN_CACHE;
+        --pending;
+    }
+
+    entry.trace = trace;
+    __atomic_store_n(&entry.born, now, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&hints[hint_index(address)], 1, __ATOMIC_SEQ_CST);
+    __atomic_store_n(&entry.address, address, __ATOMIC_RELEASE);
+    next = (next + 1) % CHURN_CACHE;
+    ++pending;
+    return true;
+}
+
+bool ChurnCache::release(uintptr_t address, uint64_t now, bool remote) {
+    for (Entry& entry : entries) {
+        // An entry being evicted has to be waited for, claim does that
+        uintptr_t const current{__atomic_load_n(&entry.address, __ATOMIC_ACQUIRE)};
+        if ((current & ~(EVICTING | CLAIMED)) == address) {
+            return claim(entry, address, now, remote);
+        }
+    }
+    return false;
+}
+
+// Write out what every cache held back for too long, the first hook call after
+// next_sweep does it
+static void churn_sweep(uint64_t now) {
+    uint64_t due{__atomic_load_n(&next_sweep, __ATOMIC_RELAXED)};
+    if (now < due || !__atomic_compare_exchange_n(&next_sweep, &due, now + CHURN_SWEEP_NS, false,
+                                                  __ATOMIC_RELAXED, __ATOMIC_RELAXED)) {
+        return;
+    }
+    for (ChurnCache& cache : caches) {
+        if (__atomic_load_n(&cache.owned, __ATOMIC_ACQUIRE)) {
+            cache.sweep(now);
+        }
+    }
+}
+
+bool churn_defer(Trace const& trace) {
+    uint64_t const now{churn_clock()};
+    churn_sweep(now);
+    ChurnCache* const cache{churn_thread.get()};
+    return cache && cache->defer(trace, now);
+}
+
+bool churn_free(void* ptr) {
+    uintptr_t const address{reinterpret_cast<uintptr_t>(ptr)};
+    if (!address) {
+        return false;
+    }
+
+    // Most short lived allocations are freed by the thread that made them
+    uint64_t const now{churn_clock()};
+    churn_sweep(now);
+    ChurnCache* const local{churn_thread.cache};
+    if (local && local->release(address, now, false)) {
+        return true;
+    }
+
+    if (!__atomic_load_n(&hints[hint_index(address)], __ATOMIC_SEQ_CST)) {
+        return false;
+    }
+
+    for (ChurnCache& cache : caches) {
+        if (&cache != local && __atomic_load_n(&cache.owned, __ATOMIC_ACQUIRE) &&
+            cache.release(address, now, true)) {
+            return true;
+        }
+    }
+    return false;
+}
@@ -0,0 +1,125 @@
+#pragma once
+#include "shared_buffer.h"
+#include <array>
+#include <chrono>
+#include <cstdint>
+
+// Allocations freed within this many nanoseconds are only counted per call
+// stack instead of being written to the ring, 0 disables churn mode
+constexpr uint64_t CHURN_LIFETIME_NS{<<<CHURN_LIFETIME>>>};
+
+constexpr uint32_t CHURN_SITES{2048};   // Call stacks in the shared table
+constexpr uint32_t CHURN_BUCKETS{16};   // Lifetime histogram, log2 of nanoseconds
+constexpr uint32_t CHURN_CACHE{32};     // Deferred allocations per thread
+constexpr uint32_t CHURN_THREADS{64};   // Threads whose allocations are deferred
+constexpr uint32_t CHURN_HINT_BITS{14};
+// How often the caches of all threads are searched for entries too old to churn,
+// by whichever hook call comes first. Threads that stop allocating hold none back.
+constexpr uint64_t CHURN_SWEEP_NS{CHURN_LIFETIME_NS > 10000000 ? CHURN_LIFETIME_NS : 10000000};
+
+// Start of the churn table, matches CHURN_HEAD_DTYPE in churn.py
+struct ChurnHeader {
+    uint32_t sites;
+    uint32_t buckets;
+    uint64_t lifetime_ns;
+    uint64_t pairs;   // Allocation and free pairs folded into the table
+    uint64_t remote;  // Of those, freed by another thread than the allocating one
+    uint64_t full;    // Pairs written to the ring because the table was full
+    uint64_t evicted; // Deferred allocations written to the ring
+    uint64_t reserved[2];
+};
+
+// Churn counters of one call stack, matches CHURN_SITE_DTYPE in churn.py
+struct ChurnSite {
+    uint64_t key;     // Hash of the backtrace, 0 while unused
+    uint32_t ready;   // Set once the backtrace has been written
+    uint32_t backtrace_size;
+    uint64_t count;
+    uint64_t bytes;
+    std::array<uint64_t, CHURN_BUCKETS> lifetimes;
+    std::array<void*, 20> backtrace_buffer;
+};
+
+inline uint64_t churn_clock() {
+    auto const now = std::chrono::steady_clock::now();
+    return std::chrono::duration_cast<std::chrono::nanoseconds>(now.time_since_epoch()).count();
+}
+
+/**
+ * @brief Per call stack counters of short lived allocations, in their own
+ * shared memory object /mem_hook_<pid>.churn read by the profiler.
+ *
+ * Sites are claimed with a compare-and-swap on the backtrace hash and updated
+ * with atomic adds, any thread can fold a pair without a lock.
+ */
+class ChurnTable {
+  public:
+    ChurnTable();
+    ~ChurnTable();
+
+    // Returns false if the table has no room for the stack of trace
+    bool fold(Trace const& trace, uint64_t lifetime, bool remote);
+    void count_evicted();
+
+  private:
+    void* memory{nullptr};
+    int fd{-1};
+    size_t size{0};
+    ChurnHeader* header{nullptr};
+    ChurnSite* sites{nullptr};
+};
+
+/**
+ * @brief The most recent allocations of a thread, kept back from the ring
+ * until they are freed, grow older than CHURN_LIFETIME_NS or are pushed out by
+ * newer ones.
+ *
+ * Caches live in a static pool and are handed to threads on their first
+ * allocation, so other threads can search them for pointers they free without
+ * the cache going away. The address of an entry doubles as its state. The low
+ * bits of a pointer are free, EVICTING marks an entry the owner is writing to
+ * the ring and CLAIMED one taken by a free.
+ */
+class ChurnCache {
+  public:
+    // Returns false if the allocation has to be written to the ring right away
+    bool defer(Trace const& trace, uint64_t now);
+
+    // Returns true if the free of address was folded with its allocation
+    bool release(uintptr_t address, uint64_t now, bool remote);
+
+    // Write every deferred allocation to the ring
+    void flush();
+
+    // Write the deferred allocations older than CHURN_LIFETIME_NS to the ring,
+    // from any thread
+    void sweep(uint64_t now);
+
+    uint32_t owned{0};
+
+  private:
+    struct Entry {
+        uintptr_t address{0};
+        uint64_t born{0};
+        Trace trace{};
+    };
+
+    static constexpr uintptr_t EVICTING{1};
+    static constexpr uintptr_t CLAIMED{2};
+
+    bool claim(Entry& entry, uintptr_t address, uint64_t now, bool remote);
+    void evict(Entry& entry, uintptr_t address);
+    void expire(uint64_t now);
+
+    std::array<Entry, CHURN_CACHE> entries{};
+    uint32_t next{0};
+    // Entries from first on are in the order they were deferred, pending of them up to next
+    uint32_t first{0};
+    uint32_t pending{0};
+};
+
+// Returns false if the allocation has to be written to the ring right away
+bool churn_defer(Trace const& trace);
+
+// Returns true if the free was folded with its allocation and is not recorded
+bool churn_free(void* ptr);
@@ -1,4 +1,8 @@
+#include "allocator.h"
 #include "backtrace.h"
+#include "churn.h"
+#include "overhead.h"
+#include "pointer_set.h"
 #include "shared_buffer.h"
 #include <cstdlib>
 #include <cstring>
@@ -10,6 +14,9 @@
 
 SharedBuffer buffer{};
 
+// Pointers that passed the size filters, 2^20 slots
+PointerSet<20> tracked{};
+
 // Define a function pointer for the original functions
 void* (*malloc_real)(size_t) = nullptr;
 void (*free_real)(void*) = nullptr;
@@ -28,142 +35,241 @@ void* (*placement_new_real)(size_t, void*) = nullptr;
 void* (*array_placement_new_real)(size_t, void*) = nullptr;
 struct timespec ts;
 
+// Allocations are held back in churn mode until it is known whether they churn
+inline void write_allocation(Trace const& trace) {
+    if (!CHURN_LIFETIME_NS || !churn_defer(trace)) {
+        buffer.write(trace);
+    }
+}
+
+// Whether a free should be written to the ring
+inline bool record_free(void* ptr) {
+    <<<FREE_FILTER>>>
+    return !CHURN_LIFETIME_NS || !churn_free(ptr);
+}
+
 // The hook function for malloc
 extern "C" void* malloc_hook(uint32_t size) {
     void* const ptr{malloc_real(size)}; // Call the original malloc
+    OverheadCall const overhead{};
+    allocator_poll(buffer.allocator());
 
     <<<ALLOC_FILTER_RANGE>>>
     <<<ALLOC_FILTER>>>
+    <<<TRACK_POINTER>>>
+    uint64_t const timestamp_start{overhead_start()};
     <<<TIMESTAMP>>>
-
+    overhead_stop(PHASE_TIMESTAMP, timestamp_start);
 
     std::array<void*, 20> backtrace_buffer{};
 
+    uint64_t const backtrace_start{overhead_start()};
     <<<USE_BACKTRACE_FAST>>>
     <<<USE_BACKTRACE_GLIBC>>>
+    overhead_stop(PHASE_BACKTRACE, backtrace_start);
 
-    Trace trace{ptr, timestamp, size, backtrace_size, MALLOC, backtrace_buffer};
-    buffer.write(trace);
+    Trace trace{ptr, timestamp, size, backtrace_size, MALLOC, backtrace_buffer, cpu_id};
+    write_allocation(trace);
     return ptr;
 }
 
 extern "C" void free_hook(void* ptr) {
-    std::array<void*, 20> backtrace_buffer {};
-
-    <<<TIMESTAMP>>>
-
-    <<<USE_BACKTRACE_FAST>>>
-    <<<USE_BACKTRACE_GLIBC>>>
-
-    Trace trace{ptr, timestamp, 0, backtrace_size, FREE, backtrace_buffer};
-    buffer.write(trace);
-    return free_real(ptr);
+    // The real free is left out of the hook's overhead
+    {
+        OverheadCall const overhead{};
+        if (record_free(ptr)) {
+            std::array<void*, 20> backtrace_buffer{};
+            uint64_t const backtrace_start{overhead_start()};
+            <<<FREE_BACKTRACE>>>
+            overhead_stop(PHASE_BACKTRACE, backtrace_start);
+            uint64_t const timestamp_start{overhead_start()};
+            <<<TIMESTAMP>>>
+            overhead_stop(PHASE_TIMESTAMP, timestamp_start);
+
+            Trace trace{ptr, timestamp, 0, backtrace_size, FREE, backtrace_buffer, cpu_id};
+            buffer.write(trace);
+        }
+    }
+    free_real(ptr);
+    allocator_poll(buffer.allocator());
 }
 
 void* new_hook(uint32_t size) {
     void* const ptr{new_real(size)};
+    OverheadCall const overhead{};
+    allocator_poll(buffer.allocator());
 
     <<<ALLOC_FILTER_RANGE>>>
     <<<ALLOC_FILTER>>>
+    <<<TRACK_POINTER>>>
+    uint64_t const timestamp_start{overhead_start()};
     <<<TIMESTAMP>>>
+    overhead_stop(PHASE_TIMESTAMP, timestamp_start);
 
     std::array<void*, 20> backtrace_buffer{};
 
+    uint64_t const backtrace_start{overhead_start()};
     <<<USE_BACKTRACE_FAST>>>
     <<<USE_BACKTRACE_GLIBC>>>
+    overhead_stop(PHASE_BACKTRACE, backtrace_start);
 
 
-    Trace trace{ptr, timestamp, size, backtrace_size, NEW, backtrace_buffer};
-    buffer.write(trace);
+    Trace trace{ptr, timestamp, size, backtrace_size, NEW, backtrace_buffer, cpu_id};
+    write_allocation(trace);
     return ptr;
 }
 
 void* array_new_hook(uint32_t size) {
     void* const ptr{array_new_real(size)};
+    OverheadCall const overhead{};
+    allocator_poll(buffer.allocator());
 
     <<<ALLOC_FILTER_RANGE>>>
     <<<ALLOC_FILTER>>>
+    <<<TRACK_POINTER>>>
+    uint64_t const timestamp_start{overhead_start()};
     <<<TIMESTAMP>>>
+    overhead_stop(PHASE_TIMESTAMP, timestamp_start);
 
     std::array<void*, 20> backtrace_buffer{};
 
+    uint64_t const backtrace_start{overhead_start()};
     <<<USE_BACKTRACE_FAST>>>
     <<<USE_BACKTRACE_GLIBC>>>
+    overhead_stop(PHASE_BACKTRACE, backtrace_start);
 
-    Trace trace{ptr, timestamp, size, backtrace_size, NEW_ARRAY, backtrace_buffer};
-    buffer.write(trace);
+    Trace trace{ptr, timestamp, size, backtrace_size, NEW_ARRAY, backtrace_buffer, cpu_id};
+    write_allocation(trace);
     return ptr;
 }
 
 void* non_throw_new_hook(uint32_t size, const std::nothrow_t& nothrow) {
     void* const ptr{non_throw_new_real(size, nothrow)};
+    OverheadCall const overhead{};
+    allocator_poll(buffer.allocator());
 
     <<<ALLOC_FILTER_RANGE>>>
     <<<ALLOC_FILTER>>>
+    <<<TRACK_POINTER>>>
+    uint64_t const timestamp_start{overhead_start()};
     <<<TIMESTAMP>>>
+    overhead_stop(PHASE_TIMESTAMP, timestamp_start);
 
     std::array<void*, 20> backtrace_buffer{};
 
+    uint64_t const backtrace_start{overhead_start()};
     <<<USE_BACKTRACE_FAST>>>
     <<<USE_BACKTRACE_GLIBC>>>
+    overhead_stop(PHASE_BACKTRACE, backtrace_start);
 
-    Trace trace{ptr, timestamp, 0, backtrace_size, NEW_NO_THROW, backtrace_buffer};
-    buffer.write(trace);
+    Trace trace{ptr, timestamp, 0, backtrace_size, NEW_NO_THROW, backtrace_buffer, cpu_id};
+    write_allocation(trace);
     return ptr;
 }
 
 void delete_hook(void* ptr) {
-    std::array<void*, 20> backtrace_buffer{};
-    <<<USE_BACKTRACE_FAST>>>
-    <<<USE_BACKTRACE_GLIBC>>>
-    <<<TIMESTAMP>>>
-
-    Trace trace{ptr, timestamp, 0, backtrace_size, DELETE, backtrace_buffer};
-    buffer.write(trace);
+    // The real free is left out of the hook's overhead
+    {
+        OverheadCall const overhead{};
+        if (record_free(ptr)) {
+            std::array<void*, 20> backtrace_buffer{};
+            uint64_t const backtrace_start{overhead_start()};
+            <<<FREE_BACKTRACE>>>
+            overhead_stop(PHASE_BACKTRACE, backtrace_start);
+            uint64_t const timestamp_start{overhead_start()};
+            <<<TIMESTAMP>>>
+            overhead_stop(PHASE_TIMESTAMP, timestamp_start);
+
+            Trace trace{ptr, timestamp, 0, backtrace_size, DELETE, backtrace_buffer, cpu_id};
+            buffer.write(trace);
+        }
+    }
     delete_real(ptr);
+    allocator_poll(buffer.allocator());
 }
 
 void delete_size_hook(void* ptr, size_t size) {
-    std::array<void*, 20> backtrace_buffer{};
-    <<<USE_BACKTRACE_FAST>>>
-    <<<USE_BACKTRACE_GLIBC>>>
-
-    Trace trace{ptr, 0, 0, backtrace_size, DELETE, backtrace_buffer};
-    buffer.write(trace);
+    // The real free is left out of the hook's overhead
+    {
+        OverheadCall const overhead{};
+        if (record_free(ptr)) {
+            std::array<void*, 20> backtrace_buffer{};
+            uint64_t const backtrace_start{overhead_start()};
+            <<<FREE_BACKTRACE>>>
+            overhead_stop(PHASE_BACKTRACE, backtrace_start);
+            uint64_t const timestamp_start{overhead_start()};
+            <<<TIMESTAMP>>>
+            overhead_stop(PHASE_TIMESTAMP, timestamp_start);
+
+            Trace trace{ptr, timestamp, 0, backtrace_size, DELETE, backtrace_buffer, cpu_id};
+            buffer.write(trace);
+        }
+    }
     delete_size_real(ptr, size);
+    allocator_poll(buffer.allocator());
 }
 
 void array_delete_hook(void* ptr) {
-    std::array<void*, 20> backtrace_buffer{};
-    <<<USE_BACKTRACE_FAST>>>
-    <<<USE_BACKTRACE_GLIBC>>>
-    <<<TIMESTAMP>>>
-
-    Trace trace{ptr, timestamp, 0, backtrace_size, DELETE_ARRAY, backtrace_buffer};
-    buffer.write(trace);
+    // The real free is left out of the hook's overhead
+    {
+        OverheadCall const overhead{};
+        if (record_free(ptr)) {
+            std::array<void*, 20> backtrace_buffer{};
+            uint64_t const backtrace_start{overhead_start()};
+            <<<FREE_BACKTRACE>>>
+            overhead_stop(PHASE_BACKTRACE, backtrace_start);
+            uint64_t const timestamp_start{overhead_start()};
+            <<<TIMESTAMP>>>
+            overhead_stop(PHASE_TIMESTAMP, timestamp_start);
+
+            Trace trace{ptr, timestamp, 0, backtrace_size, DELETE_ARRAY, backtrace_buffer, cpu_id};
+            buffer.write(trace);
+        }
+    }
     delete_array_real(ptr);
-} 
+    allocator_poll(buffer.allocator());
+}
 
 void array_delete_size_hook(void* ptr, size_t size) {
-    std::array<void*, 20> backtrace_buffer{};
-    <<<USE_BACKTRACE_FAST>>>
-    <<<USE_BACKTRACE_GLIBC>>>
-    <<<TIMESTAMP>>>
-
-    Trace trace{ptr, timestamp, 0, backtrace_size, DELETE_ARRAY, backtrace_buffer};
-    buffer.write(trace);
+    // The real free is left out of the hook's overhead
+    {
+        OverheadCall const overhead{};
+        if (record_free(ptr)) {
+            std::array<void*, 20> backtrace_buffer{};
+            uint64_t const backtrace_start{overhead_start()};
+            <<<FREE_BACKTRACE>>>
+            overhead_stop(PHASE_BACKTRACE, backtrace_start);
+            uint64_t const timestamp_start{overhead_start()};
+            <<<TIMESTAMP>>>
+            overhead_stop(PHASE_TIMESTAMP, timestamp_start);
+
+            Trace trace{ptr, timestamp, 0, backtrace_size, DELETE_ARRAY, backtrace_buffer, cpu_id};
+            buffer.write(trace);
+        }
+    }
     delete_array_size_real(ptr, size);
+    allocator_poll(buffer.allocator());
 }
 
 void non_throw_delete_hook(void* ptr, const std::nothrow_t& nothrow) {
-    std::array<void*, 20> backtrace_buffer{};
-    <<<USE_BACKTRACE_FAST>>>
-    <<<USE_BACKTRACE_GLIBC>>>
-    <<<TIMESTAMP>>>
-
-    Trace trace{ptr, timestamp, 0, backtrace_size, DELETE_NO_THROW, backtrace_buffer};
-    buffer.write(trace);
+    // The real free is left out of the hook's overhead
+    {
+        OverheadCall const overhead{};
+        if (record_free(ptr)) {
+            std::array<void*, 20> backtrace_buffer{};
+            uint64_t const backtrace_start{overhead_start()};
+            <<<FREE_BACKTRACE>>>
+            overhead_stop(PHASE_BACKTRACE, backtrace_start);
+            uint64_t const timestamp_start{overhead_start()};
+            <<<TIMESTAMP>>>
+            overhead_stop(PHASE_TIMESTAMP, timestamp_start);
+
+            Trace trace{ptr, timestamp, 0, backtrace_size, DELETE_NO_THROW, backtrace_buffer, cpu_id};
+            buffer.write(trace);
+        }
+    }
     non_throw_delete_real(ptr, nothrow);
+    allocator_poll(buffer.allocator());
 }
 
 void* placement_new_hook(uint32_t size, void* ptr) {
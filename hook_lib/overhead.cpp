@@ -0,0 +1,48 @@
+#include "overhead.h"
+#include "shared_buffer.h"
+#include <ctime>
+
+extern SharedBuffer buffer;
+
+thread_local OverheadThread overhead_thread{};
+
+static uint64_t monotonic_ns() {
+    timespec now{};
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return static_cast<uint64_t>(now.tv_sec) * 1000000000ull + now.tv_nsec;
+}
+
+void overhead_init(OverheadHeader* header) {
+    header->sampling = OVERHEAD_SAMPLING;
+    header->start_tsc = __rdtsc();
+    header->start_ns = monotonic_ns();
+    header->tsc = header->start_tsc;
+    header->ns = header->start_ns;
+}
+
+void OverheadThread::publish(uint64_t now) {
+    published = now;
+    OverheadHeader* const header{buffer.overhead()};
+    if (!header || !calls) {
+        return;
+    }
+
+    if (!registered) {
+        registered = true;
+        __atomic_fetch_add(&header->threads, 1, __ATOMIC_RELAXED);
+    }
+    __atomic_fetch_add(&header->calls, calls, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&header->timed, timed, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&header->cycles, cycles, __ATOMIC_RELAXED);
+    for (uint32_t phase = 0; phase < PHASES; ++phase) {
+        __atomic_fetch_add(&header->phases[phase], phases[phase], __ATOMIC_RELAXED);
+        phases[phase] = 0;
+    }
+    calls = 0;
+    timed = 0;
+    cycles = 0;
+
+    // The profiler converts cycles to time with the TSC rate since the start
+    __atomic_store_n(&header->tsc, now, __ATOMIC_RELAXED);
+    __atomic_store_n(&header->ns, monotonic_ns(), __ATOMIC_RELAXED);
+}
@@ -0,0 +1,140 @@
+#pragma once
+#include <cstdint>
+#include <x86intrin.h>
+
+// One in this many hook calls of every thread is timed, 0 disables the counters
+constexpr uint32_t OVERHEAD_SAMPLING{<<<OVERHEAD_SAMPLING>>>};
+
+// A thread adds its counters to the header at most this often, in TSC cycles
+constexpr uint64_t OVERHEAD_PUBLISH_CYCLES{1ull << 25};
+
+// Timed calls that took longer were descheduled and are left out
+constexpr uint64_t OVERHEAD_OUTLIER_CYCLES{1ull << 20};
+
+enum OverheadPhase : uint32_t {
+    PHASE_BACKTRACE = 0,
+    PHASE_TIMESTAMP = 1,
+    PHASE_WRITE = 2, // Copying the record into the ring
+    PHASE_LOCK = 3,  // Waiting for the ring's mutex with --thread-safe
+    PHASES = 4,
+};
+
+// Follows the ring counters in the header, matches OVERHEAD_DTYPE in overhead.py
+struct OverheadHeader {
+    uint32_t sampling;
+    uint32_t threads;        // Threads that published counters
+    uint64_t calls;          // Hook calls, timed or not
+    uint64_t timed;
+    uint64_t cycles;         // Spent in the timed calls, outside the real allocator
+    uint64_t phases[PHASES]; // Of those, per phase
+    uint64_t start_tsc;      // TSC and CLOCK_MONOTONIC nanoseconds when the ring was
+    uint64_t start_ns;       // created and at the last publish, to convert cycles
+    uint64_t tsc;
+    uint64_t ns;
+};
+
+// Counters of one thread, added to the header now and then so hooks on
+// different threads don't write to the same cache line on every call
+struct OverheadThread {
+    uint64_t calls{0};
+    uint64_t timed{0};
+    uint64_t cycles{0};
+    uint64_t phases[PHASES]{};
+    uint64_t pending[PHASES]{}; // Of the current call, kept unless it is an outlier
+    uint64_t published{0}; // TSC of the last publish
+    uint32_t countdown{1}; // Calls until the next timed one
+    uint32_t random{0x9e3779b9u};
+    bool timing{false};
+    bool registered{false};
+
+    uint64_t begin() {
+        ++calls;
+        if (--countdown) {
+            return 0;
+        }
+        // A fixed period would only ever time mallocs in a loop that alternates
+        // malloc and free, the jittered one still averages OVERHEAD_SAMPLING
+        random ^= random << 13;
+        random ^= random >> 17;
+        random ^= random << 5;
+        countdown = 1 + random % (2 * OVERHEAD_SAMPLING - 1);
+        timing = true;
+        return __rdtsc();
+    }
+
+    void end(uint64_t start) {
+        uint64_t const now{__rdtsc()};
+        timing = false;
+        bool const outlier{now - start > OVERHEAD_OUTLIER_CYCLES};
+        if (!outlier) {
+            cycles += now - start;
+            ++timed;
+        }
+        for (uint32_t phase = 0; phase < PHASES; ++phase) {
+            phases[phase] += outlier ? 0 : pending[phase];
+            pending[phase] = 0;
+        }
+        if (now - published > OVERHEAD_PUBLISH_CYCLES) {
+            publish(now);
+        }
+    }
+
+    void publish(uint64_t now);
+
+    ~OverheadThread() { publish(__rdtsc()); }
+};
+
+extern thread_local OverheadThread overhead_thread;
+
+// Writes the start of the counters, called once the ring is mapped
+void overhead_init(OverheadHeader* header);
+
+// Starts timing a phase if the current hook call is timed
+inline uint64_t overhead_start() {
+    if (!OVERHEAD_SAMPLING || !overhead_thread.timing) {
+        return 0;
+    }
+    return __rdtsc();
+}
+
+inline void overhead_stop(OverheadPhase phase, uint64_t start) {
+    if (OVERHEAD_SAMPLING && start) {
+        overhead_thread.pending[phase] += __rdtsc() - start;
+    }
+}
+
+// Times the rest of a hook call, declared once the real allocator returned
+class OverheadCall {
+  public:
+    OverheadCall() {
+        if (OVERHEAD_SAMPLING) {
+            start = overhead_thread.begin();
+        }
+    }
+
+    ~OverheadCall() {
+        if (OVERHEAD_SAMPLING && start) {
+            overhead_thread.end(start);
+        }
+    }
+
+    OverheadCall(OverheadCall const&) = delete;
+    OverheadCall& operator=(OverheadCall const&) = delete;
+
+  private:
+    uint64_t start{0};
+};
+
+// Times a phase until the end of the scope
+class OverheadTimer {
+  public:
+    explicit OverheadTimer(OverheadPhase phase) : phase{phase}, start{overhead_start()} {}
+    ~OverheadTimer() { overhead_stop(phase, start); }
+
+    OverheadTimer(OverheadTimer const&) = delete;
+    OverheadTimer& operator=(OverheadTimer const&) = delete;
+
+  private:
+    OverheadPhase phase;
+    uint64_t start;
+};
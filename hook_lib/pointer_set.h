@@ -0,0 +1,86 @@
+#pragma once
+#include <atomic>
+#include <cstddef>
+#include <cstdint>
+
+/**
+ * @brief Lock-free set of the pointers whose allocation was recorded.
+ *
+ * Used when the allocation hooks filter on size, so the free hooks only record
+ * frees of pointers the profiler has seen allocated. Open addressing with
+ * linear probing over a fixed table, slots are claimed and released with a
+ * compare-and-swap. A removed pointer leaves a tombstone that later inserts
+ * reuse.
+ *
+ * Probing is bounded. When an insert finds no slot the set is marked as
+ * saturated, from then on every free has to be recorded since the set no
+ * longer knows all tracked pointers.
+ *
+ * @note The table lives in .bss, pages are only touched when pointers are
+ *       tracked.
+ */
+template <std::size_t Bits>
+class PointerSet {
+  public:
+    bool insert(void* ptr) {
+        uintptr_t const key{reinterpret_cast<uintptr_t>(ptr)};
+        if (key <= TOMBSTONE) {
+            return true;
+        }
+
+        std::size_t index{hash(key)};
+        for (std::size_t probe = 0; probe < MAX_PROBE; ++probe) {
+            uintptr_t current{slots[index].load(std::memory_order_relaxed)};
+            while (current == EMPTY || current == TOMBSTONE) {
+                if (slots[index].compare_exchange_weak(current, key,
+                                                       std::memory_order_release,
+                                                       std::memory_order_relaxed)) {
+                    return true;
+                }
+            }
+            index = (index + 1) & MASK;
+        }
+
+        full.store(true, std::memory_order_relaxed);
+        return false;
+    }
+
+    // Returns whether the pointer was in the set
+    bool remove(void* ptr) {
+        uintptr_t const key{reinterpret_cast<uintptr_t>(ptr)};
+        if (key <= TOMBSTONE) {
+            return false;
+        }
+
+        std::size_t index{hash(key)};
+        for (std::size_t probe = 0; probe < MAX_PROBE; ++probe) {
+            uintptr_t current{slots[index].load(std::memory_order_acquire)};
+            if (current == EMPTY) {
+                return false;
+            }
+            // Only the thread freeing the pointer can remove it
+            if (current == key) {
+                slots[index].store(TOMBSTONE, std::memory_order_release);
+                return true;
+            }
+            index = (index + 1) & MASK;
+        }
+        return false;
+    }
+
+    bool saturated() const { return full.load(std::memory_order_relaxed); }
+
+  private:
+    static constexpr uintptr_t EMPTY{0};
+    static constexpr uintptr_t TOMBSTONE{1};
+    static constexpr std::size_t MASK{(std::size_t{1} << Bits) - 1};
+    static constexpr std::size_t MAX_PROBE{64}; // 8 cache lines
+
+    static std::size_t hash(uintptr_t key) {
+        // Allocations are at least 16 byte aligned
+        return ((key >> 4) * 0x9E3779B97F4A7C15ull) >> (64 - Bits);
+    }
+
+    std::atomic<uintptr_t> slots[std::size_t{1} << Bits]{};
+    std::atomic<bool> full{false};
+};
@@ -0,0 +1,8 @@
+#pragma once
+#include <cstdint>
+
+// Layout of the ring header, defined only here. The profiler reads these
+// values from this file (ring_layout.py) and the stress targets include it.
+constexpr uint32_t HEAD_SIZE{256};        // Four cache lines, the records after it stay aligned
+constexpr uint32_t OVERHEAD_OFFSET{64};   // OverheadHeader, after the line of the ring counters
+constexpr uint32_t ALLOCATOR_OFFSET{192}; // AllocatorHeader, a line of its own the profiler writes to
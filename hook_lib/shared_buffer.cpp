@@ -5,61 +5,175 @@
 #include <mutex>
 #include <ostream>
 #include <sys/mman.h> // For shm_open, mmap
+#include <sys/socket.h>
+#include <sys/un.h>
 #include <unistd.h>   // For close
 
 Trace::Trace(void* address, uint64_t time, uint32_t size,
              uint32_t backtrace_size, TraceType type,
-             std::array<void*, 20> const& backtrace_buffer)
+             std::array<void*, 20> const& backtrace_buffer, uint16_t cpu)
     : address{address}, time{time}, size{size}, backtrace_size{backtrace_size},
-      type{type}, backtrace_buffer{backtrace_buffer} {}
+      type{type}, cpu{cpu}, tid{thread_id()}, backtrace_buffer{backtrace_buffer} {}
+
+std::string shm_name() { return "/mem_hook_" + std::to_string(getpid()); }
+
+// Size of the huge pages hugetlbfs and transparent huge pages back the ring with
+static constexpr size_t HUGE_PAGE_SIZE{2 << 20};
+static char const* const HUGETLBFS_MOUNT{"/dev/hugepages"};
+
+static size_t round_up(size_t size, size_t alignment) {
+    return (size + alignment - 1) & ~(alignment - 1);
+}
 
 Buffer::Buffer(const char* mount_point, uint32_t head_size, uint32_t data_size,
-               uint32_t buffer_size)
-    : head_size{head_size}, data_size{data_size}, buffer_size{buffer_size} {
+               uint32_t buffer_size, bool prefault, bool hugepages)
+    : notify_path{std::string{"/dev/shm"} + mount_point + ".sock"},
+      head_size{head_size}, data_size{data_size}, buffer_size{buffer_size} {
+    // Unconnected, so it can be created before the profiler binds its socket.
+    // Creating it here instead of in notify keeps racing hooks from each making one.
+    notify_fd = socket(AF_UNIX, SOCK_DGRAM | SOCK_CLOEXEC | SOCK_NONBLOCK, 0);
+
+    // Huge pages cut the TLB entries the ring needs, every fallback still works
+    bool const mapped{(hugepages && map_hugetlbfs(mount_point, prefault)) ||
+                      map_shm(mount_point, prefault, hugepages)};
+    if (!mapped) {
+        return;
+    }
+
+    head = reinterpret_cast<uint32_t*>(memory);
+    tail = reinterpret_cast<uint32_t*>(head + 1);
+    overflow = reinterpret_cast<uint32_t*>(head + 2);
+    waiting = reinterpret_cast<uint32_t*>(head + 3);
+    entries = reinterpret_cast<uint32_t*>(head + 4);
+    flags = reinterpret_cast<uint32_t*>(head + 5);
+    *head = 0;
+    *tail = 0;
+    *overflow = 0;
+    *waiting = 0;
+    *entries = data_size / sizeof(struct Trace);
+    *flags = backing;
+    if (head_size >= OVERHEAD_OFFSET + sizeof(OverheadHeader)) {
+        overhead = reinterpret_cast<OverheadHeader*>(static_cast<char*>(memory) + OVERHEAD_OFFSET);
+        overhead_init(overhead);
+    }
+    if (head_size >= ALLOCATOR_OFFSET + sizeof(AllocatorHeader)) {
+        allocator = reinterpret_cast<AllocatorHeader*>(static_cast<char*>(memory) + ALLOCATOR_OFFSET);
+        *allocator = AllocatorHeader{};
+    }
+    data_start = reinterpret_cast<char*>(memory) + head_size;
+}
+
+bool Buffer::map_hugetlbfs(const char* mount_point, bool prefault) {
+    // Nothing to fall back from when hugetlbfs is not mounted
+    std::string const path{std::string{HUGETLBFS_MOUNT} + mount_point};
+    int const huge_fd{open(path.c_str(), O_CREAT | O_RDWR | O_CLOEXEC, 0666)};
+    if (huge_fd == -1) {
+        return false;
+    }
 
+    // Files on hugetlbfs are sized in whole huge pages, the pages are reserved
+    // by mmap which fails when the pool is too small
+    size_t const size{round_up(buffer_size, HUGE_PAGE_SIZE)};
+    void* const huge_memory{
+        ftruncate(huge_fd, size) == -1
+            ? MAP_FAILED
+            : mmap(nullptr, size, PROT_READ | PROT_WRITE,
+                   MAP_SHARED | (prefault ? MAP_POPULATE : 0), huge_fd, 0)};
+    if (huge_memory == MAP_FAILED) {
+        close(huge_fd);
+        unlink(path.c_str());
+        return false;
+    }
+
+    fd = huge_fd;
+    memory = huge_memory;
+    mapped_size = size;
+    backing = HUGETLBFS | (prefault ? PREFAULTED : 0);
+    return true;
+}
+
+bool Buffer::map_shm(const char* mount_point, bool prefault, bool hugepages) {
     // Open the existing shared memory object
     fd = shm_open(mount_point, O_CREAT | O_RDWR, 0666);
     if (fd == -1) {
         perror("shm_open");
-        return;
+        return false;
     }
 
+    // Whole huge pages, so transparent huge pages can back all of the ring
+    mapped_size = hugepages ? round_up(buffer_size, HUGE_PAGE_SIZE) : buffer_size;
+
     // Set the shared memory size
-    if (ftruncate(fd, buffer_size) == -1) {
+    if (ftruncate(fd, mapped_size) == -1) {
         perror("ftruncate");
-        return;
+        return false;
     }
 
-    // Map the shared memory into process address space
-    memory =
-        mmap(nullptr, buffer_size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    // MAP_POPULATE faults in every page now instead of in the first malloc
+    // that writes to it. With huge pages the advice has to come first.
+    int const populate{prefault && !hugepages ? MAP_POPULATE : 0};
+    memory = mmap(nullptr, mapped_size, PROT_READ | PROT_WRITE, MAP_SHARED | populate, fd, 0);
     if (memory == MAP_FAILED) {
         perror("mmap");
-        return;
+        return false;
     }
 
-    head = reinterpret_cast<uint32_t*>(memory);
-    tail = reinterpret_cast<uint32_t*>(head + 1);
-    overflow = reinterpret_cast<uint32_t*>(head + 2);
-    *head = 0;
-    *tail = 0;
-    *overflow = 0;
-    data_start = reinterpret_cast<char*>(memory) + head_size;
+    if (hugepages && madvise(memory, mapped_size, MADV_HUGEPAGE) == 0) {
+        backing |= TRANSPARENT_HUGE;
+    }
+    if (prefault) {
+        if (hugepages) {
+            fault_in();
+        }
+        backing |= PREFAULTED;
+    }
+    return true;
+}
+
+void Buffer::fault_in() {
+    if (madvise(memory, mapped_size, MADV_POPULATE_WRITE) == 0) {
+        return;
+    }
+    // Kernels before 5.14, the ring is not in use yet so writing zeros is fine
+    long const page_size{sysconf(_SC_PAGESIZE)};
+    for (size_t offset = 0; offset < mapped_size; offset += page_size) {
+        static_cast<char volatile*>(memory)[offset] = 0;
+    }
 }
 
 Buffer::~Buffer() {
-    // CLeanup
-    munmap(memory, buffer_size);
+    // CLeanup, threads exiting later stop publishing their overhead counters
+    // and hooks called later stop answering allocator requests
+    overhead = nullptr;
+    allocator = nullptr;
+    munmap(memory, mapped_size);
     close(fd);
+    if (notify_fd != -1) {
+        close(notify_fd);
+    }
 }
 
-SharedBuffer::SharedBuffer() : <<<BUFFER>>> {};
+void Buffer::notify() {
+    if (notify_fd == -1) {
+        return;
+    }
 
-SharedBuffer::~SharedBuffer() {
-    // Cleanup
-    buffer.~Buffer();
+    sockaddr_un address{};
+    address.sun_family = AF_UNIX;
+    std::strncpy(address.sun_path, notify_path.c_str(),
+                 sizeof(address.sun_path) - 1);
+
+    // Errors are ignored, the profiler also wakes up on a timer
+    char const byte{1};
+    sendto(notify_fd, &byte, sizeof(byte), MSG_DONTWAIT | MSG_NOSIGNAL,
+           reinterpret_cast<sockaddr*>(&address), sizeof(address));
 }
 
+SharedBuffer::SharedBuffer() : <<<BUFFER>>> {};
+
+// The Buffer member is destroyed, and cleaned up, after this
+SharedBuffer::~SharedBuffer() {}
+
 void SharedBuffer::write(Trace const& trace) {
     if (<<<THREAD_SAFE>>>) {
         write_safe(trace);
@@ -69,20 +183,30 @@ void SharedBuffer::write(Trace const& trace) {
 }
 
 void SharedBuffer::write_safe(Trace const& trace) {
+    uint64_t const start{overhead_start()};
     std::lock_guard<std::mutex> lock{mtx};
+    overhead_stop(PHASE_LOCK, start);
     write_unsafe(trace);
 }
 
 void SharedBuffer::write_unsafe(Trace const& trace) {
+    OverheadTimer const timer{PHASE_WRITE};
     uint32_t const next_tail =
         (*buffer.tail + 1) % (buffer.data_size / sizeof(struct Trace));
 
     if (next_tail == *buffer.head) {
-        *buffer.overflow = 1;
+        // Count the dropped record so the profiler can report it
+        __atomic_fetch_add(buffer.overflow, 1, __ATOMIC_RELAXED);
         return;
     }
 
     std::memcpy(buffer.data_start + (*buffer.tail * sizeof(struct Trace)),
                 &trace, sizeof(struct Trace));
-    (*buffer.tail) = next_tail;
+    __atomic_store_n(buffer.tail, next_tail, __ATOMIC_SEQ_CST);
+
+    // Only the first record after the profiler went to sleep sends a wake-up
+    if (__atomic_load_n(buffer.waiting, __ATOMIC_RELAXED) &&
+        __atomic_exchange_n(buffer.waiting, 0, __ATOMIC_SEQ_CST)) {
+        buffer.notify();
+    }
 }
@@ -1,11 +1,16 @@
 #pragma once
+#include "allocator.h"
+#include "overhead.h"
+#include "ring_layout.h"
 #include <array>
 #include <cstddef>
 #include <cstdint>
 #include <string>
 #include <mutex>
+#include <sys/syscall.h>
+#include <unistd.h>
 
-enum TraceType : uint32_t {
+enum TraceType : uint16_t {
     MALLOC = 0,
     NEW = 1,
     NEW_ARRAY = 2,
@@ -23,32 +28,79 @@ struct Trace {
     uint32_t backtrace_size; // Backtrace size of allocation
 
     TraceType type;
+    uint16_t cpu;            // From __rdtscp, NO_CPU with other timestamps
+    uint32_t tid;            // Thread that made the allocation or free
     std::array<void*, 20> backtrace_buffer; // Actual backtrace
 
+    Trace() = default;
     Trace(void* alloc_address, uint64_t time, uint32_t size,
           uint32_t backtrace_size, TraceType type,
-          std::array<void*, 20> const& backtrace_buffer);
+          std::array<void*, 20> const& backtrace_buffer,
+          uint16_t cpu = NO_CPU);
+
+    static constexpr uint16_t NO_CPU{0xFFFF};
+};
+
+// The thread id and cpu fit in what used to be padding
+static_assert(sizeof(Trace) == 192, "Trace must match TRACE_DTYPE in shared_buffer.py");
+
+// Kernel thread id of the calling thread, only the first call makes a syscall
+inline uint32_t thread_id() {
+    static thread_local uint32_t const tid = syscall(SYS_gettid);
+    return tid;
+}
+
+// Name of the shared memory object of this process, e.g. /mem_hook_1234
+std::string shm_name();
+
+// Bits of Buffer::flags, tells the profiler how the ring is backed
+enum BufferFlags : uint32_t {
+    PREFAULTED = 1,      // Every page was faulted in when the ring was created
+    HUGETLBFS = 2,       // Backed by a file on hugetlbfs
+    TRANSPARENT_HUGE = 4 // Transparent huge pages were requested with madvise
 };
 
 class Buffer {
   public:
+    // The first head_size bytes hold the header, head_size should be a
+    // multiple of the cache line so records never straddle the header
     Buffer(const char* mount_point, uint32_t head_size, uint32_t data_size,
-           uint32_t buffer_size);
+           uint32_t buffer_size, bool prefault = true, bool hugepages = false);
     ~Buffer();
 
+    // Wake up the profiler, called when it asked for it through waiting
+    void notify();
+
     // Shared memory
-    void* memory;
-    int fd;
+    void* memory{nullptr};
+    int fd{-1};
+    size_t mapped_size{0}; // buffer_size, rounded up to whole huge pages with hugepages
 
     // Ring buffer
     uint32_t* head;
     uint32_t* tail;
-    uint32_t* overflow;
+    uint32_t* overflow; // Number of records dropped because the ring was full
+    uint32_t* waiting;  // Set by the profiler before it sleeps on an empty ring
+    uint32_t* entries;  // Number of records the ring holds
+    uint32_t* flags;    // BufferFlags
+    OverheadHeader* overhead{nullptr}; // After the first cache line, if the header has room
+    AllocatorHeader* allocator{nullptr}; // In the fourth cache line, if the header has room
     char* data_start; // char pointer to avoid dividing memory address with 4
 
+    // Datagram socket used to wake up the profiler
+    int notify_fd{-1};
+    std::string notify_path;
+
     uint32_t head_size;
     uint32_t data_size;
     uint32_t buffer_size;
+
+  private:
+    bool map_hugetlbfs(const char* mount_point, bool prefault);
+    bool map_shm(const char* mount_point, bool prefault, bool hugepages);
+    void fault_in();
+
+    uint32_t backing{0}; // BufferFlags of the mapping, published through flags
 };
 
 class SharedBuffer {
@@ -57,6 +109,8 @@ class SharedBuffer {
     ~SharedBuffer();
     std::mutex mtx {};
     void write(Trace const& trace);
+    OverheadHeader* overhead() { return buffer.overhead; }
+    AllocatorHeader* allocator() { return buffer.allocator; }
 
   private:
     Buffer buffer;
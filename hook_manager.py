@@ -3,6 +3,7 @@ import re
 import subprocess
 from dataclasses import dataclass
 
+from elf import GotSlots, read_got_slots
 from gdb_utils import GdbUtils
 
 
@@ -31,35 +32,47 @@ class HookDescriptor:
         self.close()
 
     def close(self):
-        for hook in self.hooks:
-            try:
-                GdbUtils.inject_function(self.pid, hook.plt_addr, hook.func_addr)
-                log(f"Set PLT entry {hex(hook.plt_addr)} to {hex(hook.func_addr)}")
-                log(f"Restored {hook.func_name}")
-            except Exception as e:
-                log(f"Failed to restore {hook.func_name}: {e}", True)
+        # Only the slots that were written, all in one attach
+        hooks = [hook for hook in self.hooks if hook.hook_addr != -1 and hook.func_addr != -1]
+        if not hooks:
+            return
+        cmds = [f"p/x *(void **) {hex(hook.plt_addr)} = {hex(hook.func_addr)}" for hook in hooks]
+        try:
+            outputs = GdbUtils.run_gdb_batch(self.pid, cmds)
+        except Exception as e:
+            log(f"Failed to restore {', '.join(hook.func_name for hook in hooks)}: {e}", True)
+            return
+
+        for hook, output in zip(hooks, outputs):
+            if GdbUtils.parse_address(output) != hook.func_addr:
+                log(f"Failed to restore {hook.func_name}", True)
+                continue
+            log(f"Set PLT entry {hex(hook.plt_addr)} to {hex(hook.func_addr)}")
+            log(f"Restored {hook.func_name}")
 
 
 class HookManager:
     DEFAULT_HOOK_SUFFIX = "_hook"
     LIB_NAME: str = "hook.so"
 
-    hooks: list[FunctionHook] = []
+    hooks: list[FunctionHook]
 
     process_path: str
     lib_path: str
-    obj_dump: str
+    got_slots: GotSlots | None
+    obj_dump: str | None = None  # Only disassembled when the ELF could not be read
     address: int
 
     def __init__(self, pid: int, debug=True) -> None:
         self.pid = pid
         self.debug = debug
+        self.hooks = []
 
         try:
             self.process_path = self._get_process_path(self.pid)
             self.lib_path = self._get_lib_path()
             self.address = self._get_process_address(self.pid)
-            self.obj_dump = self._get_obj_dump(self.process_path)
+            self.got_slots = self._get_got_slots(self.pid)
         except Exception as e:
             self._log(str(e), True)
             exit(1)
@@ -69,25 +82,56 @@ class HookManager:
             hook_name = func_name + self.DEFAULT_HOOK_SUFFIX
 
         try:
-            plt_addr: int = self._get_plt_offset(func_name) + self.address
+            plt_addr: int = self._get_got_address(func_name)
             self.hooks.append(FunctionHook(plt_addr, func_name, hook_name))
             self._log(f"Registered hook {hook_name} on {func_name}")
         except Exception as e:
             self._log(str(e), True)
 
-    def inject(self) -> HookDescriptor:
-        # Inject the dynamic hooking library
-        _ = self._inject_library(self.pid, self.lib_path)
+    def inject(self, lib_path: str | None = None) -> HookDescriptor:
+        """
+        Load the hooking library and point the GOT slots at the hooks. Every
+        lookup and write is one command of a single gdb session, the target is
+        stopped once instead of three times per hook.
+        """
+        lib_path = lib_path or self.lib_path
+        cmds = [f'p $mem_hook = (void *) dlopen("{lib_path}", 1)']
+        for i, hook in enumerate(self.hooks):
+            slot = f"*(void **) {hex(hook.plt_addr)}"
+            saved = f"$mem_hook_slot_{i}"
+            cmds += [
+                f"p {hook.func_name}",
+                f"p/x {saved} = {slot}",
+                # Only written when the old value was saved, so that close can put it back. The
+                # slot also keeps its value when the library was not loaded
+                f"p/x {slot} = $mem_hook && {saved} ? (void *) &{hook.hook_name} : {saved}",
+            ]
+        outputs = GdbUtils.run_gdb_batch(self.pid, cmds)
+
+        handle = GdbUtils.parse_address(outputs[0])
+        if not handle:
+            raise ValueError(f"Could not inject {lib_path}")
+        self._log(f"Injected {lib_path} at {hex(handle)}")
 
         hook_names = []
-        for hook in self.hooks:
-            try:
-                hook.func_addr = self._get_function_address(self.pid, hook.func_name)
-                hook.hook_addr = self._get_function_address(self.pid, hook.hook_name)
-                self._inject_function(self.pid, hook.plt_addr, hook.hook_addr)
-                hook_names.append(hook.func_name)
-            except Exception as e:
-                self._log(str(e), True)
+        for i, hook in enumerate(self.hooks):
+            func_output, slot_output, hook_output = outputs[1 + 3 * i : 4 + 3 * i]
+            # What the slot held is what close restores, the function found by name is the
+            # fallback should the saved value not parse
+            func_addr = GdbUtils.parse_address(slot_output) or GdbUtils.parse_function_address(func_output)
+            hook_addr = GdbUtils.parse_address(hook_output)
+            if hook_addr is None or hook_addr == func_addr:
+                self._log(f"Could not hook {hook.func_name} with {hook.hook_name}", True)
+                continue
+            if func_addr is None:
+                # The write went through but nothing is known to undo it with
+                self._log(f"Could not find memory address of function {hook.func_name}, it stays hooked", True)
+            else:
+                hook.func_addr = func_addr
+                self._log(f"Found {hook.func_name} at {hex(func_addr)}")
+            hook.hook_addr = hook_addr
+            self._log(f"Set PLT entry {hex(hook.plt_addr)} to {hex(hook_addr)}")
+            hook_names.append(hook.func_name)
 
         num = len(hook_names)
         plural = "s" if len(hook_names) > 1 else ""
@@ -105,15 +149,23 @@ class HookManager:
         return os.path.join(path, self.LIB_NAME)
 
     def _get_process_path(self, pid: int) -> str:
-        output = subprocess.run(
-            ["readlink", "-f", f"/proc/{pid}/exe"], capture_output=True, text=True
-        )
-        if not output.stdout:
+        try:
+            path = os.path.realpath(os.readlink(f"/proc/{pid}/exe"))
+        except OSError:
             raise ValueError(f"Could not find the program path for pid {pid}")
-        path = output.stdout.strip()
         self._log(f"Found path for pid {pid}: {path}")
         return path
 
+    def _get_got_slots(self, pid: int) -> GotSlots | None:
+        # Through /proc, the file the process runs even if it was replaced on disk since
+        try:
+            got_slots = read_got_slots(f"/proc/{pid}/exe")
+        except (OSError, ValueError, IndexError) as e:
+            self._log(f"Could not read the relocations of {self.process_path}, disassembling it: {e}", True)
+            return None
+        self._log(f"Found {len(got_slots.slots)} GOT slots in {self.process_path}")
+        return got_slots
+
     def _get_obj_dump(self, path: str) -> str:
         output = subprocess.run(["objdump", "-d", path], capture_output=True, text=True)
         return output.stdout.strip()
@@ -121,7 +173,7 @@ class HookManager:
     def _get_process_address(self, pid: int) -> int:
         """Get the starting address of a process"""
         with open(f"/proc/{pid}/maps", "r") as f:
-            maps = f.read()
+            maps = f.readline()
         maps_match = re.search(r"([a-fA-F\d]+)", maps)
 
         if not maps_match:
@@ -131,8 +183,22 @@ class HookManager:
         self._log(f"Found process {pid} at {hex(addr)}")
         return addr
 
+    def _get_got_address(self, func_name: str) -> int:
+        """Get the address of the function's GOT slot in the process"""
+        if self.got_slots is None:
+            return self._get_plt_offset(func_name) + self.address
+
+        plt_offset = self.got_slots.slots.get(func_name)
+        if plt_offset is None:
+            raise ValueError(f"Could not find {func_name} entry in PLT")
+        self._log(f"Found {func_name} PLT offset at {hex(plt_offset)}")
+        # Executables that are not position independent are loaded at the addresses in the file
+        return plt_offset + (self.address if self.got_slots.relocatable else 0)
+
     def _get_plt_offset(self, func_name: str) -> int:
         """Get the offset of the function entry in PLT"""
+        if self.obj_dump is None:
+            self.obj_dump = self._get_obj_dump(self.process_path)
         # NOTE: We're extracting the comment in objdump here, it might be better to calculate it explicitly
         obj_dump_match = re.search(rf"#\s([a-fA-F\d]+)\s<{func_name}", self.obj_dump)
 
@@ -143,20 +209,6 @@ class HookManager:
         self._log(f"Found {func_name} PLT offset at {hex(plt_offset)}")
         return plt_offset
 
-    def _get_function_address(self, pid: int, func_name: str) -> int:
-        func_addr = GdbUtils.get_function_address(pid, func_name)
-        self._log(f"Found {func_name} at {hex(func_addr)}")
-        return func_addr
-
-    def _inject_library(self, pid: int, path: str):
-        handle = GdbUtils.inject_library(pid, path)
-        self._log(f"Injected {path} at {hex(handle)}")
-        return handle
-
-    def _inject_function(self, pid: int, plt_addr: int, func_addr: int):
-        GdbUtils.inject_function(pid, plt_addr, func_addr)
-        self._log(f"Set PLT entry {hex(plt_addr)} to {hex(func_addr)}")
-
 
 if __name__ == "__main__":
     hm = HookManager(124168)
@@ -0,0 +1,180 @@
+import sys
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from stacks import StackTable
+
+# Lower bound (in seconds) and label of every bin in the age histogram
+AGE_BINS: list[tuple[float, str]] = [
+    (0, "< 10s"),
+    (10, "10s - 1m"),
+    (60, "1m - 10m"),
+    (600, "10m - 1h"),
+    (3600, "1h - 6h"),
+    (6 * 3600, "> 6h"),
+]
+
+
+@dataclass
+class SuspectedLeak:
+    backtraces: tuple[int, ...]
+    count: int
+    size: int
+
+
+@dataclass
+class LeakReport:
+    min_age: float
+    leaks: list[SuspectedLeak] = field(default_factory=list)
+    # Live allocations and bytes per bin of AGE_BINS
+    histogram: list[list[int]] = field(default_factory=lambda: [[0, 0] for _ in AGE_BINS])
+
+    def merge(self, other: "LeakReport", count: int):
+        self.leaks = sorted(self.leaks + other.leaks, key=lambda leak: leak.size, reverse=True)[:count]
+        for mine, theirs in zip(self.histogram, other.histogram):
+            mine[0] += theirs[0]
+            mine[1] += theirs[1]
+
+
+class AgeIndex:
+    """
+    Hierarchical timing wheel over the live allocations. Level 0 buckets are
+    BUCKET_SECONDS wide and every level up is SPAN times wider, the last level
+    keeps everything older. Buckets only hold counters per stack id, so aging
+    merges counters instead of moving allocations, and a free goes straight
+    to the bucket its allocation ended up in.
+    """
+
+    BUCKET_SECONDS: float = 1.0
+    SPAN: int = 60
+    LEVELS: int = 3
+
+    DEFAULT_MIN_AGE: float = 600
+    REPORT_COUNT: int = 10
+
+    def __init__(self, now: float | None = None):
+        # Per level: bucket key -> stack id -> [live allocations, live bytes]
+        self.levels: list[dict[int, dict[int, list[int]]]] = [{} for _ in range(self.LEVELS)]
+        self.now = time.time() if now is None else now
+        self.slot = int(self.now // self.BUCKET_SECONDS)
+
+    def advance(self, now: float):
+        self.now = now
+        slot = int(now // self.BUCKET_SECONDS)
+        if slot != self.slot:
+            self.slot = slot
+            self._cascade()
+
+    def nbytes(self) -> int:
+        """Bytes of the buckets and their counters, as Python objects"""
+        total = sys.getsizeof(self.levels)
+        for buckets in self.levels:
+            total += sys.getsizeof(buckets)
+            for bucket in buckets.values():
+                total += sys.getsizeof(bucket)
+                total += sum(sys.getsizeof(counters) for counters in bucket.values())
+        return total
+
+    def add(self, stack_id: int, size: int, count: int = 1) -> int:
+        """Count allocations made now, returns the slot to pass to remove()"""
+        bucket = self.levels[0].get(self.slot)
+        if bucket is None:
+            bucket = self.levels[0][self.slot] = {}
+
+        counters = bucket.get(stack_id)
+        if counters is None:
+            bucket[stack_id] = [count, size]
+        else:
+            counters[0] += count
+            counters[1] += size
+        return self.slot
+
+    def add_batch(self, stack_ids: np.ndarray, sizes: np.ndarray):
+        """Count allocations made now, one update per stack"""
+        ids, inverse, counts = np.unique(stack_ids, return_inverse=True, return_counts=True)
+        summed = np.zeros(len(ids), dtype=np.int64)
+        np.add.at(summed, inverse, sizes)
+        for stack_id, size, count in zip(ids.tolist(), summed.tolist(), counts.tolist()):
+            self.add(stack_id, size, count)
+
+    def remove_batch(self, slots: np.ndarray, stack_ids: np.ndarray, sizes: np.ndarray):
+        """Uncount freed allocations, one update per slot and stack"""
+        keys = np.stack([slots.astype(np.int64), stack_ids.astype(np.int64)], axis=1)
+        pairs, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+        summed = np.zeros(len(pairs), dtype=np.int64)
+        np.add.at(summed, inverse.reshape(-1), sizes)
+        for (slot, stack_id), size, count in zip(pairs.tolist(), summed.tolist(), counts.tolist()):
+            self.remove(slot, stack_id, size, count)
+
+    def remove(self, slot: int, stack_id: int, size: int, count: int = 1):
+        # The first level that still has the bucket is where the allocation is
+        for level, buckets in enumerate(self.levels):
+            key = slot // self.SPAN**level
+            bucket = buckets.get(key)
+            if bucket is None:
+                continue
+
+            counters = bucket[stack_id]
+            counters[0] -= count
+            counters[1] -= size
+            if counters[0] == 0:
+                del bucket[stack_id]
+                if not bucket:
+                    del buckets[key]
+            return
+
+    def report(self, stacks: StackTable, min_age: float, count: int = REPORT_COUNT) -> LeakReport:
+        """Stacks with the most bytes live for at least min_age seconds and the age histogram"""
+        report = LeakReport(min_age)
+        leaks: dict[int, list[int]] = {}
+
+        for level, buckets in enumerate(self.levels):
+            width = self.BUCKET_SECONDS * self.SPAN**level
+            for key, bucket in buckets.items():
+                # Age of the youngest allocation the bucket can hold
+                age = self.now - (key + 1) * width
+                live = [sum(c[0] for c in bucket.values()), sum(c[1] for c in bucket.values())]
+                histogram_bin = report.histogram[self._age_bin(age)]
+                histogram_bin[0] += live[0]
+                histogram_bin[1] += live[1]
+
+                if age < min_age:
+                    continue
+                for stack_id, (allocations, size) in bucket.items():
+                    totals = leaks.setdefault(stack_id, [0, 0])
+                    totals[0] += allocations
+                    totals[1] += size
+
+        largest = sorted(leaks.items(), key=lambda item: item[1][1], reverse=True)[:count]
+        report.leaks = [
+            SuspectedLeak(stacks.stacks[stack_id], allocations, size)
+            for stack_id, (allocations, size) in largest
+        ]
+        return report
+
+    def _cascade(self):
+        # Buckets that have fallen SPAN buckets behind merge into the next level
+        for level in range(self.LEVELS - 1):
+            current = self.slot // self.SPAN**level
+            buckets = self.levels[level]
+            parents = self.levels[level + 1]
+
+            for key in [key for key in buckets if key <= current - self.SPAN]:
+                parent = parents.setdefault(key // self.SPAN, {})
+                for stack_id, (allocations, size) in buckets.pop(key).items():
+                    counters = parent.get(stack_id)
+                    if counters is None:
+                        parent[stack_id] = [allocations, size]
+                    else:
+                        counters[0] += allocations
+                        counters[1] += size
+
+    @staticmethod
+    def _age_bin(age: float) -> int:
+        index = 0
+        for i, (lower, _) in enumerate(AGE_BINS):
+            if age >= lower:
+                index = i
+        return index
@@ -0,0 +1,382 @@
+"""
+Live view of a running profiler, read by the graph in its own process so
+drawing and window interaction never hold up draining the rings.
+
+The profiler rewrites a small shared memory object in place, all little endian:
+
+    header  VIEW_HEAD_DTYPE
+    times   float64[history], start of every 1s interval
+    data    int64[fields][history], the rollup fields summed over all processes
+    gauges  int64[gauges][history], GAUGES of the resident samples summed over
+            all processes, 0 before the first sample or without sampling
+    sites   VIEW_SITE_DTYPE[sites], the call stacks holding the most live bytes
+
+There is a single writer and no lock (a seqlock). The writer makes the sequence
+odd before changing anything and even again after, a reader copies everything
+and starts over if the sequence was odd or changed meanwhile. Neither side ever
+waits for the other, a graph can be opened, closed or attached to a profiler
+that is already running at any time.
+"""
+
+import argparse
+import glob
+import mmap
+import os
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from resident import ResidentSeries
+from rollup import FIELD, FIELDS, Rollup, combine
+from stacks import StackTable
+
+MAX_BACKTRACES: int = 20
+VIEW_PREFIX: str = "/dev/shm/mem_hook_view_"
+GAUGES: list[str] = ["rss", "heap"]  # heap is what the allocator holds, with --allocator-stats
+GAUGE = {name: index for index, name in enumerate(GAUGES)}
+
+VIEW_HEAD_DTYPE = np.dtype(
+    [
+        ("sequence", "<u8"),
+        ("history", "<u4"),
+        ("sites", "<u4"),
+        ("fields", "<u4"),
+        ("processes", "<u4"),  # Number of profiled processes
+        ("gauges", "<u4"),
+        ("padding", "<u4"),
+        ("time_start", "<f8"),
+        ("updated", "<f8"),  # Time of the last frame
+        ("frames", "<u8"),  # Frames written so far
+    ]
+)
+
+VIEW_SITE_DTYPE = np.dtype(
+    [
+        ("pid", "<u4"),
+        ("backtrace_size", "<u4"),
+        ("live_bytes", "<i8"),
+        ("live_count", "<i8"),
+        ("backtraces", "<u8", (MAX_BACKTRACES,)),
+    ]
+)
+
+
+def view_path(pid: int) -> str:
+    """Path of the view published by the profiler with process id pid"""
+    return f"{VIEW_PREFIX}{pid}"
+
+
+@dataclass
+class ViewFrame:
+    time_start: float
+    updated: float
+    processes: int
+    times: np.ndarray
+    data: np.ndarray
+    gauges: np.ndarray
+    sites: np.ndarray  # VIEW_SITE_DTYPE, by live bytes
+
+
+class LiveView:
+    """Publishes the view of the profiler running in this process"""
+
+    HISTORY: int = 3600  # 1s intervals, an hour
+    SITES: int = 10
+
+    def __init__(self, time_start: float):
+        self.path = view_path(os.getpid())
+        self.time_start = time_start
+        self.frames = 0
+
+        self.fd = os.open(self.path, os.O_CREAT | os.O_TRUNC | os.O_RDWR, 0o644)
+        size = (
+            VIEW_HEAD_DTYPE.itemsize
+            + self.HISTORY * 8 * (1 + len(FIELDS) + len(GAUGES))
+            + self.SITES * VIEW_SITE_DTYPE.itemsize
+        )
+        os.ftruncate(self.fd, size)
+        self.mem = mmap.mmap(self.fd, size)
+        self.header, self.times, self.data, self.gauges, self.sites = view_arrays(self.mem, self.HISTORY, self.SITES)
+
+        self.header["history"] = self.HISTORY
+        self.header["sites"] = self.SITES
+        self.header["fields"] = len(FIELDS)
+        self.header["gauges"] = len(GAUGES)
+        self.header["time_start"] = time_start
+        self.header["updated"] = time.time()
+
+    def close(self):
+        del self.header, self.times, self.data, self.gauges, self.sites
+        self.mem.close()
+        os.close(self.fd)
+        os.unlink(self.path)
+
+    def take(
+        self, rollups: list[Rollup], resident: list[ResidentSeries], stack_tables: dict[int, StackTable]
+    ) -> ViewFrame:
+        """Copy the series and the top call stacks, cheap enough to run between drains"""
+        now = time.time()
+        times, data = combine(rollups, 0, now, self.HISTORY)
+
+        gauges = np.zeros((len(GAUGES), self.HISTORY), dtype=np.int64)
+        for series in resident:
+            _, samples = series.window(now, self.HISTORY)
+            gauges[GAUGE["rss"]] += samples["rss"].astype(np.int64)
+            gauges[GAUGE["heap"]] += (samples["arena"] + samples["mmapped"]).astype(np.int64)
+
+        candidates = []
+        for pid, stacks in stack_tables.items():
+            stack_ids, live_bytes, live_count = stacks.live()
+            top = np.arange(len(live_bytes))
+            if len(top) > self.SITES:
+                top = np.argpartition(live_bytes, -self.SITES)[-self.SITES :]
+            for index in top.tolist():
+                stack = stacks.stacks[stack_ids[index]][:MAX_BACKTRACES]
+                candidates.append((int(live_bytes[index]), int(live_count[index]), pid, stack))
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+        sites = np.zeros(self.SITES, dtype=VIEW_SITE_DTYPE)
+        for site, (live_bytes, live_count, pid, stack) in zip(sites, candidates):
+            site["pid"] = pid
+            site["backtrace_size"] = len(stack)
+            site["live_bytes"] = live_bytes
+            site["live_count"] = live_count
+            site["backtraces"][: len(stack)] = stack
+
+        return ViewFrame(self.time_start, now, len(rollups), times, data, gauges, sites)
+
+    def write(self, frame: ViewFrame):
+        """Publish a frame taken by take, can run off the event loop"""
+        # Stores are made in program order, x86 doesn't reorder them either
+        sequence = int(self.header["sequence"][0])
+        self.header["sequence"] = sequence + 1
+        self.times[:] = frame.times
+        self.data[:] = frame.data
+        self.gauges[:] = frame.gauges
+        self.sites[:] = frame.sites
+        self.frames += 1
+        self.header["processes"] = frame.processes
+        self.header["updated"] = frame.updated
+        self.header["frames"] = self.frames
+        self.header["sequence"] = sequence + 2
+
+
+def view_arrays(mem: mmap.mmap, history: int, sites: int) -> tuple[np.ndarray, ...]:
+    """Header, times, data, gauges and sites of a view, as arrays on mem"""
+    offset = VIEW_HEAD_DTYPE.itemsize
+    header = np.frombuffer(mem, dtype=VIEW_HEAD_DTYPE, count=1)
+    times = np.frombuffer(mem, dtype="<f8", count=history, offset=offset)
+    offset += history * 8
+    data = np.frombuffer(mem, dtype="<i8", count=history * len(FIELDS), offset=offset).reshape(len(FIELDS), history)
+    offset += history * len(FIELDS) * 8
+    gauges = np.frombuffer(mem, dtype="<i8", count=history * len(GAUGES), offset=offset).reshape(len(GAUGES), history)
+    offset += history * len(GAUGES) * 8
+    site_array = np.frombuffer(mem, dtype=VIEW_SITE_DTYPE, count=sites, offset=offset)
+    return header, times, data, gauges, site_array
+
+
+class LiveViewReader:
+    """Reads the view of another process, never blocks the profiler"""
+
+    RETRIES: int = 100
+
+    def __init__(self, path: str):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.mem = mmap.mmap(self.fd, os.fstat(self.fd).st_size, access=mmap.ACCESS_READ)
+
+        header = np.frombuffer(self.mem, dtype=VIEW_HEAD_DTYPE, count=1)
+        if int(header["fields"][0]) != len(FIELDS):
+            raise ValueError(f"view has {int(header['fields'][0])} fields, expected {len(FIELDS)}")
+        if int(header["gauges"][0]) != len(GAUGES):
+            raise ValueError(f"view has {int(header['gauges'][0])} gauges, expected {len(GAUGES)}")
+        self.header, self.times, self.data, self.gauges, self.sites = view_arrays(
+            self.mem, int(header["history"][0]), int(header["sites"][0])
+        )
+
+    def close(self):
+        del self.header, self.times, self.data, self.gauges, self.sites
+        self.mem.close()
+        os.close(self.fd)
+
+    def read(self) -> ViewFrame | None:
+        """A consistent copy of the last frame, None if the writer kept changing it"""
+        for _ in range(self.RETRIES):
+            sequence = int(self.header["sequence"][0])
+            if sequence & 1:
+                time.sleep(0.001)
+                continue
+
+            header = self.header[0].copy()
+            frame = ViewFrame(
+                float(header["time_start"]),
+                float(header["updated"]),
+                int(header["processes"]),
+                self.times.copy(),
+                self.data.copy(),
+                self.gauges.copy(),
+                self.sites.copy(),
+            )
+            if int(self.header["sequence"][0]) == sequence:
+                return frame
+        return None
+
+
+class Graph:
+    WINDOW_WIDTH = 800
+    WINDOW_HEIGHT = 600
+    STALE_SECONDS = 5  # The profiler is gone or stuck when no frame came for this long
+    LABEL_SITES = 3
+
+    def __init__(self, time_window: int):
+        import matplotlib
+        import matplotlib.pyplot as plt
+        import matplotlib.ticker as ticker
+
+        self.time_window = time_window
+        matplotlib.use("TkAgg")  # Use backend that supports scrolling
+        self.last_drawn: bytes | None = None
+
+        self.fig, self.ax = plt.subplots(
+            figsize=(self.WINDOW_WIDTH / 100, self.WINDOW_HEIGHT / 100), dpi=100
+        )
+        self.fig.subplots_adjust(bottom=0.25)
+        (self.line,) = self.ax.plot([], [], label="live")
+        (self.rss_line,) = self.ax.plot([], [], "--", color="tab:orange", label="RSS")
+        self.range = self.ax.fill_between([], [], [], alpha=0.3)
+        self.alloc_scatter = self.ax.scatter(
+            [], [], marker="^", color="g", label="alloc", s=25
+        )
+        self.free_scatter = self.ax.scatter(
+            [], [], marker="v", color="r", label="free", s=25
+        )
+        self.alloc_scatter.set_zorder(999)
+        self.free_scatter.set_zorder(999)
+        self.mem_label = self.fig.text(0.15, 0.90, "", fontsize=12)
+        self.sites_label = self.fig.text(0.02, 0.02, "", fontsize=8, family="monospace")
+
+        self.autoscroll = False
+
+        self.ax.set_navigate(True)  # Enable panning and zooming
+        self.ax.yaxis.set_major_formatter(ticker.FuncFormatter(self._size_format))
+        plt.ion()  # Set interactive mode
+        plt.legend()
+        plt.show(block=False)
+
+    def update(self, frame: ViewFrame):
+        since_start = frame.times + 1 >= frame.time_start
+        x_data = frame.times[since_start] - frame.time_start
+        data = frame.data[:, since_start]
+        rss = frame.gauges[GAUGE["rss"], since_start]
+
+        min_x = 0
+        max_x = 0
+
+        if len(x_data) > 1:
+            min_x = x_data[0]
+            max_x = x_data[-1]
+
+        # Only redraw once a new interval starts or the last one changed
+        stale = time.time() - frame.updated > self.STALE_SECONDS
+        drawn = x_data[-1:].tobytes() + data[:, -1:].tobytes() + rss[-1:].tobytes() + bytes([stale])
+        if drawn != self.last_drawn:
+            live = data[FIELD["live_bytes"]]
+            self.line.set_data(x_data, live)
+            # Seconds before the first resident sample are left out
+            self.rss_line.set_data(x_data, np.where(rss > 0, rss, np.nan))
+            self.range.remove()
+            self.range = self.ax.fill_between(
+                x_data, data[FIELD["live_min"]], data[FIELD["live_max"]], alpha=0.3
+            )
+            self.ax.relim()
+            self.ax.autoscale_view()
+
+            # One marker per second with allocations or frees
+            allocs = data[FIELD["alloc_count"]] > 0
+            frees = data[FIELD["free_count"]] > 0
+            self.alloc_scatter.set_offsets(np.column_stack((x_data[allocs], data[FIELD["live_max"], allocs])))
+            self.free_scatter.set_offsets(np.column_stack((x_data[frees], data[FIELD["live_min"], frees])))
+
+            if self.autoscroll:
+                self.ax.set_xlim(max(min_x, max_x - self.time_window), max_x)
+
+            if len(live):
+                text = f"Memory: {self._get_size(live[-1])}"
+                if rss[-1]:
+                    # Live bytes exceed RSS while pages of allocations are untouched
+                    gap = int(rss[-1] - live[-1])
+                    text += f", RSS: {self._get_size(rss[-1])} (gap {'-' if gap < 0 else ''}{self._get_size(abs(gap))})"
+                self.mem_label.set_text(text + (" (not updating)" if stale else ""))
+            self.sites_label.set_text(self._sites_text(frame))
+
+            self.fig.canvas.draw()  # Redraw figure
+            self.last_drawn = drawn
+
+        self.autoscroll = max_x <= self.ax.get_xlim()[1]
+        self.fig.canvas.flush_events()  # Process GUI events
+
+    def _sites_text(self, frame: ViewFrame) -> str:
+        lines = ["Top call stacks by live bytes:"]
+        for site in frame.sites[frame.sites["live_count"] > 0][: self.LABEL_SITES]:
+            frames = " -> ".join(hex(b) for b in site["backtraces"][: site["backtrace_size"]][:4])
+            pid = f"pid {int(site['pid'])}  " if frame.processes > 1 else ""
+            lines.append(f"{self._get_size(int(site['live_bytes'])):>10}  {pid}{frames}")
+        return "\n".join(lines)
+
+    def _size_format(self, x, pos):
+        return self._get_size(x)
+
+    def _get_size(self, num):
+        for unit in ["B", "KB", "MB", "GB", "TB"]:
+            if num < 1024.0:
+                return f"{num:.1f} {unit}"
+            num /= 1024.0
+        return f"{num:.1f} PB"
+
+
+def find_view(pid: int | None) -> str | None:
+    """The view of profiler pid, or of the most recently started profiler"""
+    if pid is not None:
+        return view_path(pid) if os.path.exists(view_path(pid)) else None
+    views = glob.glob(f"{VIEW_PREFIX}*")
+    return max(views, key=os.path.getctime) if views else None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Show a live graph of the heap of a running profiler.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("pid", type=int, nargs="?", default=None, help="Process id of the profiler, defaults to the most recently started one.")
+    parser.add_argument("-tw", "--time-window", type=int, default=32, help="Window of time (in seconds) displayed.")
+    parser.add_argument("-fi", "--frame-interval", type=float, default=0.1, help="Seconds between redraws.")
+    args = parser.parse_args()
+
+    path = find_view(args.pid)
+    if path is None:
+        print("No running profiler found")
+        exit(1)
+
+    try:
+        reader = LiveViewReader(path)
+    except (OSError, ValueError) as e:
+        print(f"Could not open the view: {e}")
+        exit(1)
+
+    import matplotlib.pyplot as plt
+
+    graph = Graph(args.time_window)
+    try:
+        while plt.fignum_exists(graph.fig.number):
+            frame = reader.read()
+            if frame is not None:
+                graph.update(frame)
+            plt.pause(args.frame_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,23 @@
 import os
+import subprocess
+import sys
+import time
+from contextlib import ExitStack, closing
+
 import cli
 import shared_buffer
+from capture import CaptureWriter
+from churn import ChurnTable
 from code_injector import CodeEntry, CodeEntryFactory, CodeInjector
+from event_loop import Scheduler
+from export import PprofWriter, write_folded
 from hook_manager import HookManager
+from live_view import LiveView
+from metrics import Metrics, MetricsExporter
+from overhead import OverheadCounters
+from resident import ResidentSampler
+from snapshot import SnapshotWriter
+from startup import StartupGraph
 
 
 FUNCTION_HOOKS = {
@@ -18,6 +33,9 @@ FUNCTION_HOOKS = {
     "_ZnaPv": "array_placement_new_hook",
 }
 
+VIEW_INTERVAL = 0.25  # Seconds between frames of the live view read by the graph
+CAPTURE_INTERVAL = 1  # Seconds between writes to the capture file
+
 
 def compile_and_inject():
     code_entries: list[CodeEntry] = []
@@ -29,11 +47,21 @@ def compile_and_inject():
         code_entries.append(CodeEntryFactory.malloc_filter(cli.filter_size))
 
     if cli.backtrace_method == "fast":
-        code_entries.append(CodeEntryFactory.backtrace_fast(cli.max_backtraces))
-    elif cli.backtrace_method == "glibc":
-        code_entries.append(CodeEntryFactory.backtrace_glibc(cli.max_backtraces))
-
-    code_entries.append(CodeEntryFactory.buffer_sizes(cli.buffer_sizes))
+        backtrace = CodeEntryFactory.backtrace_fast(cli.max_backtraces)
+    else:
+        backtrace = CodeEntryFactory.backtrace_glibc(cli.max_backtraces)
+    code_entries.append(backtrace)
+
+    # With filters most frees are of pointers that were never recorded, the hook
+    # drops those and records the others without a backtrace
+    if cli.filter_size_range or cli.filter_size:
+        code_entries.append(CodeEntryFactory.track_pointer())
+        code_entries.append(CodeEntryFactory.free_filter())
+        code_entries.append(CodeEntryFactory.free_backtrace_none())
+    else:
+        code_entries.append(CodeEntryFactory.free_backtrace(backtrace))
+
+    code_entries.append(CodeEntryFactory.buffer_sizes(cli.buffer_sizes, cli.prefault, cli.hugepages))
     
     if cli.timestamp_method == "None":
         code_entries.append(CodeEntryFactory.timestamp_none())
@@ -43,21 +71,14 @@ def compile_and_inject():
         code_entries.append(CodeEntryFactory.timestamp_chrono())
 
     code_entries.append(CodeEntryFactory.thread_safe(cli.thread_safe))
+    code_entries.append(CodeEntryFactory.churn_lifetime(cli.churn_lifetime))
+    code_entries.append(CodeEntryFactory.overhead_sampling(cli.overhead_sampling))
+    code_entries.append(CodeEntryFactory.allocator_stats(cli.allocator_stats))
 
-    CodeInjector.inject(code_entries)
-
-
-if __name__ == "__main__":
-    if not os.getuid() == 0:
-        print("The program must be run as root")
-        exit(1)
+    return CodeInjector.inject(code_entries)
 
-    compile_and_inject()
 
-    memtracker = shared_buffer.Memtracker(cli.log_file)
-    hook_manager = HookManager(cli.pid)
-
-    # Register hooks
+def register_hooks(hook_manager: HookManager):
     for func in cli.hook_functions:
         hook_func = FUNCTION_HOOKS.get(func)
         if hook_func is None:
@@ -68,18 +89,160 @@ if __name__ == "__main__":
     # hook_manager.register_hook("_ZnwmPv", "placement_new_hook")
     # hook_manager.register_hook("_ZnaPv", "array_placement_new_hook")
 
-    if cli.graph:
-        memtracker.display_graph(cli.time_window)
 
-    if not cli.log_file:
-        memtracker.print_statistics(cli.print_frequency)
+def analyze(pid: int) -> HookManager:
+    """Find the GOT slots to hook in the executable of process pid"""
+    # A ring left by an earlier process with this pid would be read instead of the new one
+    shared_buffer.SharedBuffer.remove_stale(pid)
+    hook_manager = HookManager(pid)
+    register_hooks(hook_manager)
+    return hook_manager
+
+
+def startup_graph() -> StartupGraph:
+    # The build and reading the executables need nothing of each other. gdb
+    # attaches once both are done, the target is stopped while it is attached.
+    startup = StartupGraph()
+    startup.add("build", compile_and_inject)
+    for pid in cli.pids:
+        startup.add(f"analyze {pid}", lambda pid=pid: analyze(pid))
+    for pid in cli.pids:
+        startup.add(
+            f"attach {pid}",
+            lambda pid=pid: startup.result(f"analyze {pid}").inject(startup.result("build")),
+            ["build", f"analyze {pid}"],
+        )
+    return startup
+
 
-    with hook_manager.inject() as hd, shared_buffer.SharedBuffer(cli.timestamp_method) as shared_buffer:
-        try:
-            print("\nPress CTRL+C to detach...\n")
-            while True:
-                shared_buffer.read(memtracker)
-        except KeyboardInterrupt:
-            memtracker.write_log_file()
-            memtracker.print_statistics_stop()
+if __name__ == "__main__":
+    if not os.getuid() == 0:
+        print("The program must be run as root")
+        exit(1)
 
+    time_start = time.perf_counter()
+    startup = startup_graph()
+    attached = startup.run()
+    hook_managers: list[HookManager] = [startup.result(f"analyze {pid}") for pid in cli.pids]
+
+    memtrackers = shared_buffer.MemtrackerGroup(cli.pids, cli.log_file, cli.leak_age)
+
+    metrics_exporter = None
+    if cli.metrics_file:
+        metrics_exporter = MetricsExporter(cli.metrics_file)
+
+    capture_writer = None
+    if cli.capture_file:
+        capture_writer = CaptureWriter(cli.capture_file, cli.capture_codec, cli.timestamp_method == "chrono")
+        for memtracker in memtrackers.memtrackers.values():
+            memtracker.capture = capture_writer
+
+    snapshot_writer = None
+    if cli.snapshot_file:
+        snapshot_writer = SnapshotWriter(cli.snapshot_file)
+
+    with ExitStack() as stack:
+        # Hooks that were set are restored even when attaching to another process failed
+        for pid in cli.pids:
+            hook_descriptor = startup.result(f"attach {pid}")
+            if hook_descriptor is not None:
+                stack.enter_context(hook_descriptor)
+        startup.print_timings()
+        if not attached:
+            exit(1)
+
+        # Every process writes to its own ring, a single loop drains all of them
+        readers: list[tuple[shared_buffer.SharedBuffer, shared_buffer.Memtracker]] = []
+        for hook_manager in hook_managers:
+            metrics = Metrics() if metrics_exporter else None
+            reader = stack.enter_context(
+                shared_buffer.SharedBuffer(hook_manager.pid, cli.timestamp_method, metrics)
+            )
+            huge = shared_buffer.BufferFlags.HUGETLBFS | shared_buffer.BufferFlags.TRANSPARENT_HUGE
+            if cli.hugepages and not reader.flags & huge:
+                print(f"No huge pages for the ring of process {hook_manager.pid}, it uses normal pages")
+            memtracker = memtrackers.memtrackers[hook_manager.pid]
+            readers.append((reader, memtracker))
+
+            if cli.churn_lifetime:
+                memtracker.churn = stack.enter_context(ChurnTable(hook_manager.pid))
+
+            if cli.overhead_sampling:
+                memtracker.overhead = OverheadCounters(reader.mem, hook_manager.pid)
+
+            if cli.resident_interval:
+                memtracker.resident = stack.enter_context(
+                    ResidentSampler(hook_manager.pid, reader.mem if cli.allocator_stats else None)
+                )
+
+            if metrics_exporter:
+                metrics_exporter.add(hook_manager.pid, metrics, memtracker)
+
+        fallback_interval = cli.read_frequency or Scheduler.FALLBACK_INTERVAL
+        scheduler = Scheduler(
+            readers,
+            fallback_interval=fallback_interval,
+            on_first_event=lambda first: print(f"First event {(first - time_start) * 1000:.0f} ms after start"),
+        )
+
+        # The graph runs in its own process and can also be started later with live_view.py
+        live_view = stack.enter_context(closing(LiveView(memtrackers.time_start)))
+        scheduler.add_job(
+            "view",
+            VIEW_INTERVAL,
+            lambda: live_view.take(memtrackers.rollups(), memtrackers.resident_series(), memtrackers.stack_tables()),
+            live_view.write,
+        )
+        if cli.graph:
+            viewer = os.path.join(os.path.dirname(os.path.abspath(__file__)), "live_view.py")
+            subprocess.Popen([sys.executable, viewer, str(os.getpid()), "-tw", str(cli.time_window)])
+
+        if cli.resident_interval:
+            # A few preads per process, on the loop so samples line up with the drained events
+            scheduler.add_job("resident", cli.resident_interval, memtrackers.sample_resident)
+
+        if not cli.log_file:
+            scheduler.add_job(
+                "report",
+                cli.print_frequency,
+                memtrackers.snapshot,
+                shared_buffer.MemtrackerGroup.print_statistics,
+            )
+
+        if metrics_exporter:
+            metrics_exporter.scheduler_metrics = scheduler.metrics
+            scheduler.add_job("metrics", cli.metrics_interval, metrics_exporter.format, metrics_exporter.write)
+
+        if capture_writer:
+            # Events are queued while draining, compressed and written off the loop
+            scheduler.add_job("capture", CAPTURE_INTERVAL, capture_writer.take, capture_writer.write)
+
+        if snapshot_writer:
+            # Counters are copied between drains, encoding and writing happens off the loop
+            scheduler.add_job(
+                "snapshot",
+                cli.snapshot_interval,
+                lambda: snapshot_writer.take(memtrackers.stack_tables()),
+                snapshot_writer.write,
+            )
+
+        print("\nPress CTRL+C to detach...\n")
+        scheduler.run()
+
+        memtrackers.write_log_file()
+        if capture_writer:
+            capture_writer.close(
+                {pid: memtracker.rollup for pid, memtracker in memtrackers.memtrackers.items()}
+            )
+            print(f"Capture has been written to '{cli.capture_file}'")
+        if snapshot_writer:
+            snapshot_writer.write(snapshot_writer.take(memtrackers.stack_tables()))
+
+        if cli.pprof_file:
+            PprofWriter(cli.pprof_file).write(memtrackers.stack_tables(), time.time() - memtrackers.time_start)
+            print(f"pprof profile has been written to '{cli.pprof_file}'")
+        if cli.folded_file:
+            write_folded(cli.folded_file, memtrackers.stack_tables(), cli.folded_type)
+            print(f"Folded stacks have been written to '{cli.folded_file}'")
+        if metrics_exporter:
+            metrics_exporter.write()
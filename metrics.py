@@ -0,0 +1,172 @@
+import os
+import resource
+import time
+
+PAGE_SIZE = resource.getpagesize()
+
+
+class Metrics:
+    """
+    Counters describing the health of the profiler itself. They are updated
+    once per drain of the ring, never per record, so keeping them is cheap.
+    """
+
+    def __init__(self):
+        self.ring_entries = 0
+        self.ring_fill = 0  # Records waiting in the ring when the last drain started
+        self.drain_batch = 0  # Records decoded by the last drain
+        self.drains = 0
+        self.events = 0
+        self.dropped_events = 0
+        self.reader_lag: float | None = None  # Seconds from the oldest record's timestamp to its ingest
+        self.drain_seconds = 0.0
+
+    def record_drain(
+        self,
+        fill: int,
+        batch: int,
+        entries: int,
+        dropped: int,
+        lag: float | None,
+        drain_seconds: float,
+    ):
+        self.ring_fill = fill
+        self.ring_entries = entries
+        self.drain_batch = batch
+        self.drains += 1
+        self.events += batch
+        self.dropped_events = dropped
+        if lag is not None:
+            self.reader_lag = lag
+        self.drain_seconds += drain_seconds
+
+
+class SchedulerMetrics:
+    """Counters of the event loop shared by all profiled processes"""
+
+    def __init__(self):
+        self.notify_wakeups = 0  # Drains started by a wake-up from the hooks
+        self.timeout_wakeups = 0  # Drains started by the fallback timer
+        self.budget_overruns = 0  # Drains cut short by their time budget
+        self.job_seconds: dict[str, float] = {}  # Time each periodic job spent on the event loop
+        self.first_event: float | None = None  # time.perf_counter() of the first record of any process
+
+
+class MetricsExporter:
+    """
+    Writes the metrics in the Prometheus text format, labelled with the pid of
+    each profiled process. The file is written next to the
+    target and renamed over it, so readers never see a partially written file.
+    """
+
+    PREFIX = "memhook"
+
+    DESCRIPTIONS: dict[str, tuple[str, str]] = {
+        "ring_entries": ("gauge", "Number of records the ring can hold."),
+        "ring_fill": ("gauge", "Records waiting in the ring at the start of the last drain."),
+        "ring_fill_ratio": ("gauge", "Fraction of the ring in use at the start of the last drain."),
+        "drain_batch_size": ("gauge", "Records decoded by the last drain."),
+        "drains_total": ("counter", "Number of times the ring was drained."),
+        "events_total": ("counter", "Records decoded from the ring."),
+        "events_per_second": ("gauge", "Records decoded per second since the last export."),
+        "dropped_events_total": ("counter", "Records dropped by the hooks because the ring was full."),
+        "drain_seconds_total": ("counter", "Time spent decoding and tracking records."),
+        "reader_lag_seconds": ("gauge", "Time from the oldest record's timestamp to its ingest."),
+        "live_allocations": ("gauge", "Allocations currently tracked by the profiler."),
+        "stored_traces": ("gauge", "Records kept for the log file."),
+        "tracked_sites": ("gauge", "Distinct call stacks of allocations and frees."),
+        "pointer_table_bytes": ("gauge", "Memory of the table of live allocations."),
+        "stack_table_bytes": ("gauge", "Memory of the counters per call stack."),
+        "age_index_bytes": ("gauge", "Memory of the live allocations by age."),
+        "rollup_bytes": ("gauge", "Memory of the heap activity per second and per minute."),
+        "reader_rss_bytes": ("gauge", "Resident memory of the profiler process."),
+        "target_rss_bytes": ("gauge", "Resident memory of the target at the last resident sample."),
+        "target_heap_gap_bytes": ("gauge", "Target RSS not explained by the live bytes it requested since attaching."),
+        "notify_wakeups_total": ("counter", "Drains started by a wake-up from the hooks."),
+        "timeout_wakeups_total": ("counter", "Drains started by the fallback timer."),
+        "budget_overruns_total": ("counter", "Drains cut short by their time budget."),
+        "job_seconds_total": ("counter", "Time periodic jobs (graph frames, reports) spent on the event loop."),
+    }
+
+    def __init__(self, path: str, scheduler_metrics: SchedulerMetrics | None = None):
+        self.path = path
+        self.scheduler_metrics = scheduler_metrics
+        self.targets: dict[int, tuple[Metrics, object]] = {}
+        self.last_events: dict[int, int] = {}
+        self.last_time = time.monotonic()
+
+    def add(self, pid: int, metrics: Metrics, memtracker):
+        self.targets[pid] = (metrics, memtracker)
+
+    def write(self, content: str | None = None):
+        if content is None:
+            content = self.format()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, self.path)
+
+    def format(self) -> str:
+        now = time.monotonic()
+        elapsed = now - self.last_time
+        self.last_time = now
+
+        # Samples per metric name, each a list of (label, value)
+        samples: dict[str, list[tuple[str, float]]] = {name: [] for name in self.DESCRIPTIONS}
+        samples["reader_rss_bytes"].append(("", self._get_rss()))
+
+        if self.scheduler_metrics is not None:
+            scheduler = self.scheduler_metrics
+            samples["notify_wakeups_total"].append(("", scheduler.notify_wakeups))
+            samples["timeout_wakeups_total"].append(("", scheduler.timeout_wakeups))
+            samples["budget_overruns_total"].append(("", scheduler.budget_overruns))
+            for job, seconds in list(scheduler.job_seconds.items()):
+                samples["job_seconds_total"].append((f'{{job="{job}"}}', seconds))
+
+        for pid, (metrics, memtracker) in list(self.targets.items()):
+            label = f'{{pid="{pid}"}}'
+            events = metrics.events - self.last_events.get(pid, 0)
+            self.last_events[pid] = metrics.events
+            fill_ratio = metrics.ring_fill / metrics.ring_entries if metrics.ring_entries else 0.0
+
+            values = {
+                "ring_entries": metrics.ring_entries,
+                "ring_fill": metrics.ring_fill,
+                "ring_fill_ratio": fill_ratio,
+                "drain_batch_size": metrics.drain_batch,
+                "drains_total": metrics.drains,
+                "events_total": metrics.events,
+                "events_per_second": events / elapsed if elapsed > 0 else 0.0,
+                "dropped_events_total": metrics.dropped_events,
+                "drain_seconds_total": metrics.drain_seconds,
+                "live_allocations": len(memtracker.allocations),
+                "stored_traces": len(memtracker.all_allocations) + len(memtracker.all_frees),
+                "tracked_sites": len(memtracker.stacks),
+                "pointer_table_bytes": memtracker.allocations.nbytes(),
+                "stack_table_bytes": memtracker.stacks.nbytes(),
+                "age_index_bytes": memtracker.ages.nbytes(),
+                "rollup_bytes": memtracker.rollup.nbytes(),
+            }
+            if metrics.reader_lag is not None:
+                values["reader_lag_seconds"] = metrics.reader_lag
+            sample = memtracker.resident_series.last
+            if sample is not None:
+                values["target_rss_bytes"] = int(sample["rss"])
+                values["target_heap_gap_bytes"] = int(sample["rss"]) - int(sample["live"])
+
+            for name, value in values.items():
+                samples[name].append((label, value))
+
+        lines = []
+        for name, (type, description) in self.DESCRIPTIONS.items():
+            if not samples[name]:
+                continue
+            lines.append(f"# HELP {self.PREFIX}_{name} {description}")
+            lines.append(f"# TYPE {self.PREFIX}_{name} {type}")
+            for label, value in samples[name]:
+                lines.append(f"{self.PREFIX}_{name}{label} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _get_rss(self) -> int:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
@@ -0,0 +1,341 @@
+"""
+Call stacks normalized against address space layout randomization. Every frame
+becomes a module, identified by its GNU build id or by its path when it has
+none, and an offset into the file of that module, found through
+/proc/<pid>/maps. A call site then has the same normalized stack in every run
+and in every process of the same binary.
+
+Captures and snapshots store them in three blocks, all little endian:
+
+    MODL  first module (uint32), count (uint32), then per module the lengths
+          of its build id and path (uint16 each) followed by both strings
+    NSTK  first normalized stack id (uint32), count (uint32), depth per stack
+          (uint32[count]), modules (int32[sum of depths]), offsets
+          (uint64[sum of depths])
+    SMAP  pid (uint64), first stack id (uint32), count (uint32), normalized
+          stack id of every stack of the pid (uint32[count])
+
+Frames outside any file mapping have module -1 and keep their address as offset.
+"""
+
+import hashlib
+import os
+import struct
+from dataclasses import dataclass
+
+import numpy as np
+
+MODULES_HEADER = struct.Struct("<II")
+MODULE_HEADER = struct.Struct("<HH")
+NORMALIZED_HEADER = struct.Struct("<II")
+STACK_MAP_HEADER = struct.Struct("<QII")
+
+ELF_HEADER = struct.Struct("<4sB27xQ14xHH")  # Magic, class, e_phoff, e_phentsize, e_phnum
+PROGRAM_HEADER = struct.Struct("<II QQQQ")  # p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz
+NOTE_HEADER = struct.Struct("<III")
+PT_NOTE = 4
+NT_GNU_BUILD_ID = 3
+
+UNKNOWN_MODULE: int = -1
+
+
+@dataclass
+class Module:
+    build_id: str  # Hex, empty if the file has none
+    path: str
+
+    @property
+    def key(self) -> str:
+        """What identifies the module across runs"""
+        return self.build_id or self.path
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path)
+
+
+def read_build_id(path: str) -> str:
+    """GNU build id of a 64 bit little endian ELF file, empty if it has none"""
+    try:
+        with open(path, "rb") as f:
+            magic, elf_class, phoff, phentsize, phnum = ELF_HEADER.unpack(f.read(ELF_HEADER.size))
+            if magic != b"\x7fELF" or elf_class != 2:
+                return ""
+
+            f.seek(phoff)
+            headers = f.read(phentsize * phnum)
+            for index in range(phnum):
+                p_type, _, p_offset, _, _, p_filesz = PROGRAM_HEADER.unpack_from(headers, index * phentsize)
+                if p_type != PT_NOTE:
+                    continue
+
+                f.seek(p_offset)
+                notes = f.read(p_filesz)
+                offset = 0
+                while offset + NOTE_HEADER.size <= len(notes):
+                    namesz, descsz, note_type = NOTE_HEADER.unpack_from(notes, offset)
+                    name_start = offset + NOTE_HEADER.size
+                    desc_start = name_start + (namesz + 3) // 4 * 4
+                    if note_type == NT_GNU_BUILD_ID and notes[name_start : name_start + namesz] == b"GNU\0":
+                        return notes[desc_start : desc_start + descsz].hex()
+                    offset = desc_start + (descsz + 3) // 4 * 4
+    except (OSError, struct.error):
+        pass
+    return ""
+
+
+@dataclass
+class ProcessMaps:
+    """File mappings of a process sorted by start address, with the module of each"""
+
+    starts: np.ndarray
+    ends: np.ndarray
+    file_offsets: np.ndarray
+    modules: np.ndarray
+
+    def lookup(self, addresses: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Module and offset of every address, and which addresses were found"""
+        if not len(self.starts):
+            return np.full(len(addresses), UNKNOWN_MODULE, dtype=np.int32), addresses, np.zeros(len(addresses), dtype=bool)
+        index = np.searchsorted(self.starts, addresses, side="right") - 1
+        found = (index >= 0) & (addresses < self.ends[np.maximum(index, 0)])
+        index = np.maximum(index, 0)
+        modules = np.where(found, self.modules[index], UNKNOWN_MODULE).astype(np.int32)
+        offsets = np.where(found, addresses - self.starts[index] + self.file_offsets[index], addresses)
+        return modules, offsets.astype(np.uint64), found
+
+
+class Normalizer:
+    """
+    Normalizes the stacks of StackTables as they are written to a file and
+    hands out the blocks describing them. Every file has its own Normalizer,
+    modules and normalized stacks are written the first time a stack refers to
+    them.
+    """
+
+    def __init__(self):
+        self.modules: list[Module] = []
+        self.module_index: dict[str, int] = {}
+        self.build_ids: dict[str, str] = {}  # Per path
+        self.maps: dict[int, ProcessMaps] = {}
+
+        self.stack_index: dict[tuple[tuple[int, ...], tuple[int, ...]], int] = {}
+        self.stacks: list[tuple[tuple[int, ...], tuple[int, ...]]] = []
+
+        self.written_modules = 0
+        self.written_stacks = 0
+
+    def _module(self, pid: int, path: str) -> int:
+        build_id = self.build_ids.get(path)
+        if build_id is None:
+            # Through the root of the process, it may run in another mount namespace
+            build_id = read_build_id(f"/proc/{pid}/root{path}") or read_build_id(path)
+            self.build_ids[path] = build_id
+
+        module = Module(build_id, path)
+        index = self.module_index.get(module.key)
+        if index is None:
+            index = len(self.modules)
+            self.module_index[module.key] = index
+            self.modules.append(module)
+        return index
+
+    def _load_maps(self, pid: int) -> ProcessMaps:
+        rows = []
+        try:
+            with open(f"/proc/{pid}/maps", "r") as f:
+                for line in f:
+                    # start-end perms offset dev inode path
+                    fields = line.split(maxsplit=5)
+                    if len(fields) < 6 or not fields[5].startswith("/"):
+                        continue
+                    start, end = (int(value, 16) for value in fields[0].split("-"))
+                    path = fields[5].strip().removesuffix(" (deleted)")
+                    rows.append((start, end, int(fields[2], 16), self._module(pid, path)))
+        except OSError:
+            pass  # The process is gone, frames stay unknown
+
+        rows.sort()
+        columns = list(zip(*rows)) or [(), (), (), ()]
+        return ProcessMaps(
+            np.array(columns[0], dtype=np.uint64),
+            np.array(columns[1], dtype=np.uint64),
+            np.array(columns[2], dtype=np.uint64),
+            np.array(columns[3], dtype=np.int32),
+        )
+
+    def normalize(self, pid: int, stacks: list[tuple[int, ...]]) -> np.ndarray:
+        """Normalized stack id of every stack"""
+        depths = np.fromiter((len(stack) for stack in stacks), dtype=np.int64, count=len(stacks))
+        frames = np.fromiter((frame for stack in stacks for frame in stack), dtype=np.uint64, count=int(depths.sum()))
+
+        maps = self.maps.get(pid)
+        if maps is None:
+            maps = self.maps[pid] = self._load_maps(pid)
+        modules, offsets, found = maps.lookup(frames)
+        if not found.all():
+            # Libraries loaded since the maps were read
+            maps = self.maps[pid] = self._load_maps(pid)
+            modules, offsets, found = maps.lookup(frames)
+
+        ids = np.empty(len(stacks), dtype=np.uint32)
+        bounds = [0] + np.cumsum(depths).tolist()
+        modules, offsets = modules.tolist(), offsets.tolist()
+        for i in range(len(stacks)):
+            key = (tuple(modules[bounds[i] : bounds[i + 1]]), tuple(offsets[bounds[i] : bounds[i + 1]]))
+            stack_id = self.stack_index.get(key)
+            if stack_id is None:
+                stack_id = len(self.stacks)
+                self.stack_index[key] = stack_id
+                self.stacks.append(key)
+            ids[i] = stack_id
+        return ids
+
+    def blocks(self, pid: int, first: int, stacks: list[tuple[int, ...]]) -> list[tuple[bytes, bytes]]:
+        """Tags and payloads of the blocks normalizing stacks first.. of pid"""
+        ids = self.normalize(pid, stacks)
+        blocks = []
+
+        if self.written_modules < len(self.modules):
+            blocks.append((b"MODL", encode_modules(self.written_modules, self.modules[self.written_modules :])))
+            self.written_modules = len(self.modules)
+        if self.written_stacks < len(self.stacks):
+            blocks.append((b"NSTK", encode_normalized(self.written_stacks, self.stacks[self.written_stacks :])))
+            self.written_stacks = len(self.stacks)
+
+        blocks.append((b"SMAP", STACK_MAP_HEADER.pack(pid, first, len(ids)) + ids.astype("<u4").tobytes()))
+        return blocks
+
+
+def encode_modules(first: int, modules: list[Module]) -> bytes:
+    parts = [MODULES_HEADER.pack(first, len(modules))]
+    for module in modules:
+        build_id, path = module.build_id.encode(), module.path.encode()
+        parts.append(MODULE_HEADER.pack(len(build_id), len(path)) + build_id + path)
+    return b"".join(parts)
+
+
+def encode_normalized(first: int, stacks: list[tuple[tuple[int, ...], tuple[int, ...]]]) -> bytes:
+    depths = np.fromiter((len(modules) for modules, _ in stacks), dtype="<u4", count=len(stacks))
+    total = int(depths.sum())
+    modules = np.fromiter((module for modules, _ in stacks for module in modules), dtype="<i4", count=total)
+    offsets = np.fromiter((offset for _, offsets in stacks for offset in offsets), dtype="<u8", count=total)
+    return NORMALIZED_HEADER.pack(first, len(stacks)) + depths.tobytes() + modules.tobytes() + offsets.tobytes()
+
+
+def splitmix64(values: np.ndarray) -> np.ndarray:
+    values = values + np.uint64(0x9E3779B97F4A7C15)
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+class NormalizedTable:
+    """The normalized stacks of a capture or snapshot file, built from its blocks"""
+
+    def __init__(self):
+        self.modules: list[Module] = []
+        self.depths: list[np.ndarray] = []
+        self.frame_modules: list[np.ndarray] = []
+        self.frame_offsets: list[np.ndarray] = []
+        self.count = 0
+        self.stack_maps: dict[int, np.ndarray] = {}
+
+    def add_block(self, tag: bytes, payload: memoryview):
+        if tag == b"MODL":
+            first, count = MODULES_HEADER.unpack_from(payload)
+            del self.modules[first:]
+            offset = MODULES_HEADER.size
+            for _ in range(count):
+                id_length, path_length = MODULE_HEADER.unpack_from(payload, offset)
+                offset += MODULE_HEADER.size
+                build_id = bytes(payload[offset : offset + id_length]).decode()
+                path = bytes(payload[offset + id_length : offset + id_length + path_length]).decode()
+                offset += id_length + path_length
+                self.modules.append(Module(build_id, path))
+        elif tag == b"NSTK":
+            first, count = NORMALIZED_HEADER.unpack_from(payload)
+            depths = np.frombuffer(payload, dtype="<u4", count=count, offset=NORMALIZED_HEADER.size)
+            total = int(depths.sum())
+            start = NORMALIZED_HEADER.size + 4 * count
+            self.add_stacks(
+                depths,
+                np.frombuffer(payload, dtype="<i4", count=total, offset=start),
+                np.frombuffer(payload, dtype="<u8", count=total, offset=start + 4 * total),
+            )
+        elif tag == b"SMAP":
+            pid, first, count = STACK_MAP_HEADER.unpack_from(payload)
+            ids = np.frombuffer(payload, dtype="<u4", count=count, offset=STACK_MAP_HEADER.size)
+            self.map_stacks(pid, first, ids)
+
+    def add_stacks(self, depths: np.ndarray, modules: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        """Append normalized stacks, returns their ids"""
+        self.depths.append(depths.astype(np.int64))
+        self.frame_modules.append(modules.astype(np.int32))
+        self.frame_offsets.append(offsets.astype(np.uint64))
+        ids = np.arange(self.count, self.count + len(depths), dtype=np.uint32)
+        self.count += len(depths)
+        return ids
+
+    def add_unnormalized(self, pid: int, stacks: list[tuple[int, ...]]):
+        """Stacks of files written without normalization, their frames stay absolute"""
+        depths = np.fromiter((len(stack) for stack in stacks), dtype=np.int64, count=len(stacks))
+        frames = np.fromiter((frame for stack in stacks for frame in stack), dtype=np.uint64, count=int(depths.sum()))
+        ids = self.add_stacks(depths, np.full(len(frames), UNKNOWN_MODULE, dtype=np.int32), frames)
+        self.map_stacks(pid, 0, ids)
+
+    def map_stacks(self, pid: int, first: int, ids: np.ndarray):
+        stack_map = self.stack_maps.get(pid, np.zeros(0, dtype=np.uint32))
+        if len(stack_map) < first + len(ids):
+            grown = np.zeros(first + len(ids), dtype=np.uint32)
+            grown[: len(stack_map)] = stack_map
+            stack_map = grown
+        stack_map[first : first + len(ids)] = ids
+        self.stack_maps[pid] = stack_map
+
+    def frames(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Depth of every normalized stack, module and offset of all their frames"""
+        # Concatenated once, blocks are only added while reading
+        if len(self.depths) > 1:
+            self.depths = [np.concatenate(self.depths)]
+            self.frame_modules = [np.concatenate(self.frame_modules)]
+            self.frame_offsets = [np.concatenate(self.frame_offsets)]
+        if not self.depths:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint64)
+        return self.depths[0], self.frame_modules[0], self.frame_offsets[0]
+
+    def keys(self) -> np.ndarray:
+        """
+        A 64 bit hash of every normalized stack over the module keys and
+        offsets of its frames, equal for the same call site in any file
+        """
+        depths, modules, offsets = self.frames()
+        module_hashes = np.array(
+            [int.from_bytes(hashlib.blake2b(module.key.encode(), digest_size=8).digest(), "little") for module in self.modules]
+            + [0],  # UNKNOWN_MODULE indexes the last entry
+            dtype=np.uint64,
+        )
+
+        starts = np.cumsum(depths) - depths
+        positions = (np.arange(len(modules)) - np.repeat(starts, depths)).astype(np.uint64)
+        hashes = splitmix64(module_hashes[modules] ^ splitmix64(offsets ^ (positions << np.uint64(56))))
+
+        keys = np.zeros(len(depths), dtype=np.uint64)
+        filled = depths > 0
+        if len(hashes):
+            keys[filled] = np.bitwise_xor.reduceat(hashes, starts[filled])
+        return splitmix64(keys ^ depths.astype(np.uint64))
+
+    def describe(self, stack_id: int, frames: int = 4) -> str:
+        """Innermost frames of a stack as module+offset"""
+        depths, modules, offsets = self.frames()
+        start = int(depths[:stack_id].sum())
+        names = []
+        for module, offset in zip(
+            modules[start : start + min(frames, int(depths[stack_id]))].tolist(),
+            offsets[start : start + min(frames, int(depths[stack_id]))].tolist(),
+        ):
+            names.append(hex(offset) if module == UNKNOWN_MODULE else f"{self.modules[module].name}+{hex(offset)}")
+        if depths[stack_id] > frames:
+            names.append("...")
+        return " -> ".join(names)
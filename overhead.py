@@ -0,0 +1,113 @@
+"""
+Reads the counters the hooks keep of their own cost. One in --overhead-sampling
+hook calls of every thread is timed with the TSC, per phase: the backtrace,
+the timestamp, copying the record into the ring and waiting for its mutex.
+Threads add their counters to the ring header now and then. The real allocator
+is not part of the time, so the total is what the hooks add to the target.
+"""
+
+import os
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from ring_layout import OVERHEAD_OFFSET
+
+PHASES: list[str] = ["backtrace", "timestamp", "write", "lock"]
+
+# Matches struct OverheadHeader in hook_lib/overhead.h
+OVERHEAD_DTYPE = np.dtype(
+    [
+        ("sampling", "<u4"),
+        ("threads", "<u4"),
+        ("calls", "<u8"),
+        ("timed", "<u8"),
+        ("cycles", "<u8"),
+        ("phases", "<u8", (len(PHASES),)),
+        ("start_tsc", "<u8"),
+        ("start_ns", "<u8"),
+        ("tsc", "<u8"),
+        ("ns", "<u8"),
+    ]
+)
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def cpu_seconds(pid: int) -> float | None:
+    """User and system time of a process so far"""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # utime and stime are the 12th and 13th fields after the name in parentheses
+    fields = stat.rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+@dataclass
+class OverheadReport:
+    calls: int = 0
+    timed: int = 0
+    sampling: int = 0
+    threads: int = 0
+    seconds: float = 0  # Estimated for all calls, from the timed ones
+    phases: dict[str, float] = field(default_factory=lambda: dict.fromkeys(PHASES, 0.0))
+    cpu_seconds: float = 0  # Of the target since the hooks were loaded
+
+    @property
+    def other(self) -> float:
+        """Filters, the churn table and the rest of the hooks"""
+        return max(self.seconds - sum(self.phases.values()), 0)
+
+    @property
+    def slowdown(self) -> float | None:
+        """Estimated slowdown of the target in percent"""
+        own = self.cpu_seconds - self.seconds
+        return 100 * self.seconds / own if own > 0 else None
+
+    def merge(self, other: "OverheadReport"):
+        self.calls += other.calls
+        self.timed += other.timed
+        self.sampling = max(self.sampling, other.sampling)
+        self.threads += other.threads
+        self.seconds += other.seconds
+        for phase, seconds in other.phases.items():
+            self.phases[phase] += seconds
+        self.cpu_seconds += other.cpu_seconds
+
+
+class OverheadCounters:
+    """The overhead counters in the ring header of process pid"""
+
+    def __init__(self, mem, pid: int):
+        self.mem = mem
+        self.pid = pid
+        self.start_cpu = cpu_seconds(pid) or 0
+
+    def read(self) -> np.void:
+        return np.frombuffer(self.mem[OVERHEAD_OFFSET : OVERHEAD_OFFSET + OVERHEAD_DTYPE.itemsize], dtype=OVERHEAD_DTYPE)[0]
+
+    def report(self) -> OverheadReport | None:
+        """None if the hooks were built without the counters or nothing was timed yet"""
+        header = self.read()
+        elapsed_ns = int(header["ns"]) - int(header["start_ns"])
+        if not header["sampling"] or not header["timed"] or elapsed_ns <= 0:
+            return None
+
+        # Cycles per second from the TSC and the clock of the hooks, the timed
+        # calls stand in for the untimed ones
+        frequency = (int(header["tsc"]) - int(header["start_tsc"])) / elapsed_ns * 10**9
+        scale = int(header["calls"]) / int(header["timed"]) / frequency
+
+        cpu = cpu_seconds(self.pid)
+        return OverheadReport(
+            int(header["calls"]),
+            int(header["timed"]),
+            int(header["sampling"]),
+            int(header["threads"]),
+            int(header["cycles"]) * scale,
+            {phase: int(cycles) * scale for phase, cycles in zip(PHASES, header["phases"])},
+            0 if cpu is None else cpu - self.start_cpu,
+        )
@@ -0,0 +1,207 @@
+import numpy as np
+
+# Reserved keys, no allocation is ever made at these addresses
+EMPTY: int = 0
+TOMBSTONE: int = 1
+
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+class PointerTable:
+    """
+    Live allocations by address in an open addressing hash table with linear
+    probing, kept in NumPy arrays: 22 bytes per slot (address, size, stack id,
+    age slot and thread), about 31 bytes per live allocation after a rebuild.
+    Removed entries leave tombstones that are dropped when the table is
+    rebuilt, which also resizes it to TARGET_LOAD. Lookups, inserts and
+    removes work on whole arrays of addresses at once.
+    """
+
+    INITIAL_CAPACITY: int = 1024
+    MAX_LOAD: float = 0.85  # Live entries and tombstones per slot before rebuilding
+    TARGET_LOAD: float = 0.7  # Live entries per slot after rebuilding
+
+    def __init__(self, capacity: int = INITIAL_CAPACITY):
+        self._allocate(capacity)
+        self.live = 0
+        self.tombstones = 0
+
+    def __len__(self) -> int:
+        return self.live
+
+    def _allocate(self, capacity: int):
+        self.capacity = capacity
+        self.keys = np.zeros(capacity, dtype=np.uint64)
+        self.sizes = np.zeros(capacity, dtype=np.uint32)
+        self.stack_ids = np.zeros(capacity, dtype=np.uint32)
+        self.age_slots = np.zeros(capacity, dtype=np.uint32)
+        self.threads = np.zeros(capacity, dtype=np.uint16)  # Indices of a ThreadTable
+
+    def nbytes(self) -> int:
+        return (
+            self.keys.nbytes
+            + self.sizes.nbytes
+            + self.stack_ids.nbytes
+            + self.age_slots.nbytes
+            + self.threads.nbytes
+        )
+
+    def _hash(self, keys: np.ndarray) -> np.ndarray:
+        # Allocations are aligned, the multiply spreads the low bits, the high half is kept
+        return ((keys * HASH_MULTIPLIER) >> np.uint64(32)) % np.uint64(self.capacity)
+
+    def find(self, keys: np.ndarray) -> np.ndarray:
+        """Slot of every key, -1 for keys that are not in the table"""
+        result = np.full(len(keys), -1, dtype=np.int64)
+        active = np.arange(len(keys))
+        positions = self._hash(keys).astype(np.int64)
+
+        while active.size:
+            found = self.keys[positions]
+            hit = found == keys[active]
+            result[active[hit]] = positions[hit]
+
+            # Tombstones don't end a probe sequence, empty slots do
+            probing = ~hit & (found != EMPTY)
+            active = active[probing]
+            positions = (positions[probing] + 1) % self.capacity
+
+        return result
+
+    def remove(self, keys: np.ndarray):
+        slots = self.find(keys)
+        slots = slots[slots >= 0]
+        self.keys[slots] = TOMBSTONE
+        self.live -= len(slots)
+        self.tombstones += len(slots)
+
+    def upsert(
+        self, keys: np.ndarray, sizes: np.ndarray, stack_ids: np.ndarray, age_slots: np.ndarray, threads: np.ndarray
+    ):
+        """Set the values of keys, which must be unique, inserting the ones that are missing"""
+        slots = self.find(keys)
+        present = slots >= 0
+        self._set(
+            slots[present], keys[present], sizes[present], stack_ids[present], age_slots[present], threads[present]
+        )
+
+        missing = ~present
+        count = int(missing.sum())
+        if not count:
+            return
+
+        if self.live + self.tombstones + count > self.MAX_LOAD * self.capacity:
+            self._rebuild(self.live + count)
+
+        self._insert(keys[missing], sizes[missing], stack_ids[missing], age_slots[missing], threads[missing])
+
+    def _insert(
+        self, keys: np.ndarray, sizes: np.ndarray, stack_ids: np.ndarray, age_slots: np.ndarray, threads: np.ndarray
+    ):
+        # Keys are known to be missing, so any free slot on their probe sequence will do
+        active = np.arange(len(keys))
+        positions = self._hash(keys).astype(np.int64)
+
+        while active.size:
+            free = self.keys[positions] <= TOMBSTONE
+            # When several keys reach the same free slot the first one takes it
+            _, first = np.unique(np.where(free, positions, -1), return_index=True)
+            claim = np.zeros(len(active), dtype=bool)
+            claim[first] = True
+            claim &= free
+
+            claimed = active[claim]
+            self.tombstones -= int((self.keys[positions[claim]] == TOMBSTONE).sum())
+            self._set(
+                positions[claim], keys[claimed], sizes[claimed], stack_ids[claimed], age_slots[claimed], threads[claimed]
+            )
+            self.live += len(claimed)
+
+            probing = ~claim
+            active = active[probing]
+            positions = np.where(free[probing], positions[probing], (positions[probing] + 1) % self.capacity)
+
+    def _set(self, slots, keys, sizes, stack_ids, age_slots, threads):
+        self.keys[slots] = keys
+        self.sizes[slots] = sizes
+        self.stack_ids[slots] = stack_ids
+        self.age_slots[slots] = age_slots
+        self.threads[slots] = threads
+
+    def _rebuild(self, live: int):
+        used = self.keys > TOMBSTONE
+        keys = self.keys[used]
+        sizes = self.sizes[used]
+        stack_ids = self.stack_ids[used]
+        age_slots = self.age_slots[used]
+        threads = self.threads[used]
+
+        self._allocate(max(self.INITIAL_CAPACITY, int(live / self.TARGET_LOAD)))
+        self.live = 0
+        self.tombstones = 0
+        self._insert(keys, sizes, stack_ids, age_slots, threads)
+
+    def apply(
+        self,
+        keys: np.ndarray,
+        inserts: np.ndarray,
+        sizes: np.ndarray,
+        stack_ids: np.ndarray,
+        age_slot: int,
+        threads: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Apply a batch of allocations (where inserts is set) and frees in
+        order. Returns for every record whether it freed a live allocation,
+        and the size, stack id, age slot and thread of that allocation.
+        """
+        count = len(keys)
+        index = np.arange(count)
+        found = np.zeros(count, dtype=bool)
+        freed_sizes = np.zeros(count, dtype=np.int64)
+        freed_stacks = np.full(count, -1, dtype=np.int64)
+        freed_slots = np.zeros(count, dtype=np.int64)
+        freed_threads = np.zeros(count, dtype=np.int64)
+        if threads is None:
+            threads = np.zeros(count, dtype=np.uint16)
+
+        # Group the records by address, in batch order within every address
+        order = np.lexsort((index, keys))
+        sorted_keys = keys[order]
+        first = np.ones(count, dtype=bool)
+        first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        last = np.ones(count, dtype=bool)
+        last[:-1] = first[1:]
+
+        previous = np.full(count, -1, dtype=np.int64)
+        previous[order[~first]] = order[np.flatnonzero(~first) - 1]
+
+        # Frees that follow an allocation of their address in the same batch
+        frees = ~inserts & (keys > TOMBSTONE)
+        in_batch = frees & (previous >= 0)
+        in_batch[in_batch] = inserts[previous[in_batch]]
+        found[in_batch] = True
+        freed_sizes[in_batch] = sizes[previous[in_batch]]
+        freed_stacks[in_batch] = stack_ids[previous[in_batch]]
+        freed_slots[in_batch] = age_slot
+        freed_threads[in_batch] = threads[previous[in_batch]]
+
+        # Frees of allocations made before the batch
+        from_table = frees & (previous < 0)
+        slots = self.find(keys[from_table])
+        hits = np.flatnonzero(from_table)[slots >= 0]
+        slots = slots[slots >= 0]
+        found[hits] = True
+        freed_sizes[hits] = self.sizes[slots]
+        freed_stacks[hits] = self.stack_ids[slots]
+        freed_slots[hits] = self.age_slots[slots]
+        freed_threads[hits] = self.threads[slots]
+
+        # The last record of every address decides whether it stays live
+        final = order[last]
+        final = final[keys[final] > TOMBSTONE]
+        kept = final[inserts[final]]
+        self.remove(keys[final[~inserts[final]]])
+        self.upsert(keys[kept], sizes[kept], stack_ids[kept], np.full(len(kept), age_slot), threads[kept])
+
+        return found, freed_sizes, freed_stacks, freed_slots, freed_threads
@@ -0,0 +1,384 @@
+"""
+Queries over the events of a capture file, such as "allocations between 2 MB
+and 8 MB from stacks containing frame X during minute 37". A query filters on
+a time range, a size range, trace types, processes, threads and frames of the
+call stack, and only decompresses the event blocks that can hold matches:
+
+    time    the first and last timestamp of every block, from INDX
+    sizes, types, threads, stacks
+            the size classes, trace types, thread ids and stack ids present
+            in every block, from the EIDX block written after it
+    frames  an inverted index from frames to the stacks containing them,
+            built from the stacks of the capture when a query first needs it
+
+Blocks without an EIDX block, from older or unfinished captures, are always
+decompressed. Matching events are summed into a StackTable per process, so
+the reports of the profiler can be printed for them.
+"""
+
+import argparse
+import re
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from capture import CaptureReader, print_events
+from normalize import NormalizedTable
+from shared_buffer import ALLOCATION_TYPES, Memtracker, TraceType, print_header
+from stacks import StackTable, size_classes
+
+ALL_BITS = (1 << 64) - 1
+
+SIZE_UNITS = {"": 1, "b": 1, "k": 1 << 10, "kb": 1 << 10, "m": 1 << 20, "mb": 1 << 20, "g": 1 << 30, "gb": 1 << 30}
+TIME_UNITS = {"": 1, "ms": 1e-3, "s": 1, "m": 60, "h": 3600}
+
+
+@dataclass
+class Query:
+    """Every given filter has to match, timestamps and sizes are inclusive"""
+
+    start: int | None = None
+    end: int | None = None
+    min_size: int | None = None
+    max_size: int | None = None
+    types: list[int] | None = None
+    pids: list[int] | None = None
+    tids: list[int] | None = None
+    frames: list[str] | None = None  # All of them have to be in the stack, see FrameIndex.matching
+
+    def size_mask(self) -> int:
+        """Size classes that can hold sizes in [min_size, max_size]"""
+        if self.min_size is None and self.max_size is None:
+            return ALL_BITS
+        low = int(size_classes(np.array([self.min_size or 0]))[0])
+        high = 63 if self.max_size is None else int(size_classes(np.array([self.max_size]))[0])
+        return sum(1 << size_class for size_class in range(low, min(high, 63) + 1))
+
+    def type_mask(self) -> int:
+        if self.types is None:
+            return ALL_BITS
+        return sum(1 << trace_type for trace_type in self.types)
+
+    def matches(self, events: np.ndarray) -> np.ndarray:
+        """Events passing the filters other than frames"""
+        mask = np.ones(len(events), dtype=bool)
+        if self.start is not None:
+            mask &= events["time"] >= self.start
+        if self.end is not None:
+            mask &= events["time"] <= self.end
+        if self.min_size is not None:
+            mask &= events["size"] >= self.min_size
+        if self.max_size is not None:
+            mask &= events["size"] <= self.max_size
+        if self.types is not None:
+            mask &= np.isin(events["type"], self.types)
+        if self.tids is not None:
+            mask &= np.isin(events["tid"], self.tids)
+        return mask
+
+
+class FrameIndex:
+    """
+    Inverted indexes from frames to the ids of the stacks containing them:
+    absolute addresses per process, and module and offset over the
+    normalized stacks. Both are sorted arrays of frames with the stack of
+    every frame, a frame is looked up with a binary search.
+    """
+
+    def __init__(self, stacks: dict[int, list[tuple[int, ...]]], normalized: NormalizedTable):
+        self.stacks = stacks
+        self.normalized = normalized
+        self.absolute: dict[int, tuple[np.ndarray, np.ndarray]] = {}
+        self.modules: tuple[np.ndarray, np.ndarray] | None = None
+
+    def _absolute(self, pid: int) -> tuple[np.ndarray, np.ndarray]:
+        index = self.absolute.get(pid)
+        if index is None:
+            stacks = self.stacks.get(pid, [])
+            depths = np.fromiter((len(stack) for stack in stacks), dtype=np.int64, count=len(stacks))
+            frames = np.fromiter((frame for stack in stacks for frame in stack), dtype=np.uint64, count=int(depths.sum()))
+            order = np.argsort(frames, kind="stable")
+            index = self.absolute[pid] = frames[order], np.repeat(np.arange(len(stacks)), depths)[order]
+        return index
+
+    def _modules(self) -> tuple[np.ndarray, np.ndarray]:
+        """Keys (module + 1) << 48 | offset of the normalized frames, frames of unknown modules get module 0"""
+        if self.modules is None:
+            depths, modules, offsets = self.normalized.frames()
+            keys = ((modules.astype(np.int64) + 1).astype(np.uint64) << np.uint64(48)) | offsets
+            order = np.argsort(keys, kind="stable")
+            self.modules = keys[order], np.repeat(np.arange(len(depths)), depths)[order]
+        return self.modules
+
+    def _normalized_stacks(self, frame: str) -> np.ndarray:
+        """Normalized stacks containing a frame given as module+offset or as a module"""
+        # Module names may contain a + themselves, like libstdc++
+        match = re.fullmatch(r"(.+)\+(0x[0-9a-fA-F]+|[0-9]+)", frame)
+        name, offset = match.groups() if match else (frame, None)
+        modules = [
+            index for index, module in enumerate(self.normalized.modules) if name in (module.name, module.path, module.build_id)
+        ]
+        keys, stack_ids = self._modules()
+        found = []
+        for module in modules:
+            low = np.uint64(module + 1) << np.uint64(48)
+            if offset is not None:
+                low |= np.uint64(int(offset, 0))
+                high = low + np.uint64(1)
+            else:
+                high = np.uint64(module + 2) << np.uint64(48)
+            found.append(stack_ids[np.searchsorted(keys, low) : np.searchsorted(keys, high)])
+        return np.unique(np.concatenate(found)) if found else np.zeros(0, dtype=np.int64)
+
+    def stacks_with(self, pid: int, frame: str) -> np.ndarray:
+        """
+        Sorted ids of the stacks of pid containing a frame, given as an
+        address (0x7f12...), as module+offset (libfoo.so+0x1234) or as a
+        module, which matches every frame in it. Modules are named by file
+        name, path or build id.
+        """
+        if re.fullmatch(r"0x[0-9a-fA-F]+|[0-9]+", frame):
+            frames, stack_ids = self._absolute(pid)
+            address = np.uint64(int(frame, 0))
+            return np.unique(stack_ids[np.searchsorted(frames, address) : np.searchsorted(frames, address, side="right")])
+
+        stack_map = self.normalized.stack_maps.get(pid)
+        if stack_map is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero(np.isin(stack_map, self._normalized_stacks(frame)))
+
+    def matching(self, pid: int, frames: list[str]) -> np.ndarray:
+        """Sorted ids of the stacks of pid containing every frame"""
+        matching = self.stacks_with(pid, frames[0])
+        for frame in frames[1:]:
+            matching = np.intersect1d(matching, self.stacks_with(pid, frame), assume_unique=True)
+        return matching
+
+
+@dataclass
+class QueryStatistics:
+    blocks: int = 0  # Event blocks in the capture
+    scanned_blocks: int = 0  # Decompressed to answer the query
+    scanned_events: int = 0
+    seconds: float = 0
+
+
+class CaptureQuery:
+    """Answers queries over one capture, keeping the summaries of its event blocks in arrays"""
+
+    def __init__(self, reader: CaptureReader):
+        self.reader = reader
+        self.blocks = reader.event_blocks()
+        self.frames = FrameIndex(reader.stacks, reader.normalized)
+
+        count = len(self.blocks)
+        self.summarized = np.zeros(count, dtype=bool)
+        self.size_masks = np.full(count, ALL_BITS, dtype=np.uint64)
+        self.type_masks = np.full(count, ALL_BITS, dtype=np.uint64)
+
+        # Thread and stack ids of all blocks concatenated, with the position of their block
+        tids, tid_blocks, stack_ids, stack_blocks = [], [], [], []
+        offsets = self.blocks["offset"]
+        for _, offset, size_mask, type_mask, block_tids, block_stacks in reader.summaries():
+            position = int(np.searchsorted(offsets, offset))
+            if position == count or offsets[position] != offset:
+                continue
+            self.summarized[position] = True
+            self.size_masks[position] = size_mask
+            self.type_masks[position] = type_mask
+            tids.append(block_tids)
+            tid_blocks.append(np.full(len(block_tids), position, dtype=np.int64))
+            stack_ids.append(block_stacks)
+            stack_blocks.append(np.full(len(block_stacks), position, dtype=np.int64))
+
+        self.tids = np.concatenate(tids) if tids else np.zeros(0, dtype=np.uint32)
+        self.tid_blocks = np.concatenate(tid_blocks) if tid_blocks else np.zeros(0, dtype=np.int64)
+        self.stack_ids = np.concatenate(stack_ids) if stack_ids else np.zeros(0, dtype=np.uint32)
+        self.stack_blocks = np.concatenate(stack_blocks) if stack_blocks else np.zeros(0, dtype=np.int64)
+        self.statistics = QueryStatistics(count)
+
+    def _any_in(self, positions: np.ndarray, hits: np.ndarray) -> np.ndarray:
+        """Blocks with a hit among their ids, and blocks without a summary"""
+        found = np.bincount(positions[hits], minlength=len(self.blocks)) > 0
+        return found | ~self.summarized
+
+    def select(self, query: Query, stacks: dict[int, np.ndarray] | None = None) -> np.ndarray:
+        """Index rows of the event blocks that can hold matches, stacks are the matching stack ids per pid"""
+        blocks = self.blocks
+        keep = np.ones(len(blocks), dtype=bool)
+        if query.pids is not None:
+            keep &= np.isin(blocks["pid"], query.pids)
+        if query.start is not None:
+            keep &= blocks["last_time"] >= query.start
+        if query.end is not None:
+            keep &= blocks["first_time"] <= query.end
+        keep &= (self.size_masks & np.uint64(query.size_mask())) != 0
+        keep &= (self.type_masks & np.uint64(query.type_mask())) != 0
+
+        if query.tids is not None and keep.any():
+            keep &= self._any_in(self.tid_blocks, np.isin(self.tids, query.tids))
+        if stacks is not None and keep.any():
+            hits = np.zeros(len(self.stack_ids), dtype=bool)
+            block_pids = blocks["pid"][self.stack_blocks]
+            for pid, stack_ids in stacks.items():
+                hits |= (block_pids == pid) & np.isin(self.stack_ids, stack_ids)
+            keep &= self._any_in(self.stack_blocks, hits)
+        return blocks[keep]
+
+    def run(self, query: Query):
+        """Yield the pid and matching events of every block that can hold matches"""
+        start = time.perf_counter()
+        stacks = None
+        if query.frames:
+            pids = np.unique(self.blocks["pid"]).tolist() if query.pids is None else query.pids
+            stacks = {pid: self.frames.matching(pid, query.frames) for pid in pids}
+
+        rows = self.select(query, stacks)
+        self.statistics = QueryStatistics(len(self.blocks), len(rows))
+        for row in rows:
+            pid, events = self.reader.decode_block(int(row["offset"]))
+            self.statistics.scanned_events += len(events)
+            mask = query.matches(events)
+            if stacks is not None:
+                mask &= np.isin(events["stack_id"], stacks.get(pid, []))
+            self.statistics.seconds = time.perf_counter() - start
+            yield pid, events[mask]
+        self.statistics.seconds = time.perf_counter() - start
+
+
+@dataclass
+class QueryResult:
+    """Matching events summed per process, in StackTables with the stack ids of the capture"""
+
+    stacks: dict[int, list[tuple[int, ...]]]
+    tables: dict[int, StackTable] = field(default_factory=dict)
+    events: int = 0
+    allocations: int = 0
+    allocated_bytes: int = 0
+    frees: int = 0
+    freed_bytes: int = 0
+
+    def table(self, pid: int) -> StackTable:
+        table = self.tables.get(pid)
+        if table is None:
+            table = self.tables[pid] = StackTable()
+            for stack in self.stacks.get(pid, []):
+                table.intern(list(stack))
+        return table
+
+    def add(self, pid: int, events: np.ndarray):
+        self.events += len(events)
+        allocations = np.isin(events["type"], ALLOCATION_TYPES)
+        sizes = events["size"].astype(np.int64)
+        tracked = events["stack_id"] >= 0
+
+        self.allocations += int(allocations.sum())
+        self.allocated_bytes += int(sizes[allocations].sum())
+        self.frees += int((~allocations).sum())
+        self.freed_bytes += int(sizes[~allocations].sum())
+
+        table = self.table(pid)
+        table.add_allocations(events["stack_id"][allocations & tracked], sizes[allocations & tracked])
+        table.add_frees(events["stack_id"][~allocations & tracked], sizes[~allocations & tracked])
+
+
+def parse_range(text: str, parse) -> tuple:
+    """Bounds of "low:high", either may be left out"""
+    low, separator, high = text.partition(":")
+    if not separator:
+        raise argparse.ArgumentTypeError(f"expected low:high, got {text!r}")
+    return (parse(low) if low else None, parse(high) if high else None)
+
+
+def parse_number(text: str, units: dict[str, int]) -> float:
+    match = re.fullmatch(r"([0-9.]+)\s*([a-zA-Z]*)", text.strip())
+    if match is None or match.group(2).lower() not in units:
+        raise argparse.ArgumentTypeError(f"invalid value {text!r}")
+    return float(match.group(1)) * units[match.group(2).lower()]
+
+
+def size_range(text: str) -> tuple[int | None, int | None]:
+    return parse_range(text, lambda value: int(parse_number(value, SIZE_UNITS)))
+
+
+def time_range(text: str) -> tuple[float | None, float | None]:
+    return parse_range(text, lambda value: parse_number(value, TIME_UNITS))
+
+
+def trace_type(text: str) -> int:
+    try:
+        return TraceType[text.upper()]
+    except KeyError:
+        raise argparse.ArgumentTypeError(f"unknown trace type {text!r}")
+
+
+def print_result(result: QueryResult, statistics: QueryStatistics):
+    print_header("Query")
+    print(
+        f"Matched {result.events} events: {result.allocations} allocations ({result.allocated_bytes} bytes), "
+        f"{result.frees} frees ({result.freed_bytes} bytes)"
+    )
+    print(
+        f"Scanned {statistics.scanned_blocks} of {statistics.blocks} blocks "
+        f"({statistics.scanned_events} events) in {statistics.seconds:.3f}s\n"
+    )
+
+    for pid, table in result.tables.items():
+        if not table.alloc_count[: len(table)].any():
+            continue
+        print(f"Process {pid}:\n")
+        Memtracker(None, pid).print_sizes(table.size_report())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Query the events of a capture file, only decompressing the blocks that can hold matches.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("file", help="Capture file written with --capture-file.")
+    parser.add_argument("-t", "--time", type=time_range, default=None, help="Time range as start:end after the first event, e.g. 36m:37m or 90s: (units ms, s, m, h).")
+    parser.add_argument("-s", "--size", type=size_range, default=None, help="Size range in bytes as min:max, e.g. 2M:8M or :64 (units K, M, G).")
+    parser.add_argument("-y", "--types", type=trace_type, nargs="+", default=None, help="Trace types, e.g. malloc new free.")
+    parser.add_argument("-p", "--pids", type=int, nargs="+", default=None, help="Processes.")
+    parser.add_argument("-T", "--tids", type=int, nargs="+", default=None, help="Thread ids.")
+    parser.add_argument("-f", "--frames", nargs="+", default=None, help="Frames every matching stack contains: an address, module+offset or a module.")
+    parser.add_argument("-e", "--events", type=int, default=0, help="Print up to this many matching events.")
+    args = parser.parse_args()
+
+    try:
+        reader = CaptureReader(args.file)
+    except (OSError, ValueError) as e:
+        print(f"Could not read capture: {e}")
+        exit(1)
+
+    engine = CaptureQuery(reader)
+    query = Query(types=args.types, pids=args.pids, tids=args.tids, frames=args.frames)
+    if args.size is not None:
+        query.min_size, query.max_size = args.size
+    if args.time is not None and len(engine.blocks):
+        # Cycles of rdtscp have no fixed length, and without timestamps every event is at 0
+        if not reader.nanoseconds():
+            print("Time ranges need a capture timestamped in nanoseconds, taken with --timestamp-method chrono")
+            reader.close()
+            exit(1)
+        origin = int(engine.blocks["first_time"].min())
+        start, end = args.time
+        query.start = None if start is None else origin + int(start * 10**9)
+        query.end = None if end is None else origin + int(end * 10**9)
+
+    result = QueryResult(reader.stacks)
+    printed = 0
+    for pid, events in engine.run(query):
+        result.add(pid, events)
+        if printed < args.events and len(events):
+            shown = events[: args.events - printed]
+            print_events(reader, [(pid, shown)])
+            printed += len(shown)
+
+    print_result(result, engine.statistics)
+    reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+"""
+Replays the allocations and frees of a capture file through allocator models
+to compare size classes, arenas and pools without rerunning the process.
+Every model works on whole capture blocks with vectorized passes.
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from capture import CaptureReader
+from pointer_table import PointerTable
+from shared_buffer import ALLOCATION_TYPES
+
+PAGE_SIZE: int = 4096
+ALIGNMENT: int = 16
+
+
+def default_size_classes(largest: int = 14336) -> np.ndarray:
+    """Four classes per doubling above 64 bytes, similar to jemalloc's small classes"""
+    classes = [8, 16, 32, 48, 64]
+    step = 16
+    while classes[-1] < largest:
+        for _ in range(4):
+            classes.append(classes[-1] + step)
+        step *= 2
+    return np.array([size for size in classes if size <= largest], dtype=np.int64)
+
+
+def round_up(sizes: np.ndarray, multiple: int) -> np.ndarray:
+    return (sizes + multiple - 1) // multiple * multiple
+
+
+class FreeLists:
+    """
+    Free lists of fixed size objects, one per group. Freed objects are kept
+    for reuse and never handed back, so a group needs as many objects as it
+    ever had live at once.
+    """
+
+    def __init__(self, groups: int):
+        self.live = np.zeros(groups, dtype=np.int64)
+        self.peak = np.zeros(groups, dtype=np.int64)
+        self.longest = np.zeros(groups, dtype=np.int64)  # Longest free list seen
+
+    def apply(self, groups: np.ndarray, deltas: np.ndarray) -> np.ndarray:
+        """Apply +1 (allocation) and -1 (free) per event, returns which allocations needed a new object"""
+        count = len(groups)
+        new_objects = np.zeros(count, dtype=bool)
+        if not count:
+            return new_objects
+
+        # Work on the events of every group in order
+        order = np.argsort(groups, kind="stable")
+        sorted_groups = groups[order]
+        sorted_deltas = deltas[order]
+        starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+        segments = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, count]))
+
+        cumulative = np.cumsum(sorted_deltas)
+        live = self.live[sorted_groups] + cumulative - (cumulative[starts] - sorted_deltas[starts])[segments]
+
+        # Running maximum per group, segments are lifted so earlier ones never win
+        peak = self.peak[sorted_groups]
+        span = 2 * (count + int(self.peak.max()) + 1)
+        lifted = live - peak + segments * span
+        running = np.maximum(np.maximum.accumulate(lifted) - segments * span, 0) + peak
+
+        previous = np.r_[0, running[:-1]]
+        previous[starts] = peak[starts]
+        new_objects[order] = running > previous
+
+        np.maximum.at(self.longest, sorted_groups, running - live)
+        ends = np.r_[starts[1:], count] - 1
+        self.live[sorted_groups[ends]] = live[ends]
+        self.peak[sorted_groups[ends]] = running[ends]
+        return new_objects
+
+
+class AllocatorModel:
+    """Base of the models, keeps the statistics every model reports"""
+
+    name: str = "model"
+
+    def __init__(self):
+        self.footprint = 0
+        self.peak_footprint = 0
+        self.allocations = 0
+        self.requested_bytes = 0
+        self.allocated_bytes = 0  # Including rounding and padding
+        self.reused = 0  # Allocations served from a free list
+        self.longest_free_list = 0
+
+    def replay(self, sizes: np.ndarray, allocations: np.ndarray, stack_ids: np.ndarray, addresses: np.ndarray):
+        """Replay a block of matched events, frees carry the size and stack id of what they freed"""
+        deltas = self._replay(sizes, allocations, stack_ids, addresses)
+        footprint = self.footprint + np.cumsum(deltas)
+        if len(footprint):
+            self.peak_footprint = max(self.peak_footprint, int(footprint.max()))
+            self.footprint = int(footprint[-1])
+        self.allocations += int(allocations.sum())
+        self.requested_bytes += int(sizes[allocations].sum())
+
+    def _replay(self, sizes, allocations, stack_ids, addresses) -> np.ndarray:
+        """Footprint change of every event"""
+        raise NotImplementedError
+
+    def details(self) -> list[str]:
+        return []
+
+
+class SizeClassModel(AllocatorModel):
+    """Rounds requests up to size classes served from free lists, larger ones are mapped in pages"""
+
+    def __init__(self, classes: np.ndarray):
+        super().__init__()
+        self.classes = classes
+        self.name = f"size classes ({len(classes)} up to {int(classes[-1])} bytes)"
+        self.free_lists = FreeLists(len(classes))
+
+    def _replay(self, sizes, allocations, stack_ids, addresses) -> np.ndarray:
+        size_classes = np.searchsorted(self.classes, sizes)
+        small = size_classes < len(self.classes)
+        rounded = np.where(small, self.classes[np.minimum(size_classes, len(self.classes) - 1)], round_up(sizes, PAGE_SIZE))
+        self.allocated_bytes += int(rounded[allocations].sum())
+
+        deltas = np.zeros(len(sizes), dtype=np.int64)
+        signs = np.where(allocations, 1, -1)
+        new_objects = self.free_lists.apply(size_classes[small], signs[small])
+        deltas[np.flatnonzero(small)[new_objects]] = rounded[small][new_objects]
+        self.reused += int((allocations[small] & ~new_objects).sum())
+        self.longest_free_list = int(self.free_lists.longest.max())
+
+        # Pages of large allocations go back to the system on free
+        deltas[~small] = signs[~small] * rounded[~small]
+        return deltas
+
+    def details(self) -> list[str]:
+        busiest = np.argsort(-self.free_lists.peak, kind="stable")[:5]
+        return [
+            f"{int(self.classes[i])} bytes: {int(self.free_lists.peak[i])} objects at most, "
+            f"free list up to {int(self.free_lists.longest[i])}"
+            for i in busiest.tolist()
+            if self.free_lists.peak[i]
+        ]
+
+
+class BumpArenaModel(AllocatorModel):
+    """
+    Bumps allocations through fixed size arenas, an arena is handed back once
+    the bump pointer has moved on and all its allocations are freed.
+    Requests of half an arena or more are mapped in pages. Allocations that
+    straddle an arena boundary are counted in the arena they end in.
+    """
+
+    DIRECT: int = np.iinfo(np.uint32).max  # Arena id of page mapped allocations
+
+    def __init__(self, arena_size: int):
+        super().__init__()
+        self.arena_size = arena_size
+        self.name = f"bump arenas ({arena_size // 1024} KiB)"
+        self.cursor = 0  # Bytes bumped through all arenas
+        self.arenas = PointerTable()  # Address -> arena of every live allocation
+        self.arena_allocations = np.zeros(1, dtype=np.int64)
+        self.arena_frees = np.zeros(1, dtype=np.int64)
+        self.released = np.zeros(1, dtype=bool)
+
+    def _grow(self, arenas: int):
+        if arenas <= len(self.arena_allocations):
+            return
+        capacity = max(arenas, 2 * len(self.arena_allocations))
+        for name in ["arena_allocations", "arena_frees", "released"]:
+            array = getattr(self, name)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[: len(array)] = array
+            setattr(self, name, grown)
+
+    def _replay(self, sizes, allocations, stack_ids, addresses) -> np.ndarray:
+        count = len(sizes)
+        deltas = np.zeros(count, dtype=np.int64)
+        if not count:
+            return deltas
+
+        direct = sizes >= self.arena_size // 2
+        padded = np.where(direct, round_up(sizes, PAGE_SIZE), round_up(np.maximum(sizes, 1), ALIGNMENT))
+        self.allocated_bytes += int(padded[allocations].sum())
+
+        # Arena of every bumped allocation, from where it ends
+        bumped = allocations & ~direct
+        ends = self.cursor + np.cumsum(np.where(bumped, padded, 0))
+        arenas = np.where(bumped, (ends - 1) // self.arena_size, self.DIRECT)
+        current_before = (self.cursor - 1) // self.arena_size if self.cursor else -1
+        self.cursor = int(ends[-1])
+        current = max(current_before, (self.cursor - 1) // self.arena_size)
+        self._grow(current + 1)
+
+        _, _, freed_arenas, _, _ = self.arenas.apply(addresses, allocations, sizes, arenas, 0)
+        arenas = np.where(allocations, arenas, freed_arenas)
+        tracked = arenas != self.DIRECT
+        tracked &= allocations | (freed_arenas >= 0)
+
+        # An arena is opened by its first allocation, the bump pointer moves one arena at a time
+        latest = np.maximum.accumulate(np.where(bumped, arenas, current_before))
+        opened = bumped & (arenas > np.r_[current_before, latest[:-1]])
+        deltas[opened] += self.arena_size
+
+        # Page mapped allocations come and go with their pages
+        mapped = direct & (allocations | (freed_arenas == self.DIRECT))
+        deltas[mapped] += np.where(allocations[mapped], padded[mapped], -padded[mapped])
+
+        # Closed arenas are released by their last free, or when closed if already empty
+        arena_events = np.flatnonzero(tracked)
+        arena_ids = arenas[arena_events]
+        np.add.at(self.arena_allocations, arena_ids[allocations[arena_events]], 1)
+        frees = arena_events[~allocations[arena_events]]
+        free_arenas = arenas[frees]
+
+        order = np.argsort(free_arenas, kind="stable")
+        sorted_arenas = free_arenas[order]
+        starts = np.flatnonzero(np.r_[True, sorted_arenas[1:] != sorted_arenas[:-1]]) if len(order) else np.zeros(0, dtype=np.int64)
+        running = np.ones(len(order), dtype=np.int64)
+        if len(order):
+            cumulative = np.cumsum(running)
+            segments = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(order)]))
+            running = cumulative - (cumulative[starts] - 1)[segments] + self.arena_frees[sorted_arenas]
+        np.add.at(self.arena_frees, free_arenas, 1)
+
+        # First allocation after each arena was closed
+        closing = np.full(current + 1, -1, dtype=np.int64)
+        closed = opened & (arenas > 0)
+        closing[arenas[closed] - 1] = np.flatnonzero(closed)
+        closing_known = np.arange(current + 1) < current
+
+        emptied = (running == self.arena_allocations[sorted_arenas]) & closing_known[sorted_arenas] & ~self.released[sorted_arenas]
+        release_at = np.maximum(frees[order][emptied], closing[sorted_arenas[emptied]])
+        self.released[sorted_arenas[emptied]] = True
+
+        # Empty arenas closed in this block with no free in it
+        empty_closed = np.flatnonzero(
+            (closing >= 0) & closing_known & ~self.released[: current + 1]
+            & (self.arena_allocations[: current + 1] == self.arena_frees[: current + 1])
+        )
+        self.released[empty_closed] = True
+        release_at = np.r_[release_at, closing[empty_closed]].astype(np.int64)
+        np.subtract.at(deltas, release_at, self.arena_size)
+
+        return deltas
+
+    def details(self) -> list[str]:
+        opened = (self.cursor + self.arena_size - 1) // self.arena_size
+        return [f"{opened} arenas opened, {int(self.released.sum())} released"]
+
+
+class SitePoolModel(AllocatorModel):
+    """
+    Serves the call stacks with the most allocations from pools of objects
+    sized to their largest request, everything else goes to size classes
+    """
+
+    def __init__(self, pool_stacks: np.ndarray, pool_sizes: np.ndarray, classes: np.ndarray):
+        super().__init__()
+        self.name = f"site pools ({len(pool_stacks)} stacks) + size classes"
+        order = np.argsort(pool_stacks)
+        self.pool_stacks = pool_stacks[order]
+        self.pool_sizes = round_up(pool_sizes[order], ALIGNMENT)
+        self.free_lists = FreeLists(len(pool_stacks))
+        self.fallback = SizeClassModel(classes)
+        self.pool_bytes = 0
+        self.pool_reused = 0
+
+    def _replay(self, sizes, allocations, stack_ids, addresses) -> np.ndarray:
+        deltas = np.zeros(len(sizes), dtype=np.int64)
+        pools = np.minimum(np.searchsorted(self.pool_stacks, stack_ids), max(len(self.pool_stacks) - 1, 0))
+        pooled = np.zeros(len(sizes), dtype=bool)
+        if len(self.pool_stacks):
+            pooled = self.pool_stacks[pools] == stack_ids
+
+        rest = ~pooled
+        deltas[rest] = self.fallback._replay(sizes[rest], allocations[rest], stack_ids[rest], addresses[rest])
+
+        signs = np.where(allocations, 1, -1)
+        new_objects = self.free_lists.apply(pools[pooled], signs[pooled])
+        object_sizes = self.pool_sizes[pools[pooled]]
+        deltas[np.flatnonzero(pooled)[new_objects]] = object_sizes[new_objects]
+
+        pooled_allocations = allocations[pooled]
+        self.pool_bytes += int(object_sizes[pooled_allocations].sum())
+        self.pool_reused += int((pooled_allocations & ~new_objects).sum())
+        self.allocated_bytes = self.fallback.allocated_bytes + self.pool_bytes
+        self.reused = self.fallback.reused + self.pool_reused
+        self.longest_free_list = max(self.fallback.longest_free_list, int(self.free_lists.longest.max(initial=0)))
+        return deltas
+
+    def details(self) -> list[str]:
+        objects = int(self.free_lists.peak.sum())
+        return [f"{objects} pooled objects at most, {int((self.free_lists.peak * self.pool_sizes).sum())} bytes"]
+
+
+def hot_stacks(reader: CaptureReader, pid: int, count: int) -> tuple[np.ndarray, np.ndarray]:
+    """The count stacks with the most allocations and their largest request"""
+    stacks = max(len(reader.stacks.get(pid, [])), 1)
+    allocations = np.zeros(stacks, dtype=np.int64)
+    largest = np.zeros(stacks, dtype=np.int64)
+
+    for _, events in reader.events(pid=pid):
+        events = events[np.isin(events["type"], ALLOCATION_TYPES)]
+        stack_ids = events["stack_id"]
+        np.add.at(allocations, stack_ids, 1)
+        np.maximum.at(largest, stack_ids, events["size"].astype(np.int64))
+
+    hottest = np.argsort(-allocations, kind="stable")[:count]
+    hottest = hottest[allocations[hottest] > 0]
+    return hottest, largest[hottest]
+
+
+class Replayer:
+    """Streams the events of one process in a capture through allocator models"""
+
+    def __init__(self, reader: CaptureReader, pid: int, models: list[AllocatorModel]):
+        self.reader = reader
+        self.pid = pid
+        self.models = models
+        self.events = 0
+        self.live_requested = 0
+        self.peak_requested = 0
+
+    def run(self) -> float:
+        """Replay every event, returns the seconds it took"""
+        start = time.perf_counter()
+        for _, events in self.reader.events(pid=self.pid):
+            # Frees of allocations made before the capture started can't be replayed
+            events = events[events["stack_id"] >= 0]
+            allocations = np.isin(events["type"], ALLOCATION_TYPES)
+            sizes = events["size"].astype(np.int64)
+
+            live = self.live_requested + np.cumsum(np.where(allocations, sizes, -sizes))
+            if len(live):
+                self.peak_requested = max(self.peak_requested, int(live.max()))
+                self.live_requested = int(live[-1])
+
+            for model in self.models:
+                model.replay(sizes, allocations, events["stack_id"], events["address"])
+            self.events += len(events)
+
+        return time.perf_counter() - start
+
+    def print_report(self, seconds: float):
+        print(f"Replayed {self.events} events of pid {self.pid} in {seconds:.2f}s ({self.events / max(seconds, 1e-9) / 10**6:.2f}M events/s)")
+        print(f"Peak requested: {self.peak_requested} bytes\n")
+
+        for model in self.models:
+            fragmentation = 1 - model.requested_bytes / model.allocated_bytes if model.allocated_bytes else 0
+            overhead = model.peak_footprint / self.peak_requested if self.peak_requested else 0
+            reuse = model.reused / model.allocations if model.allocations else 0
+            print(f"{model.name}:")
+            print(f"  - Peak footprint: {model.peak_footprint} bytes ({overhead:.2f}x the peak requested)")
+            print(f"  - Internal fragmentation: {100 * fragmentation:.1f}%")
+            print(f"  - Free list reuse: {100 * reuse:.1f}% of allocations, longest free list {model.longest_free_list}")
+            for detail in model.details():
+                print(f"  - {detail}")
+            print()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a capture through allocator models and compare their footprint.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("file", help="Capture file written with --capture-file.")
+    parser.add_argument("-p", "--pid", type=int, default=None, help="Process to replay, defaults to the first one in the capture.")
+    parser.add_argument("-c", "--classes", type=int, nargs="+", default=None, help="Size classes in bytes, defaults to jemalloc-like classes up to 14 KiB.")
+    parser.add_argument("-as", "--arena-size", type=int, default=1 << 20, help="Arena size in bytes of the bump arena model.")
+    parser.add_argument("-ps", "--pool-stacks", type=int, default=16, help="Number of call stacks served from their own pool.")
+    args = parser.parse_args()
+
+    try:
+        reader = CaptureReader(args.file)
+    except (OSError, ValueError) as e:
+        print(f"Could not read capture: {e}")
+        exit(1)
+
+    pids = np.unique(reader.event_blocks()["pid"]).tolist()
+    if not pids:
+        print("The capture has no events")
+        exit(1)
+    pid = pids[0] if args.pid is None else args.pid
+
+    classes = default_size_classes() if args.classes is None else np.unique(np.array(args.classes, dtype=np.int64))
+    pool_stacks, pool_sizes = hot_stacks(reader, pid, args.pool_stacks)
+    models = [
+        SizeClassModel(classes),
+        BumpArenaModel(args.arena_size),
+        SitePoolModel(pool_stacks, pool_sizes, classes),
+    ]
+
+    replayer = Replayer(reader, pid, models)
+    replayer.print_report(replayer.run())
+    reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+Samples what the memory of a target costs the system, next to the bytes it
+asked for. /proc/<pid>/statm is read on every sample, smaps_rollup, which walks
+the page tables of the target under its mmap lock, on every ROLLUP_EVERY-th.
+Both stay open and are read again with pread at offset 0, which has the kernel
+generate them anew, so a sample is a couple of system calls. With
+--allocator-stats the hooks copy glibc's mallinfo2 into the ring header when
+asked to, see hook_lib/allocator.h.
+
+The gap between RSS and the requested live bytes is what fragmentation,
+allocator caches and everything besides the heap cost. Allocations made before
+the hooks were loaded are not known, so how the gap changes says more than its
+size.
+"""
+
+import os
+import re
+import resource
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from ring_layout import ALLOCATOR_OFFSET
+
+PAGE_SIZE = resource.getpagesize()
+
+# Matches struct AllocatorHeader in hook_lib/allocator.h
+ALLOCATOR_DTYPE = np.dtype(
+    [
+        ("requested", "<u4"),
+        ("served", "<u4"),
+        ("sequence", "<u8"),
+        ("time", "<u8"),
+        ("arena", "<u8"),
+        ("mmapped", "<u8"),
+        ("in_use", "<u8"),
+        ("free", "<u8"),
+        ("releasable", "<u8"),
+    ]
+)
+ALLOCATOR_FIELDS: list[str] = ["arena", "mmapped", "in_use", "free", "releasable"]
+
+# One sample, kept in ResidentSeries and written to captures
+RESIDENT_DTYPE = np.dtype(
+    [
+        ("time", "<u8"),  # Nanoseconds since the epoch, the clock of chrono timestamps
+        ("live", "<i8"),  # Requested bytes alive, of the allocations the hooks saw
+        ("rss", "<u8"),
+        ("file", "<u8"),  # Resident pages backed by files or shared memory, from statm
+        ("pss", "<u8"),  # The rest is from the last read of smaps_rollup
+        ("anonymous", "<u8"),
+        ("swap", "<u8"),
+        ("anon_huge", "<u8"),
+        ("arena", "<u8"),  # The rest is from the allocator, 0 without --allocator-stats
+        ("mmapped", "<u8"),
+        ("in_use", "<u8"),
+        ("free", "<u8"),
+        ("releasable", "<u8"),
+    ]
+)
+
+SMAPS_FIELDS: dict[bytes, str] = {
+    b"Pss": "pss",
+    b"Anonymous": "anonymous",
+    b"Swap": "swap",
+    b"AnonHugePages": "anon_huge",
+}
+SMAPS_LINE = re.compile(rb"^(" + b"|".join(SMAPS_FIELDS) + rb"):\s+(\d+) kB", re.MULTILINE)
+
+
+@dataclass
+class ResidentReport:
+    seconds: float = 0  # Between the first and the last sample
+    rss: int = 0
+    file: int = 0
+    pss: int = 0
+    anonymous: int = 0
+    swap: int = 0
+    live: int = 0
+    gap: int = 0  # RSS not explained by the requested live bytes
+    gap_start: int = 0
+    gap_max: int = 0
+    arena: int = 0
+    mmapped: int = 0
+    in_use: int = 0
+    free: int = 0
+    releasable: int = 0
+
+    @property
+    def gap_growth(self) -> int:
+        return self.gap - self.gap_start
+
+    @property
+    def heap(self) -> int:
+        """Bytes the allocator holds, resident or not"""
+        return self.arena + self.mmapped
+
+    def merge(self, other: "ResidentReport"):
+        # The largest gaps of the processes need not have been at the same time
+        self.seconds = max(self.seconds, other.seconds)
+        for name in ["rss", "file", "pss", "anonymous", "swap", "live", "gap", "gap_start", "gap_max"]:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for name in ALLOCATOR_FIELDS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+
+class ResidentSeries:
+    """The last sample of every second in a ring array, the oldest second is overwritten"""
+
+    def __init__(self, seconds: float = 1, slots: int = 3600):
+        self.seconds = seconds
+        self.slots = slots
+        self.samples = np.zeros(slots, dtype=RESIDENT_DTYPE)
+        self.intervals = np.full(slots, -1, dtype=np.int64)
+        self.first: np.ndarray | None = None
+        self.last: np.ndarray | None = None
+        self.gap_max = 0
+
+    def add(self, sample: np.ndarray):
+        interval = int(sample["time"] / 10**9 // self.seconds)
+        slot = interval % self.slots
+        self.intervals[slot] = interval
+        self.samples[slot] = sample
+
+        if self.first is None:
+            self.first = sample
+        self.last = sample
+        self.gap_max = max(self.gap_max, gap(sample))
+
+    def window(self, end: float, count: int) -> tuple[np.ndarray, np.ndarray]:
+        """Start times and samples of the count intervals up to the one holding end, carried forward"""
+        count = min(count, self.slots)
+        last = int(end // self.seconds)
+        intervals = np.arange(last - count + 1, last + 1)
+        slots = intervals % self.slots
+        valid = self.intervals[slots] == intervals
+
+        latest = np.maximum.accumulate(np.where(valid, np.arange(count), -1))
+        samples = np.zeros(count, dtype=RESIDENT_DTYPE)
+        seen = latest >= 0
+        samples[seen] = self.samples[slots[latest[seen]]]
+        return intervals * self.seconds, samples
+
+    def report(self) -> ResidentReport | None:
+        if self.first is None:
+            return None
+        last = self.last
+        return ResidentReport(
+            (int(last["time"]) - int(self.first["time"])) / 10**9,
+            int(last["rss"]),
+            int(last["file"]),
+            int(last["pss"]),
+            int(last["anonymous"]),
+            int(last["swap"]),
+            int(last["live"]),
+            gap(last),
+            gap(self.first),
+            self.gap_max,
+            *(int(last[name]) for name in ALLOCATOR_FIELDS),
+        )
+
+
+def gap(sample: np.ndarray) -> int:
+    return int(sample["rss"]) - int(sample["live"])
+
+
+class ResidentSampler:
+    """
+    Samples process pid. mem is the mapping of its ring, to ask the hooks for
+    the allocator's counters, None without --allocator-stats.
+    """
+
+    ROLLUP_EVERY: int = 10
+
+    def __init__(self, pid: int, mem=None):
+        self.pid = pid
+        self.mem = mem
+        self.samples = 0
+        self.statm_fd: int | None = None
+        self.rollup_fd: int | None = None
+        self.last = np.zeros((), dtype=RESIDENT_DTYPE)
+
+    def __enter__(self):
+        try:
+            self.statm_fd = os.open(f"/proc/{self.pid}/statm", os.O_RDONLY)
+        except OSError as e:
+            print(f"Failed to open statm of process {self.pid}: {e}")
+            exit(1)
+        # Linux 4.14 and later
+        try:
+            self.rollup_fd = os.open(f"/proc/{self.pid}/smaps_rollup", os.O_RDONLY)
+        except OSError:
+            self.rollup_fd = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for fd in (self.statm_fd, self.rollup_fd):
+            if fd is not None:
+                os.close(fd)
+
+    def sample(self, live: int) -> np.ndarray | None:
+        """A sample of the process now, None once it has exited"""
+        sample = self.last.copy()
+        try:
+            # size resident shared text lib data dt, in pages
+            statm = os.pread(self.statm_fd, 256, 0).split()
+            if self.rollup_fd is not None and self.samples % self.ROLLUP_EVERY == 0:
+                for name, kilobytes in SMAPS_LINE.findall(os.pread(self.rollup_fd, 4096, 0)):
+                    sample[SMAPS_FIELDS[name]] = int(kilobytes) * 1024
+        except OSError:
+            return None
+
+        sample["time"] = time.time_ns()
+        sample["live"] = live
+        sample["rss"] = int(statm[1]) * PAGE_SIZE
+        sample["file"] = int(statm[2]) * PAGE_SIZE
+        if self.mem is not None:
+            self._read_allocator(sample)
+
+        self.samples += 1
+        self.last = sample
+        return sample
+
+    def _read_allocator(self, sample: np.ndarray):
+        """Copy what the hooks answered to the last request and ask again"""
+        end = ALLOCATOR_OFFSET + ALLOCATOR_DTYPE.itemsize
+        header = np.frombuffer(self.mem[ALLOCATOR_OFFSET:end], dtype=ALLOCATOR_DTYPE)[0]
+        sequence = int.from_bytes(self.mem[ALLOCATOR_OFFSET + 8 : ALLOCATOR_OFFSET + 16], byteorder="little")
+
+        # A copy made while the hooks wrote is dropped, the previous counters are kept
+        if not sequence & 1 and int(header["sequence"]) == sequence and header["time"]:
+            for name in ALLOCATOR_FIELDS:
+                sample[name] = header[name]
+
+        requested = (int(header["requested"]) + 1) & 0xFFFFFFFF
+        self.mem[ALLOCATOR_OFFSET : ALLOCATOR_OFFSET + 4] = requested.to_bytes(4, byteorder="little")
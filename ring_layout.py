@@ -0,0 +1,24 @@
+"""
+Names of the hooks' shared memory objects and offsets of the ring header. The
+offsets are read from hook_lib/ring_layout.h, so the hooks, the profiler and
+the stress targets can't disagree about them.
+"""
+
+import os
+import re
+
+# Shared memory objects of the hooks in process pid are named MOUNT_PREFIX<pid>
+MOUNT_PREFIX: str = "/dev/shm/mem_hook_"
+
+LAYOUT_PATH: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hook_lib", "ring_layout.h")
+
+
+def read_layout(path: str = LAYOUT_PATH) -> dict[str, int]:
+    with open(path, "r") as f:
+        return {name: int(value) for name, value in re.findall(r"constexpr uint32_t (\w+)\{(\d+)\}", f.read())}
+
+
+_layout = read_layout()
+HEAD_SIZE: int = _layout["HEAD_SIZE"]
+OVERHEAD_OFFSET: int = _layout["OVERHEAD_OFFSET"]
+ALLOCATOR_OFFSET: int = _layout["ALLOCATOR_OFFSET"]
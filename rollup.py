@@ -0,0 +1,168 @@
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+# Aggregates kept per interval, see RollupSeries
+FIELDS: list[str] = [
+    "alloc_bytes",
+    "alloc_count",
+    "free_bytes",
+    "free_count",
+    "live_bytes",  # At the end of the interval
+    "live_min",
+    "live_max",
+    "dropped",
+]
+FIELD = {name: index for index, name in enumerate(FIELDS)}
+
+# Interval length (in seconds) and number of intervals kept per resolution
+RESOLUTIONS: list[tuple[float, int]] = [
+    (1, 3600),  # 1s for an hour
+    (60, 7 * 24 * 60),  # 1min for a week
+]
+
+
+@dataclass
+class RollupSummary:
+    seconds: float
+    alloc_bytes: int = 0
+    alloc_count: int = 0
+    free_bytes: int = 0
+    free_count: int = 0
+    live_min: int = 0
+    live_max: int = 0
+    dropped: int = 0
+
+    def merge(self, other: "RollupSummary"):
+        # Minimum and maximum of the summed heaps are approximated by the sums
+        self.alloc_bytes += other.alloc_bytes
+        self.alloc_count += other.alloc_count
+        self.free_bytes += other.free_bytes
+        self.free_count += other.free_count
+        self.live_min += other.live_min
+        self.live_max += other.live_max
+        self.dropped += other.dropped
+
+
+class RollupSeries:
+    """Aggregates of fixed length intervals in ring arrays, the oldest interval is overwritten"""
+
+    def __init__(self, seconds: float, slots: int):
+        self.seconds = seconds
+        self.slots = slots
+        self.data = np.zeros((len(FIELDS), slots), dtype=np.int64)
+        self.intervals = np.full(slots, -1, dtype=np.int64)  # Interval held by every slot
+
+    def add(self, now: float, values: np.ndarray, live_start: int):
+        interval = int(now // self.seconds)
+        slot = interval % self.slots
+
+        if self.intervals[slot] != interval:
+            self.intervals[slot] = interval
+            self.data[:, slot] = 0
+            self.data[FIELD["live_min"], slot] = live_start
+            self.data[FIELD["live_max"], slot] = live_start
+
+        column = self.data[:, slot]
+        column[FIELD["alloc_bytes"]] += values[FIELD["alloc_bytes"]]
+        column[FIELD["alloc_count"]] += values[FIELD["alloc_count"]]
+        column[FIELD["free_bytes"]] += values[FIELD["free_bytes"]]
+        column[FIELD["free_count"]] += values[FIELD["free_count"]]
+        column[FIELD["dropped"]] += values[FIELD["dropped"]]
+        column[FIELD["live_bytes"]] = values[FIELD["live_bytes"]]
+        column[FIELD["live_min"]] = min(column[FIELD["live_min"]], values[FIELD["live_min"]])
+        column[FIELD["live_max"]] = max(column[FIELD["live_max"]], values[FIELD["live_max"]])
+
+    def window(self, end: float, count: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Start times and aggregates of the count intervals up to the one holding
+        end. Intervals without events carry the live heap forward.
+        """
+        count = min(count, self.slots)
+        last = int(end // self.seconds)
+        intervals = np.arange(last - count + 1, last + 1)
+        slots = intervals % self.slots
+        valid = self.intervals[slots] == intervals
+
+        data = np.where(valid, self.data[:, slots], 0)
+        # Index of the latest interval with events at or before every interval
+        latest = np.maximum.accumulate(np.where(valid, np.arange(count), -1))
+        carried = ~valid & (latest >= 0)
+        live = data[FIELD["live_bytes"], latest[carried]]
+        for name in ["live_bytes", "live_min", "live_max"]:
+            data[FIELD[name], carried] = live
+
+        return intervals * self.seconds, data
+
+
+class Rollup:
+    """
+    Heap activity of one process at several resolutions, see RESOLUTIONS.
+    Memory use is fixed, however long the process is profiled.
+    """
+
+    def __init__(self):
+        self.series = [RollupSeries(seconds, slots) for seconds, slots in RESOLUTIONS]
+        self.live_bytes = 0
+
+    def nbytes(self) -> int:
+        return sum(series.data.nbytes + series.intervals.nbytes for series in self.series)
+
+    def add_batch(self, now: float, allocated: np.ndarray, freed: np.ndarray, deltas: np.ndarray):
+        """
+        Add a batch of events made at now. allocated and freed hold the sizes of
+        the allocations and frees, deltas the heap size change of every event in order.
+        """
+        live_start = self.live_bytes
+        live = live_start + np.cumsum(deltas)
+        self.live_bytes = int(live[-1]) if len(live) else live_start
+
+        values = np.zeros(len(FIELDS), dtype=np.int64)
+        values[FIELD["alloc_bytes"]] = allocated.sum()
+        values[FIELD["alloc_count"]] = len(allocated)
+        values[FIELD["free_bytes"]] = freed.sum()
+        values[FIELD["free_count"]] = len(freed)
+        values[FIELD["live_bytes"]] = self.live_bytes
+        values[FIELD["live_min"]] = min(live_start, live.min()) if len(live) else live_start
+        values[FIELD["live_max"]] = max(live_start, live.max()) if len(live) else live_start
+
+        for series in self.series:
+            series.add(now, values, live_start)
+
+    def add_dropped(self, now: float, dropped: int):
+        values = np.zeros(len(FIELDS), dtype=np.int64)
+        values[FIELD["dropped"]] = dropped
+        for name in ["live_bytes", "live_min", "live_max"]:
+            values[FIELD[name]] = self.live_bytes
+
+        for series in self.series:
+            series.add(now, values, self.live_bytes)
+
+    def summary(self, seconds: float, now: float | None = None) -> RollupSummary:
+        """Totals over the last seconds, from the finest resolution that covers them"""
+        now = time.time() if now is None else now
+        series = next(
+            (series for series in self.series if series.seconds * series.slots >= seconds),
+            self.series[-1],
+        )
+        _, data = series.window(now, max(1, int(seconds // series.seconds)))
+
+        return RollupSummary(
+            seconds,
+            int(data[FIELD["alloc_bytes"]].sum()),
+            int(data[FIELD["alloc_count"]].sum()),
+            int(data[FIELD["free_bytes"]].sum()),
+            int(data[FIELD["free_count"]].sum()),
+            int(data[FIELD["live_min"]].min()),
+            int(data[FIELD["live_max"]].max()),
+            int(data[FIELD["dropped"]].sum()),
+        )
+
+
+def combine(rollups: list[Rollup], level: int, end: float, count: int) -> tuple[np.ndarray, np.ndarray]:
+    """Window of several processes at the same resolution, summed per interval"""
+    times, data = rollups[0].series[level].window(end, count)
+    for rollup in rollups[1:]:
+        data = data + rollup.series[level].window(end, count)[1]
+    return times, data
@@ -1,17 +1,52 @@
 import mmap
 import os
-from threading import Timer
+import socket
 import time
 from collections import defaultdict
 from dataclasses import dataclass
-from enum import IntEnum
+from enum import IntEnum, IntFlag
+
+import numpy as np
+
+from capture import CaptureWriter
+from churn import ChurnReport, ChurnTable, lifetime_label
+from leaks import AGE_BINS, AgeIndex, LeakReport
+from metrics import Metrics
+from overhead import OverheadCounters, OverheadReport
+from pointer_table import TOMBSTONE, PointerTable
+from resident import ResidentReport, ResidentSampler, ResidentSeries
+from ring_layout import HEAD_SIZE, MOUNT_PREFIX
+from rollup import Rollup, RollupSummary
+from stacks import SizeReport, StackTable, size_class_label
+from threads import NO_CPU, ThreadReport, ThreadTable
 
 # Constants
-HEAD_SIZE: int = 12
+MAX_BACKTRACES: int = 20
 TRACE_SIZE: int = (
-    32 + 8 * 20
+    32 + 8 * MAX_BACKTRACES
 )  # Accounts for inner padding, currently no padding between allocations
 
+# Shown when a phase takes more than half of the time in the hooks
+OVERHEAD_HINTS: dict[str, str] = {
+    "backtrace": "Most of it is spent on backtraces, a lower --max-backtraces or --backtrace-method fast is cheaper",
+    "timestamp": "Most of it is spent on timestamps, try another --timestamp-method",
+    "lock": "Most of it is spent waiting for the ring's mutex of --thread-safe",
+}
+
+# Layout of a Trace record in the ring, matches struct Trace in hook_lib/shared_buffer.h
+TRACE_DTYPE = np.dtype(
+    [
+        ("address", "<u8"),
+        ("time", "<u8"),
+        ("size", "<u4"),
+        ("backtrace_size", "<u4"),
+        ("type", "<u2"),
+        ("cpu", "<u2"),
+        ("tid", "<u4"),
+        ("backtraces", "<u8", (MAX_BACKTRACES,)),
+    ]
+)
+
 
 class TraceType(IntEnum):
     MALLOC = 0
@@ -24,9 +59,20 @@ class TraceType(IntEnum):
     DELETE_NO_THROW = 7
 
 
-class GraphType(IntEnum):
-    ALLOCATION = 0
-    DEALLOCATION = 1
+class BufferFlags(IntFlag):
+    """How the hooks backed the ring, matches enum BufferFlags in hook_lib/shared_buffer.h"""
+
+    PREFAULTED = 1
+    HUGETLBFS = 2
+    TRANSPARENT_HUGE = 4
+
+
+ALLOCATION_TYPES: list[TraceType] = [
+    TraceType.MALLOC,
+    TraceType.NEW,
+    TraceType.NEW_ARRAY,
+    TraceType.NEW_NO_THROW,
+]
 
 
 class Trace:
@@ -38,6 +84,7 @@ class Trace:
         backtrace_size: int,
         type: TraceType,
         backtraces: list[int],
+        tid: int = 0,
     ):
         self.address = address
         self.size = size
@@ -45,102 +92,11 @@ class Trace:
         self.backtrace_size = backtrace_size
         self.type = type
         self.backtraces = backtraces
+        self.tid = tid
 
     def __str__(self):
         addresses = [hex(value) for value in self.backtraces]
-        return f"ALLOCTATION: Address: {hex(self.address)}, Size: {self.size}, Time: {self.time}, Backtrace size: {self.backtrace_size}, Backtrace: {addresses}"
-
-
-class Graph:
-    WINDOW_WIDTH = 800
-    WINDOW_HEIGHT = 600
-
-    def __init__(self, time_window: int):
-        import matplotlib
-        import matplotlib.pyplot as plt
-        import matplotlib.ticker as ticker
-
-        self.time_window = time_window
-        matplotlib.use("TkAgg")  # Use backend that supports scrolling
-        self.x_data, self.y_data = [], []
-        self.allocs: list[tuple[float, int]] = []
-        self.frees: list[tuple[float, int]] = []
-
-        self.fig, self.ax = plt.subplots(
-            figsize=(self.WINDOW_WIDTH / 100, self.WINDOW_HEIGHT / 100), dpi=100
-        )
-        (self.line,) = self.ax.plot([], [])
-        self.alloc_scatter = self.ax.scatter(
-            [], [], marker="^", color="g", label="alloc", s=25
-        )
-        self.free_scatter = self.ax.scatter(
-            [], [], marker="v", color="r", label="free", s=25
-        )
-        self.alloc_scatter.set_zorder(999)
-        self.free_scatter.set_zorder(999)
-        self.mem_label = self.fig.text(0.15, 0.90, "", fontsize=12)
-
-        self.redraw = True
-        self.autoscroll = False
-
-        self.ax.set_navigate(True)  # Enable panning and zooming
-        self.ax.yaxis.set_major_formatter(ticker.FuncFormatter(self._size_format))
-        plt.ion()  # Set interactive mode
-        plt.legend()
-        plt.show(block=False)
-
-    def update(self):
-        # Scroll the x-axis dynamically
-        min_x = 0
-        max_x = 0
-
-        if len(self.x_data) > 1:
-            min_x = min(self.x_data)
-            max_x = max(self.x_data)
-
-        if self.redraw:
-            self.line.set_data(self.x_data, self.y_data)
-            self.ax.relim()
-            self.ax.autoscale_view()
-
-            if self.allocs:
-                self.alloc_scatter.set_offsets(self.allocs)
-            if self.frees:
-                self.free_scatter.set_offsets(self.frees)
-
-            if self.autoscroll:
-                self.ax.set_xlim(max(min_x, max_x - self.time_window), max_x)
-
-            if self.y_data:
-                self.mem_label.set_text(f"Memory: {self._get_size(self.y_data[-1])}")
-
-            self.fig.canvas.draw()  # Redraw figure
-            self.redraw = False
-
-        self.autoscroll = max_x <= self.ax.get_xlim()[1]
-        self.fig.canvas.flush_events()  # Process GUI events
-
-    def add_event(self, time: float, size: int, operation: GraphType):
-        self.x_data.append(time)
-        self.y_data.append(size)
-
-        match operation:
-            case GraphType.ALLOCATION:
-                self.allocs.append((time, size))
-            case GraphType.DEALLOCATION:
-                self.frees.append((time, size))
-
-        self.redraw = True
-
-    def _size_format(self, x, pos):
-        return self._get_size(x)
-
-    def _get_size(self, num):
-        for unit in ["B", "KB", "MB", "GB", "TB"]:
-            if num < 1024.0:
-                return f"{num:.1f} {unit}"
-            num /= 1024.0
-        return f"{num:.1f} PB"
+        return f"ALLOCTATION: Address: {hex(self.address)}, Size: {self.size}, Time: {self.time}, Thread: {self.tid}, Backtrace size: {self.backtrace_size}, Backtrace: {addresses}"
 
 
 @dataclass
@@ -149,30 +105,48 @@ class FunctionStatistics:
     sizes: int = 0  # Sizes of the allocations/frees
 
 
+def process_start(pid: int) -> float:
+    """Time process pid started, in seconds since the epoch, to the clock tick"""
+    with open(f"/proc/{pid}/stat", "r") as f:
+        # The command name in parentheses may hold spaces, starttime is the 22nd field
+        fields = f.read().rsplit(")", 1)[1].split()
+    since_boot = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    return time.time() - (time.clock_gettime(time.CLOCK_BOOTTIME) - since_boot)
+
+
+def print_header(header: str, file=None):
+    """Title of a report section, shared by every report"""
+    width = 32
+    print("=" * width, file=file)
+    print(header.center(width), file=file)
+    print("=" * width + "\n", file=file)
+
+
 # Memtracker does not distingish between the different types of allocations/frees
 # e.g. it will treat malloc/new/new[] as simply an allocation. Same for free/delete/delete[]
 # The information will still be available
 class Memtracker:
-    def __init__(self, log_file: str | None):
+    ACTIVITY_SECONDS: float = 60  # Period summarized by the periodic report
+
+    def __init__(self, log_file: str | None, pid: int | None = None):
         self.log_file = log_file
-        self.allocations = {}
+        self.pid = pid
+        self.allocations = PointerTable()
         self.total_allocation_size: int = 0
         self.total_allocations = 0
-        self.frees = {}
         self.total_free_size = 0
         self.total_frees = 0
         self.time_start = time.time()
+        # Every event is only kept when it will be written to the log file
         self.all_allocations: list[Trace] = []
         self.all_frees: list[Trace] = []
 
-        self.print_timer: Timer | None = None
-
-        self.malloc_overflow = 0
-        self.free_overflow = 0
+        self.dropped_events = 0
 
         # Saves the number and sizes of allocation per function (address)
         # from its backtrace
         # Key is address, value is list containing the total size and total allocations
+        # Derived from the stacks by update_function_statistics when reporting
         self.current_function_allocations: dict[int, FunctionStatistics] = defaultdict(
             lambda: FunctionStatistics()
         )
@@ -186,84 +160,150 @@ class Memtracker:
             lambda: FunctionStatistics()
         )
 
-        self.graph: Graph | None = None
-
-    def do_event_loop(self):
-        if self.graph is not None:
-            self.graph.update()
-
-    def add_allocation(self, trace: Trace):
-        self.allocations[trace.address] = trace
-        self.all_allocations.append(trace)
-        self.total_allocation_size += trace.size
-        self.total_allocations += 1
+        # Live and total allocations per distinct backtrace
+        self.stacks = StackTable()
+
+        # Live and total allocations per thread
+        self.threads = ThreadTable()
+        self.thread_report: ThreadReport | None = None
+
+        # Live allocations by age, for finding long lived ones per stack
+        self.ages = AgeIndex()
+        self.leak_age = AgeIndex.DEFAULT_MIN_AGE
+        self.leak_report: LeakReport | None = None
+        self.size_report: SizeReport | None = None
+
+        # Heap activity per second and per minute
+        self.rollup = Rollup()
+        self.activity: RollupSummary | None = None
+
+        self.capture: CaptureWriter | None = None
+
+        # Short lived allocations counted inside the hooks, with --churn-lifetime
+        self.churn: ChurnTable | None = None
+        self.churn_report: ChurnReport | None = None
+
+        # Time the hooks spend on themselves, with --overhead-sampling
+        self.overhead: OverheadCounters | None = None
+        self.overhead_report: OverheadReport | None = None
+
+        # RSS and allocator counters next to the requested bytes, with --resident-interval
+        self.resident: ResidentSampler | None = None
+        self.resident_series = ResidentSeries()
+        self.resident_report: ResidentReport | None = None
+
+    def add_batch(self, records: np.ndarray, take_time: bool = False):
+        """Add records read from the ring, as an array of TRACE_DTYPE"""
+        # Failed allocations return null, they hold no memory and are never freed
+        failed = np.isin(records["type"], ALLOCATION_TYPES) & (records["address"] <= TOMBSTONE)
+        if failed.any():
+            records = records[~failed]
+        allocations = np.isin(records["type"], ALLOCATION_TYPES)
+        depths = records["backtrace_size"]
+
+        # The stacks of the allocations, and of the frees that have a backtrace
+        stack_ids = np.full(len(records), -1, dtype=np.int64)
+        interned = np.flatnonzero(allocations | (depths > 0))
+        # tolist() gives Python integers, which is what the stacks are keyed on
+        backtraces = records["backtraces"][interned].tolist()
+        for i, backtrace, depth in zip(interned.tolist(), backtraces, depths[interned].tolist()):
+            stack_ids[i] = self.stacks.intern(backtrace[:depth])
+
+        # Match the frees to live allocations in one pass over the batch
+        sizes = records["size"].astype(np.int64)
+        threads = self.threads.intern(records["tid"], records["cpu"])
+        freed, freed_sizes, freed_stacks, age_slots, freed_threads = self.allocations.apply(
+            records["address"], allocations, sizes, stack_ids, self.ages.slot, threads
+        )
+        free_sites = ~allocations & (stack_ids >= 0)
+        self.stacks.add_allocations(stack_ids[allocations], sizes[allocations])
+        self.stacks.add_frees(freed_stacks[freed], freed_sizes[freed])
+        self.stacks.add_free_sites(stack_ids[free_sites], freed_sizes[free_sites])
+        self.threads.add_allocations(threads[allocations], sizes[allocations])
+        self.threads.add_frees(freed_threads[freed], threads[freed], freed_sizes[freed])
+        self.ages.add_batch(stack_ids[allocations], sizes[allocations])
+        self.ages.remove_batch(age_slots[freed], freed_stacks[freed], freed_sizes[freed])
+        self.rollup.add_batch(
+            time.time(),
+            sizes[allocations],
+            freed_sizes[~allocations],
+            np.where(allocations, sizes, -freed_sizes),
+        )
 
-        if self.graph is not None:
-            alloc_time = round(trace.time / 10**9 - self.time_start, 2)
-            self.graph.add_event(
-                alloc_time, self.total_allocation_size, GraphType.ALLOCATION
+        allocated = int(sizes[allocations].sum())
+        released = int(freed_sizes[freed].sum())
+        self.total_allocations += int(allocations.sum())
+        self.total_frees += len(records) - int(allocations.sum())
+        self.total_allocation_size += allocated - released
+        self.total_free_size += released
+
+        if self.capture is not None:
+            self.capture.add(
+                self.pid or 0,
+                self.stacks,
+                records,
+                np.where(allocations, stack_ids, freed_stacks),
+                np.where(allocations, sizes, freed_sizes),
             )
-            self.graph.update()
-
-        # Update some statistics
-        for address in trace.backtraces:
-
-            self.current_function_allocations[address].sizes += trace.size
-            self.current_function_allocations[address].amount += 1
 
-            self.total_function_allocations[address].sizes += trace.size
-            self.total_function_allocations[address].amount += 1
-
-    def add_trace(self, trace: Trace):
-        # TODO: nullptr? Could they be some edge case?
-        if trace.type in [
-            TraceType.MALLOC,
-            TraceType.NEW,
-            TraceType.NEW_ARRAY,
-            TraceType.NEW_NO_THROW,
-        ]:
-            self.add_allocation(trace)
-        else:
-            self.add_deallocation(trace)
-
-    def add_deallocation(self, trace: Trace):
-        # TODO: Do we care about saving what pointers we've freed? They can and most likely will be reused
-        try:
-            original_trace = self.allocations[trace.address]
-            trace.size = original_trace.size
-            del self.allocations[trace.address]
-            self.total_free_size += trace.size
-            self.total_allocation_size -= trace.size
-        except KeyError:
-            original_trace = None
-            trace.size = 0
-        self.total_frees += 1
-
-        self.frees[trace.address] = trace
-        self.all_frees.append(trace)
-
-        if self.graph is not None:
-            free_time = round(trace.time - self.time_start, 2)
-            self.graph.add_event(
-                free_time, self.total_allocation_size, GraphType.DEALLOCATION
+        if self.log_file:
+            self.keep_traces(records, np.where(allocations, sizes, freed_sizes), take_time)
+
+    def keep_traces(self, records: np.ndarray, sizes: np.ndarray, take_time: bool):
+        """Every event as a Trace for the log file, sizes of frees being those of what they freed"""
+        backtraces = records["backtraces"].tolist()
+        rows = records.tolist()
+        for i, (address, timestamp, _, backtrace_size, type, _, tid, _) in enumerate(rows):
+            trace = Trace(
+                address,
+                time.time() if take_time else timestamp,
+                int(sizes[i]),
+                backtrace_size,
+                TraceType(type),
+                backtraces[i][:backtrace_size],
+                tid,
             )
-            self.graph.update()
-
-        # Update some statistics
-        for address in trace.backtraces:
-            self.current_function_frees[address].sizes += trace.size
-            self.current_function_frees[address].amount += 1
-
-            self.total_function_frees[address].sizes += trace.size
-            self.total_function_frees[address].amount += 1
-
-        if original_trace:
-            for address in original_trace.backtraces:
-                self.current_function_allocations[address].sizes -= trace.size
-                self.current_function_allocations[address].amount -= 1
+            if trace.type in ALLOCATION_TYPES:
+                self.all_allocations.append(trace)
+            else:
+                self.all_frees.append(trace)
+
+    def sample_resident(self):
+        sample = self.resident.sample(self.rollup.live_bytes)
+        if sample is None:
+            return
+        self.resident_series.add(sample)
+        if self.capture is not None:
+            self.capture.add_resident(self.pid or 0, sample)
+
+    def update_function_statistics(self):
+        """Sum the counters of the stacks over the functions (addresses) in them"""
+        addresses, live_bytes, live_count, alloc_bytes, alloc_count, free_bytes, free_count = self.stacks.per_frame(
+            self.stacks.live_bytes,
+            self.stacks.live_count,
+            self.stacks.alloc_bytes,
+            self.stacks.alloc_count,
+            self.stacks.free_bytes,
+            self.stacks.free_count,
+        )
+        addresses = addresses.tolist()
+        for destination, sizes, amounts in [
+            (self.current_function_allocations, live_bytes, live_count),
+            (self.total_function_allocations, alloc_bytes, alloc_count),
+            # Frees are never taken back, so the current ones are all of them
+            (self.current_function_frees, free_bytes, free_count),
+            (self.total_function_frees, free_bytes, free_count),
+        ]:
+            destination.clear()
+            used = np.flatnonzero(amounts)
+            for i, amount, size in zip(used.tolist(), amounts[used].tolist(), sizes[used].tolist()):
+                destination[addresses[i]] = FunctionStatistics(amount, size)
 
     def log_every_event(self, file) -> int:
-        self.print_header("Every event", file)
+        if self.pid is None:
+            print_header("Every event", file)
+        else:
+            print_header(f"Every event (pid {self.pid})", file)
 
         all_events: list[Trace] = self.all_frees + self.all_allocations
         all_events = sorted(all_events, key=lambda x: x.time)
@@ -283,9 +323,14 @@ class Memtracker:
         if not self.log_file:
             return
 
+        self.leak_report = self.ages.report(self.stacks, self.leak_age)
+        self.size_report = self.stacks.size_report()
+        self.activity = self.rollup.summary(time.time() - self.time_start)
+        self.resident_report = self.resident_series.report()
+        self.update_function_statistics()
         with open(self.log_file, "a") as f:
             event_count = self.log_every_event(f)
-            self.print_statistics(0, file=f, loop=False)
+            self.print_statistics(file=f)
 
         print(f"All statistics have been written to '{self.log_file}'. Total records: {event_count}")
 
@@ -315,21 +360,75 @@ class Memtracker:
                 file=file,
             )
 
-    def print_header(self, header: str, file=None):
-        width = 32
-        print("=" * width, file=file)
-        print(header.center(width), file=file)
-        print("=" * width + "\n", file=file)
-
-    def print_statistics_stop(self):
-        if self.print_timer:
-            self.print_timer.cancel()
-
-    def print_statistics(self, delay: int, file=None, loop=True):
-        if loop:
-            self.print_timer = Timer(delay, self.print_statistics, [delay])
-            self.print_timer.start()
-
+    def copy_statistics(self) -> "Memtracker":
+        """Copy the counters into a new Memtracker that can be reported on from another thread"""
+        copy = Memtracker(None, self.pid)
+        copy.total_allocation_size = self.total_allocation_size
+        copy.total_allocations = self.total_allocations
+        copy.total_free_size = self.total_free_size
+        copy.total_frees = self.total_frees
+        copy.dropped_events = self.dropped_events
+        self.update_function_statistics()
+        copy.merge_statistics(self)
+        copy.leak_report = self.ages.report(self.stacks, self.leak_age)
+        copy.size_report = self.stacks.size_report()
+        copy.activity = self.rollup.summary(self.ACTIVITY_SECONDS)
+        copy.thread_report = self.threads.report(self.allocations, self.stacks, self.pid)
+        if self.churn is not None:
+            copy.churn_report = self.churn.report()
+        if self.overhead is not None:
+            copy.overhead_report = self.overhead.report()
+        copy.resident_report = self.resident_series.report()
+        return copy
+
+    def merge_statistics(self, other: "Memtracker"):
+        """Add the per function statistics of other to ours"""
+        for source, destination in [
+            (other.current_function_allocations, self.current_function_allocations),
+            (other.total_function_allocations, self.total_function_allocations),
+            (other.current_function_frees, self.current_function_frees),
+            (other.total_function_frees, self.total_function_frees),
+        ]:
+            for address, statistics in source.items():
+                destination[address].amount += statistics.amount
+                destination[address].sizes += statistics.sizes
+
+        if other.leak_report is not None:
+            if self.leak_report is None:
+                self.leak_report = LeakReport(other.leak_report.min_age)
+            self.leak_report.merge(other.leak_report, AgeIndex.REPORT_COUNT)
+
+        if other.activity is not None:
+            if self.activity is None:
+                self.activity = RollupSummary(other.activity.seconds)
+            self.activity.merge(other.activity)
+
+        if other.size_report is not None:
+            if self.size_report is None:
+                self.size_report = SizeReport()
+            self.size_report.merge(other.size_report, StackTable.REPORT_SITES)
+
+        if other.thread_report is not None:
+            if self.thread_report is None:
+                self.thread_report = ThreadReport()
+            self.thread_report.merge(other.thread_report, ThreadTable.REPORT_THREADS)
+
+        if other.churn_report is not None:
+            if self.churn_report is None:
+                self.churn_report = ChurnReport()
+            self.churn_report.merge(other.churn_report, ChurnTable.REPORT_SITES)
+
+        if other.overhead_report is not None:
+            if self.overhead_report is None:
+                self.overhead_report = OverheadReport()
+            self.overhead_report.merge(other.overhead_report)
+
+        if other.resident_report is not None:
+            if self.resident_report is None:
+                self.resident_report = ResidentReport()
+            self.resident_report.merge(other.resident_report)
+
+    def print_statistics(self, file=None):
         current_most_allocations = sorted(
             self.current_function_allocations.keys(),
             key=lambda k: self.current_function_allocations[k].amount,
@@ -362,15 +461,13 @@ class Memtracker:
         )
 
         # Skip printing if there is no data
-        if not total_most_allocations and not total_most_frees:
+        if not total_most_allocations and not total_most_frees and not self.churn_report:
             return
 
-        if self.malloc_overflow:
-            print("MALLOC BUFFER OVERFLOW!")
-        if self.free_overflow:
-            print("FREE BUFFER OVERFLOW!")
+        if self.dropped_events:
+            print(f"BUFFER OVERFLOW! {self.dropped_events} records dropped")
 
-        self.print_header("Current Allocation Summary", file)
+        print_header("Current Allocation Summary", file)
 
         print("Top Allocation Functions by Total Calls:", file=file)
         self.print_num(
@@ -388,7 +485,7 @@ class Memtracker:
         )
         print(file=file)
 
-        self.print_header("Total Allocation Summary", file=file)
+        print_header("Total Allocation Summary", file=file)
 
         print("Top Allocation Functions by Total Calls:", file=file)
         self.print_num(
@@ -406,7 +503,7 @@ class Memtracker:
         )
         print(file=file)
 
-        self.print_header("Total Free Summary", file)
+        print_header("Total Free Summary", file)
         print("Top Free Functions by Total Calls:", file=file)
         self.print_num(total_most_frees, self.total_function_frees, file)
         print(file=file)
@@ -415,22 +512,302 @@ class Memtracker:
         self.print_size(total_largest_frees, self.total_function_frees, file)
         print(file=file)
 
-    def display_graph(self, time_window: int):
-        self.graph = Graph(time_window)
+        if self.activity is not None:
+            self.print_activity(self.activity, file)
+
+        if self.resident_report is not None:
+            self.print_resident(self.resident_report, file)
+
+        if self.size_report is not None:
+            self.print_sizes(self.size_report, file)
+
+        if self.thread_report is not None:
+            self.print_threads(self.thread_report, file)
+
+        if self.churn_report is not None:
+            self.print_churn(self.churn_report, file)
+
+        if self.leak_report is not None:
+            self.print_leaks(self.leak_report, file)
+
+        if self.overhead_report is not None:
+            self.print_overhead(self.overhead_report, file)
+
+    def print_activity(self, activity: RollupSummary, file=None):
+        print_header(f"Activity in the Last {activity.seconds:.0f}s", file)
+        seconds = max(activity.seconds, 1)
+        print(
+            f"Allocations: {activity.alloc_count / seconds:.1f}/s ({activity.alloc_bytes / seconds:.1f} bytes/s)",
+            file=file,
+        )
+        print(
+            f"Frees: {activity.free_count / seconds:.1f}/s ({activity.free_bytes / seconds:.1f} bytes/s)",
+            file=file,
+        )
+        print(f"Live heap: {activity.live_min} - {activity.live_max} bytes", file=file)
+        if activity.dropped:
+            print(f"Dropped records: {activity.dropped}", file=file)
+        print(file=file)
+
+    def print_resident(self, report: ResidentReport, file=None):
+        print_header("Resident Memory", file)
+        print(f"RSS: {report.rss} bytes ({report.anonymous} anonymous, {report.file} file and shared)", file=file)
+        print(f"PSS: {report.pss} bytes, swapped out: {report.swap} bytes", file=file)
+        print(f"Requested and live: {report.live} bytes, of the allocations made since attaching", file=file)
+        print(
+            f"Gap: {report.gap} bytes, {report.gap_growth:+} bytes in {report.seconds:.0f}s (largest {report.gap_max} bytes)",
+            file=file,
+        )
+        if self.dropped_events:
+            print("Records were dropped, the live bytes and so the gap are off by the frees among them", file=file)
+
+        if report.heap:
+            print("Allocator:", file=file)
+            print(f"  - in use     - {report.in_use + report.mmapped} bytes ({report.mmapped} in mmapped chunks)", file=file)
+            print(f"  - free       - {report.free} bytes ({report.releasable} releasable with malloc_trim)", file=file)
+            print(f"  - not heap   - {max(report.rss - report.heap, 0)} bytes of RSS outside the allocator", file=file)
+            # Free chunks the allocator keeps are resident until reused or trimmed
+            if report.free > report.in_use / 4 and report.free > report.releasable * 2:
+                print("Much of the heap is free chunks between live ones, fragmentation keeps them from the system", file=file)
+        print(file=file)
+
+    def print_histogram(self, histogram: np.ndarray, indent: str, file=None):
+        total = int(histogram.sum())
+        for size_class in np.flatnonzero(histogram).tolist():
+            count = int(histogram[size_class])
+            print(
+                f"{indent}- {size_class_label(size_class):>21} bytes - {count} allocations ({100 * count / total:.1f}%)",
+                file=file,
+            )
+
+    def print_sizes(self, report: SizeReport, file=None):
+        print_header("Allocation Sizes", file)
+
+        print("Heap Wide Size Classes:", file=file)
+        self.print_histogram(report.heap, "  ", file)
+        print(file=file)
+
+        print("Size Classes of the Top Call Stacks by Total Size:", file=file)
+        for site in report.sites:
+            print(f"  - {site.size} bytes ({site.count} allocations)", file=file)
+            print(f"    Backtrace: {' -> '.join(hex(b) for b in site.backtraces)}", file=file)
+            self.print_histogram(site.histogram, "      ", file)
+        print(file=file)
+
+    def print_threads(self, report: ThreadReport, file=None):
+        print_header("Threads", file)
+        print(f"{report.seen} threads seen, {report.retired} retired without live allocations", file=file)
+        if report.retired:
+            print(
+                f"Retired threads allocated {report.retired_alloc_bytes} bytes "
+                f"({report.retired_alloc_count} allocations)",
+                file=file,
+            )
+        print(file=file)
+
+        print("Top Threads by Live Size:", file=file)
+        for thread in report.threads:
+            name = f"tid {thread.tid}" if thread.pid is None else f"pid {thread.pid} tid {thread.tid}"
+            cpu = "" if thread.cpu == NO_CPU else f", last on cpu {thread.cpu}"
+            print(
+                f"  - {name} - {thread.live_bytes} bytes live ({thread.live_count} allocations){cpu}",
+                file=file,
+            )
+            print(
+                f"    Allocated {thread.alloc_bytes} bytes ({thread.alloc_count} allocations), "
+                f"freed {thread.free_bytes} bytes ({thread.free_count} frees, "
+                f"{thread.remote_frees} of another thread's allocations)",
+                file=file,
+            )
+            for site in thread.sites:
+                print(f"    - {site.size} bytes ({site.count} allocations)", file=file)
+                print(f"      Backtrace: {' -> '.join(hex(b) for b in site.backtraces)}", file=file)
+        print(file=file)
+
+    def print_churn(self, report: ChurnReport, file=None):
+        print_header(f"Allocations Freed Within {report.lifetime_ns / 1000:g}us", file)
+        print(
+            f"{report.pairs} allocations counted in the hooks instead of recorded "
+            f"({report.remote} freed by another thread)",
+            file=file,
+        )
+        if report.full:
+            print(f"Churn table full: {report.full} allocations recorded instead", file=file)
+        print(file=file)
+
+        print("Lifetimes:", file=file)
+        for bucket in np.flatnonzero(report.lifetimes).tolist():
+            count = int(report.lifetimes[bucket])
+            print(f"  - {lifetime_label(bucket):>17} - {count} allocations ({100 * count / report.pairs:.1f}%)", file=file)
+        print(file=file)
+
+        print("Top Churning Call Stacks:", file=file)
+        for site in report.sites:
+            print(f"  - {site.count} allocations ({site.size} bytes)", file=file)
+            print(f"    Backtrace: {' -> '.join(hex(b) for b in site.backtraces)}", file=file)
+        print(file=file)
+
+    def print_overhead(self, report: OverheadReport, file=None):
+        print_header("Hook Overhead", file)
+        print(f"{report.calls} hook calls on {report.threads} threads, 1 in {report.sampling} timed", file=file)
+        print(f"Time in the hooks: {report.seconds:.3f}s ({10**9 * report.seconds / report.calls:.0f}ns per call)", file=file)
+        for phase, seconds in [*report.phases.items(), ("other", report.other)]:
+            print(f"  - {phase:<9} - {seconds:.3f}s ({100 * seconds / report.seconds:.1f}%)", file=file)
+
+        slowdown = report.slowdown
+        if slowdown is not None:
+            print(f"Target CPU time: {report.cpu_seconds:.2f}s, estimated slowdown {slowdown:.1f}%", file=file)
+
+        # What would cut the cost the most
+        dominant = max(report.phases, key=report.phases.get)
+        if report.phases[dominant] > report.seconds / 2 and dominant in OVERHEAD_HINTS:
+            print(OVERHEAD_HINTS[dominant], file=file)
+        print(file=file)
+
+    def print_leaks(self, report: LeakReport, file=None):
+        print_header("Suspected Leaks", file)
+
+        print("Live Allocations by Age:", file=file)
+        for (_, label), (count, size) in zip(AGE_BINS, report.histogram):
+            print(f"  - {label:<10} - {size} bytes ({count} allocations)", file=file)
+        print(file=file)
+
+        print(f"Top Call Stacks Alive Longer Than {report.min_age:g}s:", file=file)
+        for leak in report.leaks:
+            print(f"  - {leak.size} bytes ({leak.count} allocations)", file=file)
+            print(f"    Backtrace: {' -> '.join(hex(b) for b in leak.backtraces)}", file=file)
+        print(file=file)
+
+
+class MemtrackerGroup:
+    """
+    Keeps one Memtracker per profiled process. Reports show a short summary per
+    process followed by the statistics aggregated over all processes.
+    """
+
+    def __init__(self, pids: list[int], log_file: str | None, leak_age: float = AgeIndex.DEFAULT_MIN_AGE):
+        self.log_file = log_file
+        self.time_start = time.time()
+        self.memtrackers: dict[int, Memtracker] = {}
+
+        for pid in pids:
+            memtracker = Memtracker(log_file, pid)
+            memtracker.time_start = self.time_start
+            memtracker.leak_age = leak_age
+            self.memtrackers[pid] = memtracker
+
+    def rollups(self) -> list[Rollup]:
+        return [memtracker.rollup for memtracker in self.memtrackers.values()]
+
+    def resident_series(self) -> list[ResidentSeries]:
+        return [memtracker.resident_series for memtracker in self.memtrackers.values()]
+
+    def sample_resident(self):
+        for memtracker in self.memtrackers.values():
+            if memtracker.resident is not None:
+                memtracker.sample_resident()
+
+    def snapshot(self) -> list[Memtracker]:
+        """
+        Copy the statistics of every process, the copies can be reported on
+        from another thread while the originals keep being updated
+        """
+        return [memtracker.copy_statistics() for memtracker in self.memtrackers.values()]
+
+    def stack_tables(self) -> dict[int, StackTable]:
+        return {pid: memtracker.stacks for pid, memtracker in self.memtrackers.items()}
+
+    @staticmethod
+    def aggregate(snapshot: list[Memtracker]) -> Memtracker:
+        """Merge the statistics of every process into a single Memtracker"""
+        aggregate = Memtracker(None)
+        for memtracker in snapshot:
+            aggregate.total_allocation_size += memtracker.total_allocation_size
+            aggregate.total_allocations += memtracker.total_allocations
+            aggregate.total_free_size += memtracker.total_free_size
+            aggregate.total_frees += memtracker.total_frees
+            aggregate.dropped_events += memtracker.dropped_events
+            aggregate.merge_statistics(memtracker)
+
+        return aggregate
+
+    @staticmethod
+    def print_summary(snapshot: list[Memtracker], file=None):
+        print("Per Process Summary:", file=file)
+        for memtracker in snapshot:
+            print(
+                f"  - pid {memtracker.pid:<8} - {memtracker.total_allocation_size} bytes live "
+                f"({memtracker.total_allocations} allocations, {memtracker.total_frees} frees)",
+                file=file,
+            )
+        print(file=file)
+
+    @staticmethod
+    def print_statistics(snapshot: list[Memtracker], file=None):
+        if len(snapshot) > 1:
+            MemtrackerGroup.print_summary(snapshot, file)
+            MemtrackerGroup.aggregate(snapshot).print_statistics(file)
+        elif snapshot:
+            snapshot[0].print_statistics(file)
+
+    def write_log_file(self):
+        for memtracker in self.memtrackers.values():
+            memtracker.write_log_file()
+
+        if not self.log_file or len(self.memtrackers) == 1:
+            return
+
+        with open(self.log_file, "a") as f:
+            self.print_statistics(self.snapshot(), f)
 
 
 class SharedBuffer:
-    MOUNT: str = "/dev/shm/mem_hook"
+    MOUNT_PREFIX: str = MOUNT_PREFIX
+    HUGETLBFS_PREFIX: str = "/dev/hugepages/mem_hook_"
+    BATCH_RECORDS: int = 256  # Records decoded at once, and between deadline checks
     size: int
 
-    def __init__(self, timestamp: str | None):
+    def __init__(self, pid: int, timestamp: str | None, metrics: Metrics | None = None):
+        self.pid = pid
         self.timestamp = timestamp
+        self.metrics = metrics
+        self.first_event: float | None = None  # time.perf_counter() of the first record read
+
+    @staticmethod
+    def mount(pid: int) -> str:
+        """Path of the shared memory object created by the hooks in process pid"""
+        # With --hugepages the hooks put the ring on hugetlbfs when they can
+        huge = f"{SharedBuffer.HUGETLBFS_PREFIX}{pid}"
+        if os.path.exists(huge) and not SharedBuffer.stale(huge, pid):
+            return huge
+        return f"{SharedBuffer.MOUNT_PREFIX}{pid}"
+
+    @staticmethod
+    def stale(path: str, pid: int) -> bool:
+        """Whether path was left behind by an earlier process with the same pid"""
+        try:
+            return os.stat(path).st_ctime < process_start(pid)
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def remove_stale(pid: int):
+        """Remove what earlier processes with the same pid left, before the hooks are loaded"""
+        for path in (f"{SharedBuffer.HUGETLBFS_PREFIX}{pid}", SharedBuffer.mount(pid), ChurnTable.mount(pid)):
+            if SharedBuffer.stale(path, pid):
+                os.unlink(path)
+
+    @staticmethod
+    def notify_path(pid: int) -> str:
+        """Path of the socket the hooks in process pid send wake-ups to"""
+        return f"{SharedBuffer.MOUNT_PREFIX}{pid}.sock"
 
     def __enter__(self):
         # Open the shared memory object
         try:
             # Open the shared memory object (O_RDWR for read-write access)
-            self.fd = os.open(self.MOUNT, os.O_RDWR)
+            self.path = self.mount(self.pid)
+            self.fd = os.open(self.path, os.O_RDWR)
         except OSError as e:
             print(f"Failed to open shared memory: {e}")
             exit(1)
@@ -438,89 +815,137 @@ class SharedBuffer:
         # Get the size of the shared memory object by using fstat
         self.size = os.fstat(self.fd).st_size
 
-        self.entries = self.size // TRACE_SIZE
-
         self.take_time = False
         if not self.timestamp:
             self.take_time = True
 
-        # Map the shared memory object to the Python process's memory space
+        # Map the shared memory object to the Python process's memory space,
+        # populated so reading a page the first time doesn't fault either
         try:
-            self.mem = mmap.mmap(self.fd, self.size, access=mmap.ACCESS_WRITE)
+            self.mem = mmap.mmap(
+                self.fd,
+                self.size,
+                flags=mmap.MAP_SHARED | getattr(mmap, "MAP_POPULATE", 0),
+                prot=mmap.PROT_READ | mmap.PROT_WRITE,
+            )
         except Exception as e:
             print(f"Failed to map shared memory: {e}")
             os.close(self.fd)
             exit(1)
+
+        # The ring may be smaller than the object, which is rounded up to whole huge pages
+        self.entries = int.from_bytes(self.mem[16:20], byteorder="little")
+        self.flags = BufferFlags(int.from_bytes(self.mem[20:24], byteorder="little"))
+        self.records = np.frombuffer(self.mem, dtype=TRACE_DTYPE, count=self.entries, offset=HEAD_SIZE)
+
+        # Socket the hooks write to after a record lands in an empty ring we wait on
+        self.notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.notify_socket.setblocking(False)
+        if os.path.exists(self.notify_path(self.pid)):
+            os.unlink(self.notify_path(self.pid))
+        self.notify_socket.bind(self.notify_path(self.pid))
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         if self.fd is None or self.mem is None:
             return
 
+        self.mem[12:16] = (0).to_bytes(4, byteorder="little")
+        self.notify_socket.close()
+        os.unlink(self.notify_path(self.pid))
+        # The pages, prefaulted or huge, stay in use as long as the file exists. The
+        # hooks keep their mapping, like with the churn table.
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        # The mapping can't be closed while the array still views it
+        del self.records
         self.mem.close()
         os.close(self.fd)
 
-    def read_backtraces(self, start_address, backtrace_size) -> list[int]:
-        if backtrace_size == 0:
-            return []
-
-        backtraces = []
-        read_pointers = 0
-
-        while read_pointers != backtrace_size:
-            backtraces.append(
-                int.from_bytes(
-                    self.mem[
-                        start_address
-                        + read_pointers * 8 : start_address
-                        + (read_pointers + 1) * 8
-                    ],
-                    byteorder="little",
-                )
-            )
-            read_pointers += 1
+    def prepare_wait(self) -> bool:
+        """
+        Ask the hooks for a wake-up on the next record. Returns False if records
+        arrived in the meantime and the ring should be read instead of waiting.
+        """
+        self.mem[12:16] = (1).to_bytes(4, byteorder="little")
+        return self.mem[0:4] == self.mem[4:8]
 
-        return backtraces
+    def clear_notifications(self):
+        try:
+            while self.notify_socket.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+
+    def read_batch(self, max_records: int | None = None) -> np.ndarray:
+        """
+        Copy up to max_records records out of the ring, as an array of
+        TRACE_DTYPE, and hand their space back to the hooks
+        """
+        head = int.from_bytes(self.mem[0:4], byteorder="little")
+        tail = int.from_bytes(self.mem[4:8], byteorder="little")
+        count = (tail - head) % self.entries
+        if max_records is not None:
+            count = min(count, max_records)
 
-    def read_trace(self, head: int) -> Trace:
-        start_address = head * TRACE_SIZE + HEAD_SIZE
-        pointer = int.from_bytes(
-            self.mem[start_address : start_address + 8], byteorder="little"
-        )
-        if self.take_time:
-            current_time = time.time()
+        end = head + count
+        if end <= self.entries:
+            batch = self.records[head:end].copy()
         else:
-            current_time = int.from_bytes(
-                self.mem[start_address + 8 : start_address + 16],
-                byteorder="little",
-            )
-        size = int.from_bytes(
-            self.mem[start_address + 16 : start_address + 20], byteorder="little"
-        )
-        backtrace_size = int.from_bytes(
-            self.mem[start_address + 20 : start_address + 24], byteorder="little"
-        )
+            # The batch wraps around the end of the ring
+            batch = np.concatenate((self.records[head:], self.records[: end - self.entries]))
 
-        trace_type = int.from_bytes(
-            self.mem[start_address + 24 : start_address + 28], byteorder="little"
-        )
+        self.mem[0:4] = (end % self.entries).to_bytes(4, byteorder="little")
+        return batch
 
-        type = TraceType(int(trace_type))
-
-        backtraces = self.read_backtraces(start_address + 32, backtrace_size)
-
-        return Trace(pointer, current_time, size, backtrace_size, type, backtraces)
-
-    def read(self, memtracker: Memtracker):
+    def read_lag(self, head: int) -> float | None:
+        """Seconds between the record at head being written and now, if timestamps allow it"""
+        if self.timestamp != "chrono":
+            return None
+        start_address = head * TRACE_SIZE + HEAD_SIZE
+        timestamp = int.from_bytes(
+            self.mem[start_address + 8 : start_address + 16], byteorder="little"
+        )
+        return (time.time_ns() - timestamp) / 10**9
+
+    def read(self, memtracker: Memtracker, deadline: float | None = None) -> bool:
+        """
+        Hand the records in the ring to memtracker. With a deadline (in
+        time.perf_counter() seconds) reading stops once it has passed.
+        Returns True if the ring was emptied.
+        """
         head = int.from_bytes(self.mem[0:4], byteorder="little")
         tail = int.from_bytes(self.mem[4:8], byteorder="little")
-        memtracker.malloc_overflow = int.from_bytes(self.mem[8:12], byteorder="little")
-
-        while head != tail:
-            trace = self.read_trace(head)
-            memtracker.add_trace(trace)
-            head = (head + 1) % self.entries
-
-        self.mem[0:4] = head.to_bytes(4, byteorder="little")
+        dropped_events = int.from_bytes(self.mem[8:12], byteorder="little")
+        if dropped_events > memtracker.dropped_events:
+            memtracker.rollup.add_dropped(time.time(), dropped_events - memtracker.dropped_events)
+        memtracker.dropped_events = dropped_events
+        memtracker.ages.advance(time.time())
+
+        if self.metrics is not None:
+            fill = (tail - head) % self.entries
+            lag = self.read_lag(head) if fill else None
+            drain_start = time.perf_counter()
+
+        # Records written after this point are left for the next read
+        remaining = (tail - head) % self.entries
+        count = 0
+        while remaining:
+            batch = self.read_batch(min(remaining, self.BATCH_RECORDS))
+            memtracker.add_batch(batch, self.take_time)
+            remaining -= len(batch)
+            count += len(batch)
+            if self.first_event is None:
+                self.first_event = time.perf_counter()
+
+            if deadline is not None and time.perf_counter() > deadline:
+                break
+
+        if self.metrics is not None:
+            self.metrics.record_drain(
+                fill, count, self.entries, memtracker.dropped_events, lag, time.perf_counter() - drain_start
+            )
 
-        memtracker.do_event_loop()
+        return remaining == 0
@@ -0,0 +1,263 @@
+"""
+Snapshot file layout, all little endian:
+
+    magic  "MHSNAP01"
+    blocks tag (4 bytes), payload size (uint64), payload
+
+    STCK  pid (uint64), first stack id (uint32), count (uint32),
+          depth per stack (uint32[count]), frames (uint64[sum of depths])
+    SNAP  time (float64), pid (uint64), count (uint32), padding (4 bytes),
+          stack ids (uint32[count], sorted), live bytes (int64[count]),
+          live count (int64[count])
+
+Stacks are written once, the first time a snapshot refers to them, followed
+by the MODL, NSTK and SMAP blocks normalizing them, see normalize.
+"""
+
+import argparse
+import struct
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from normalize import NormalizedTable, Normalizer
+from shared_buffer import print_header
+from stacks import StackTable, decode_stacks, encode_stacks
+
+MAGIC = b"MHSNAP01"
+BLOCK_HEADER = struct.Struct("<4sQ")
+SNAPSHOT_HEADER = struct.Struct("<dQI4x")
+
+
+@dataclass
+class Snapshot:
+    time: float
+    pid: int
+    stack_ids: np.ndarray  # uint32, sorted
+    live_bytes: np.ndarray  # int64
+    live_count: np.ndarray  # int64
+
+
+@dataclass
+class PendingSnapshot:
+    snapshot: Snapshot
+    first_stack: int  # Id of the first stack in new_stacks
+    new_stacks: list[tuple[int, ...]]
+
+
+@dataclass
+class SnapshotDiff:
+    stack_ids: np.ndarray
+    old_bytes: np.ndarray
+    new_bytes: np.ndarray
+    old_count: np.ndarray
+    new_count: np.ndarray
+
+    @property
+    def delta_bytes(self) -> np.ndarray:
+        return self.new_bytes - self.old_bytes
+
+    @property
+    def delta_count(self) -> np.ndarray:
+        return self.new_count - self.old_count
+
+
+class SnapshotWriter:
+    """Writes periodic heap snapshots of one or more processes to a file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.written_stacks: dict[int, int] = {}  # Number of stacks written per pid
+        self.normalizer = Normalizer()
+
+        with open(self.path, "wb") as f:
+            f.write(MAGIC)
+
+    def take(self, stack_tables: dict[int, StackTable]) -> list[PendingSnapshot]:
+        """Copy the per stack counters, cheap enough to run between drains"""
+        now = time.time()
+        pending = []
+
+        for pid, stacks in stack_tables.items():
+            stack_ids, live_bytes, live_count = stacks.live()
+            first = self.written_stacks.get(pid, 0)
+            self.written_stacks[pid] = len(stacks)
+            pending.append(
+                PendingSnapshot(
+                    Snapshot(now, pid, stack_ids, live_bytes, live_count),
+                    first,
+                    stacks.stacks[first:],
+                )
+            )
+
+        return pending
+
+    def write(self, pending: list[PendingSnapshot]):
+        with open(self.path, "ab") as f:
+            for entry in pending:
+                if entry.new_stacks:
+                    self._write_block(
+                        f, b"STCK", encode_stacks(entry.snapshot.pid, entry.first_stack, entry.new_stacks)
+                    )
+                    for tag, payload in self.normalizer.blocks(entry.snapshot.pid, entry.first_stack, entry.new_stacks):
+                        self._write_block(f, tag, payload)
+                self._write_block(f, b"SNAP", self._encode_snapshot(entry.snapshot))
+
+    def _write_block(self, f, tag: bytes, payload: bytes):
+        f.write(BLOCK_HEADER.pack(tag, len(payload)))
+        f.write(payload)
+
+    def _encode_snapshot(self, snapshot: Snapshot) -> bytes:
+        header = SNAPSHOT_HEADER.pack(snapshot.time, snapshot.pid, len(snapshot.stack_ids))
+        return (
+            header
+            + snapshot.stack_ids.astype("<u4").tobytes()
+            + snapshot.live_bytes.astype("<i8").tobytes()
+            + snapshot.live_count.astype("<i8").tobytes()
+        )
+
+
+def read_snapshots(path: str) -> tuple[list[Snapshot], dict[int, list[tuple[int, ...]]], NormalizedTable]:
+    """Read every snapshot in the file, the stacks of every pid and their normalized stacks"""
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if data[: len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a snapshot file")
+
+    snapshots: list[Snapshot] = []
+    stacks: dict[int, list[tuple[int, ...]]] = {}
+    normalized = NormalizedTable()
+    offset = len(MAGIC)
+
+    while offset < len(data):
+        tag, size = BLOCK_HEADER.unpack_from(data, offset)
+        offset += BLOCK_HEADER.size
+        payload = memoryview(data)[offset : offset + size]
+        offset += size
+
+        if tag == b"STCK":
+            pid, first, new_stacks = decode_stacks(payload)
+            pid_stacks = stacks.setdefault(pid, [])
+            del pid_stacks[first:]
+            pid_stacks += new_stacks
+        elif tag == b"SNAP":
+            snapshot_time, pid, count = SNAPSHOT_HEADER.unpack_from(payload)
+            start = SNAPSHOT_HEADER.size
+            stack_ids = np.frombuffer(payload, dtype="<u4", count=count, offset=start)
+            live_bytes = np.frombuffer(payload, dtype="<i8", count=count, offset=start + 4 * count)
+            live_count = np.frombuffer(payload, dtype="<i8", count=count, offset=start + 12 * count)
+            snapshots.append(Snapshot(snapshot_time, pid, stack_ids, live_bytes, live_count))
+        else:
+            normalized.add_block(tag, payload)
+
+    # Written before stacks were normalized
+    for pid, pid_stacks in stacks.items():
+        if pid not in normalized.stack_maps:
+            normalized.add_unnormalized(pid, pid_stacks)
+
+    return snapshots, stacks, normalized
+
+
+def diff(old: Snapshot, new: Snapshot) -> SnapshotDiff:
+    """Merge-join two snapshots on stack id"""
+    stack_ids = np.union1d(old.stack_ids, new.stack_ids)
+    old_index = np.searchsorted(stack_ids, old.stack_ids)
+    new_index = np.searchsorted(stack_ids, new.stack_ids)
+
+    result = SnapshotDiff(
+        stack_ids,
+        np.zeros(len(stack_ids), dtype=np.int64),
+        np.zeros(len(stack_ids), dtype=np.int64),
+        np.zeros(len(stack_ids), dtype=np.int64),
+        np.zeros(len(stack_ids), dtype=np.int64),
+    )
+    result.old_bytes[old_index] = old.live_bytes
+    result.old_count[old_index] = old.live_count
+    result.new_bytes[new_index] = new.live_bytes
+    result.new_count[new_index] = new.live_count
+    return result
+
+
+def print_list(snapshots: list[Snapshot]):
+    print_header("Snapshots")
+    start = snapshots[0].time if snapshots else 0
+    for index, snapshot in enumerate(snapshots):
+        print(
+            f"  - [{index}] t={snapshot.time - start:.1f}s pid {snapshot.pid} - "
+            f"{int(snapshot.live_bytes.sum())} bytes live "
+            f"({int(snapshot.live_count.sum())} allocations, {len(snapshot.stack_ids)} stacks)"
+        )
+
+
+def print_diff(
+    old: Snapshot,
+    new: Snapshot,
+    stacks: list[tuple[int, ...]],
+    count: int,
+    sort: str,
+):
+    result = diff(old, new)
+    key = result.delta_bytes if sort == "bytes" else result.delta_count
+    top = np.argsort(-key, kind="stable")[:count]
+
+    print_header("Heap Growth")
+    print(f"Over {new.time - old.time:.1f}s, pid {new.pid}")
+    print(f"Live bytes: {int(old.live_bytes.sum())} -> {int(new.live_bytes.sum())}\n")
+
+    print(f"Top Call Stacks by Growth in {sort.capitalize()}:")
+    for index in top:
+        stack_id = int(result.stack_ids[index])
+        frames = stacks[stack_id] if stack_id < len(stacks) else ()
+        print(
+            f"  - stack {stack_id:<8} - {int(result.delta_bytes[index]):+} bytes "
+            f"({int(result.delta_count[index]):+} allocations, {int(result.new_bytes[index])} bytes live)"
+        )
+        print(f"    Backtrace: {' -> '.join(hex(frame) for frame in frames)}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Inspect heap snapshots written by the profiler.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = subparsers.add_parser("list", help="List the snapshots in a file.")
+    list_parser.add_argument("file")
+
+    diff_parser = subparsers.add_parser("diff", help="Show the call stacks that grew the most between two snapshots.")
+    diff_parser.add_argument("file")
+    diff_parser.add_argument("old", type=int, help="Index of the older snapshot, negative values count from the end.")
+    diff_parser.add_argument("new", type=int, help="Index of the newer snapshot, negative values count from the end.")
+    diff_parser.add_argument("-n", "--count", type=int, default=10, help="Number of call stacks to show.")
+    diff_parser.add_argument("-s", "--sort", default="bytes", choices=["bytes", "count"], help="Rank by growth in live bytes or live allocations.")
+
+    args = parser.parse_args()
+
+    try:
+        snapshots, stacks, _ = read_snapshots(args.file)
+    except (OSError, ValueError) as e:
+        print(f"Could not read snapshots: {e}")
+        exit(1)
+
+    if args.command == "list":
+        print_list(snapshots)
+        return
+
+    try:
+        old, new = snapshots[args.old], snapshots[args.new]
+    except IndexError:
+        print(f"The file only has {len(snapshots)} snapshots")
+        exit(1)
+
+    if old.pid != new.pid:
+        print(f"Snapshots {args.old} and {args.new} are from different processes ({old.pid} and {new.pid})")
+        exit(1)
+
+    print_diff(old, new, stacks.get(new.pid, []), args.count, args.sort)
+
+
+if __name__ == "__main__":
+    main()
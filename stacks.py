@@ -0,0 +1,185 @@
+import struct
+from dataclasses import dataclass, field
+
+import numpy as np
+
+# Stack blocks of snapshot and capture files: pid, id of the first stack and
+# number of stacks, followed by the depth of every stack and all their frames
+STACKS_HEADER = struct.Struct("<QII")
+
+# Size class c holds sizes in [2^(c-1), 2^c), class 0 holds zero sized allocations
+SIZE_CLASSES: int = 33
+
+
+def size_classes(sizes: np.ndarray) -> np.ndarray:
+    # frexp's exponent is floor(log2(size)) + 1, computed exactly
+    return np.frexp(sizes.astype(np.float64))[1]
+
+
+def size_class_label(size_class: int) -> str:
+    if size_class < 2:
+        return str(size_class)
+    return f"{2 ** (size_class - 1)} - {2**size_class - 1}"
+
+
+@dataclass
+class SiteSizes:
+    backtraces: tuple[int, ...]
+    size: int
+    count: int
+    histogram: np.ndarray
+
+
+@dataclass
+class SizeReport:
+    heap: np.ndarray = field(default_factory=lambda: np.zeros(SIZE_CLASSES, dtype=np.int64))
+    sites: list[SiteSizes] = field(default_factory=list)
+
+    def merge(self, other: "SizeReport", count: int):
+        self.heap = self.heap + other.heap
+        self.sites = sorted(self.sites + other.sites, key=lambda site: site.size, reverse=True)[:count]
+
+
+class StackTable:
+    """
+    Gives every distinct backtrace a small integer id and keeps allocation
+    counters per id in arrays, so per-stack views of the heap can be taken
+    without walking the live allocations.
+    """
+
+    INITIAL_CAPACITY: int = 1024
+    REPORT_SITES: int = 5
+
+    def __init__(self):
+        self.ids: dict[tuple[int, ...], int] = {}
+        self.stacks: list[tuple[int, ...]] = []
+        # Every frame of every stack and the id of its stack, for sums per frame address
+        self.frames: list[int] = []
+        self.frame_stacks: list[int] = []
+
+        self.live_bytes = np.zeros(self.INITIAL_CAPACITY, dtype=np.int64)
+        self.live_count = np.zeros(self.INITIAL_CAPACITY, dtype=np.int64)
+        self.alloc_bytes = np.zeros(self.INITIAL_CAPACITY, dtype=np.int64)
+        self.alloc_count = np.zeros(self.INITIAL_CAPACITY, dtype=np.int64)
+        # Frees made from the stack, the backtraces of frees are interned too
+        self.free_bytes = np.zeros(self.INITIAL_CAPACITY, dtype=np.int64)
+        self.free_count = np.zeros(self.INITIAL_CAPACITY, dtype=np.int64)
+        # Allocations per size class, SIZE_CLASSES * 8 bytes per stack
+        self.size_histograms = np.zeros((self.INITIAL_CAPACITY, SIZE_CLASSES), dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.stacks)
+
+    def intern(self, backtraces: list[int]) -> int:
+        stack = tuple(backtraces)
+        stack_id = self.ids.get(stack)
+        if stack_id is None:
+            stack_id = len(self.stacks)
+            self.ids[stack] = stack_id
+            self.stacks.append(stack)
+            self.frames.extend(stack)
+            self.frame_stacks.extend([stack_id] * len(stack))
+            if stack_id == len(self.live_bytes):
+                self._grow()
+        return stack_id
+
+    def add_allocations(self, stack_ids: np.ndarray, sizes: np.ndarray):
+        np.add.at(self.live_bytes, stack_ids, sizes)
+        np.add.at(self.live_count, stack_ids, 1)
+        np.add.at(self.alloc_bytes, stack_ids, sizes)
+        np.add.at(self.alloc_count, stack_ids, 1)
+        np.add.at(self.size_histograms, (stack_ids, size_classes(sizes)), 1)
+
+    def add_frees(self, stack_ids: np.ndarray, sizes: np.ndarray):
+        np.add.at(self.live_bytes, stack_ids, -sizes)
+        np.add.at(self.live_count, stack_ids, -1)
+
+    def add_free_sites(self, stack_ids: np.ndarray, sizes: np.ndarray):
+        """Frees counted for the stacks that made them, sizes are those of the freed allocations"""
+        np.add.at(self.free_bytes, stack_ids, sizes)
+        np.add.at(self.free_count, stack_ids, 1)
+
+    def per_frame(self, *counters: np.ndarray) -> tuple[np.ndarray, ...]:
+        """
+        Every frame address with counters per stack summed over the stacks
+        holding it, once per time it appears in them
+        """
+        frames = np.array(self.frames, dtype=np.uint64)
+        frame_stacks = np.array(self.frame_stacks, dtype=np.int64)
+        addresses, inverse = np.unique(frames, return_inverse=True)
+        sums = []
+        for counter in counters:
+            summed = np.zeros(len(addresses), dtype=np.int64)
+            np.add.at(summed, inverse, counter[frame_stacks])
+            sums.append(summed)
+        return (addresses, *sums)
+
+    def size_report(self, count: int = REPORT_SITES) -> SizeReport:
+        """Heap wide size histogram and the histograms of the stacks that allocated the most bytes"""
+        used = len(self.stacks)
+        report = SizeReport(self.size_histograms[:used].sum(axis=0))
+        for stack_id in np.argsort(-self.alloc_bytes[:used], kind="stable")[:count].tolist():
+            report.sites.append(
+                SiteSizes(
+                    self.stacks[stack_id],
+                    int(self.alloc_bytes[stack_id]),
+                    int(self.alloc_count[stack_id]),
+                    self.size_histograms[stack_id].copy(),
+                )
+            )
+        return report
+
+    def nbytes(self) -> int:
+        """Bytes of the counter arrays, the stacks themselves not included"""
+        return sum(
+            array.nbytes
+            for array in [
+                self.live_bytes,
+                self.live_count,
+                self.alloc_bytes,
+                self.alloc_count,
+                self.free_bytes,
+                self.free_count,
+                self.size_histograms,
+            ]
+        )
+
+    def live(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Ids, live bytes and live counts of every stack with live allocations, sorted by id"""
+        used = len(self.stacks)
+        ids = np.flatnonzero(self.live_count[:used]).astype(np.uint32)
+        return ids, self.live_bytes[ids], self.live_count[ids]
+
+    def _grow(self):
+        for name in [
+            "live_bytes",
+            "live_count",
+            "alloc_bytes",
+            "alloc_count",
+            "free_bytes",
+            "free_count",
+            "size_histograms",
+        ]:
+            array = getattr(self, name)
+            grown = np.zeros((len(array) * 2,) + array.shape[1:], dtype=array.dtype)
+            grown[: len(array)] = array
+            setattr(self, name, grown)
+
+
+def encode_stacks(pid: int, first: int, stacks: list[tuple[int, ...]]) -> bytes:
+    depths = np.fromiter((len(stack) for stack in stacks), dtype="<u4", count=len(stacks))
+    frames = np.fromiter(
+        (frame for stack in stacks for frame in stack),
+        dtype="<u8",
+        count=int(depths.sum()),
+    )
+    return STACKS_HEADER.pack(pid, first, len(stacks)) + depths.tobytes() + frames.tobytes()
+
+
+def decode_stacks(payload: bytes) -> tuple[int, int, list[tuple[int, ...]]]:
+    """Pid, id of the first stack and the stacks of a block written by encode_stacks"""
+    pid, first, count = STACKS_HEADER.unpack_from(payload)
+    depths = np.frombuffer(payload, dtype="<u4", count=count, offset=STACKS_HEADER.size)
+    frames = np.frombuffer(payload, dtype="<u8", offset=STACKS_HEADER.size + 4 * count).tolist()
+    bounds = [0] + np.cumsum(depths, dtype=np.int64).tolist()
+    return pid, first, [tuple(frames[bounds[i] : bounds[i + 1]]) for i in range(count)]
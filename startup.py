@@ -0,0 +1,104 @@
+"""
+Runs the steps of attaching to the targets as a graph. A stage starts as soon
+as the stages it needs are done, so building the hooking library, reading the
+executables of the targets and attaching to them overlap where they can. Most
+stages wait on subprocesses or files, threads are enough to run them side by
+side.
+"""
+
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from shared_buffer import print_header
+
+
+@dataclass
+class Stage:
+    name: str
+    run: Callable[[], Any]
+    needs: list[str] = field(default_factory=list)
+    start: float = 0  # Seconds after the graph started
+    seconds: float = 0
+    result: Any = None
+    error: BaseException | None = None
+    skipped: bool = False  # A stage it needs failed
+
+
+class StartupGraph:
+    WORKERS: int = 4
+
+    def __init__(self, workers: int = WORKERS):
+        self.workers = workers
+        self.stages: dict[str, Stage] = {}
+        self.seconds: float = 0
+
+    def add(self, name: str, run: Callable[[], Any], needs: list[str] | None = None):
+        for need in needs or []:
+            if need not in self.stages:
+                raise ValueError(f"Stage {name} needs {need}, which was not added before it")
+        self.stages[name] = Stage(name, run, list(needs or []))
+
+    def result(self, name: str) -> Any:
+        return self.stages[name].result
+
+    def run(self) -> bool:
+        """Run every stage once the ones it needs are done. Returns whether all succeeded."""
+        time_start = time.perf_counter()
+        waiting = list(self.stages.values())
+        done: set[str] = set()
+        running: dict[Future, Stage] = {}
+
+        def timed(stage: Stage) -> Any:
+            stage.start = time.perf_counter() - time_start
+            try:
+                return stage.run()
+            finally:
+                stage.seconds = time.perf_counter() - time_start - stage.start
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="startup") as executor:
+            while waiting or running:
+                for stage in list(waiting):
+                    if any(self.stages[need].error is not None or self.stages[need].skipped for need in stage.needs):
+                        stage.skipped = True
+                        waiting.remove(stage)
+                        done.add(stage.name)
+                    elif all(need in done for need in stage.needs):
+                        running[executor.submit(timed, stage)] = stage
+                        waiting.remove(stage)
+                if not running:
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    try:
+                        stage.result = future.result()
+                    except BaseException as e:
+                        # exit() in a stage ends up here too
+                        stage.error = e
+                    done.add(stage.name)
+
+        self.seconds = time.perf_counter() - time_start
+        return not any(stage.error is not None or stage.skipped for stage in self.stages.values())
+
+    def print_timings(self):
+        print_header("Startup")
+        width = max(len(name) for name in self.stages) if self.stages else 0
+        for stage in self.stages.values():
+            if stage.skipped:
+                print(f"{stage.name:<{width}}  skipped")
+                continue
+            status = ""
+            if isinstance(stage.error, SystemExit):
+                status = "  failed"  # The stage printed why before exiting
+            elif stage.error is not None:
+                status = f"  failed: {stage.error}"
+            print(
+                f"{stage.name:<{width}}  at {stage.start * 1000:7.1f} ms"
+                f"  took {stage.seconds * 1000:7.1f} ms{status}"
+            )
+        # The time the stages would have taken one after the other
+        serial = sum(stage.seconds for stage in self.stages.values())
+        print(f"\nTotal: {self.seconds * 1000:.1f} ms, {serial * 1000:.1f} ms run one after the other\n")
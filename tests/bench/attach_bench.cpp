@@ -0,0 +1,104 @@
+#include <algorithm>
+#include <chrono>
+#include <cstdint>
+#include <cstdlib>
+#include <dlfcn.h>
+#include <iostream>
+#include <string>
+#include <sys/resource.h>
+#include <vector>
+
+/*
+ * Measures the latency of the first allocations after the hooks are loaded.
+ *
+ * Every record lands in a part of the ring that was never written before, so
+ * without prefaulting each new page of the ring costs a page fault inside a
+ * hooked malloc. The library is loaded with dlopen, like the profiler does
+ * when it attaches, and each malloc_hook/free_hook call is timed. One call is
+ * made before measuring so the lazy setup of the backtrace unwinder is not
+ * counted.
+ *
+ * Usage: attach_bench <hook.so> <allocations>
+ */
+
+size_t const ALLOC_SIZE{64};
+
+uint32_t elapsed_ns(std::chrono::steady_clock::time_point const& start,
+                    std::chrono::steady_clock::time_point const& end) {
+    return std::chrono::duration_cast<std::chrono::nanoseconds>(end - start)
+        .count();
+}
+
+long minor_faults() {
+    rusage usage{};
+    getrusage(RUSAGE_SELF, &usage);
+    return usage.ru_minflt;
+}
+
+void print_percentiles(char const* name, std::vector<uint32_t>& values) {
+    std::sort(values.begin(), values.end());
+    std::cout << "\"" << name << "\": {\"p50\": " << values[values.size() / 2]
+              << ", \"p99\": " << values[values.size() * 99 / 100]
+              << ", \"p999\": " << values[values.size() * 999 / 1000]
+              << ", \"max\": " << values.back() << "}";
+}
+
+int main(int argc, char* argv[]) {
+    if (argc < 3) {
+        std::cerr << "Usage: " << argv[0] << " <hook.so> <allocations>"
+                  << std::endl;
+        return 1;
+    }
+
+    std::string const library{argv[1]};
+    size_t const allocations{std::stoul(argv[2])};
+
+    std::vector<void*> pointers(allocations);
+    std::vector<uint32_t> alloc_ns(allocations);
+    std::vector<uint32_t> free_ns(allocations);
+
+    // Creating the ring, and prefaulting it, happens while the library loads
+    auto const load_start{std::chrono::steady_clock::now()};
+    void* const handle{dlopen(library.c_str(), RTLD_NOW)};
+    auto const load_end{std::chrono::steady_clock::now()};
+    if (!handle) {
+        std::cerr << "Failed to load " << library << ": " << dlerror()
+                  << std::endl;
+        return 1;
+    }
+
+    auto const alloc_fn{
+        reinterpret_cast<void* (*)(uint32_t)>(dlsym(handle, "malloc_hook"))};
+    auto const free_fn{
+        reinterpret_cast<void (*)(void*)>(dlsym(handle, "free_hook"))};
+    if (!alloc_fn || !free_fn) {
+        std::cerr << "Failed to find hooks in " << library << std::endl;
+        return 1;
+    }
+
+    free_fn(alloc_fn(ALLOC_SIZE));
+
+    long const faults_before{minor_faults()};
+    for (size_t i = 0; i < allocations; i++) {
+        auto const start{std::chrono::steady_clock::now()};
+        pointers[i] = alloc_fn(ALLOC_SIZE);
+        auto const end{std::chrono::steady_clock::now()};
+        alloc_ns[i] = elapsed_ns(start, end);
+    }
+    for (size_t i = 0; i < allocations; i++) {
+        auto const start{std::chrono::steady_clock::now()};
+        free_fn(pointers[i]);
+        auto const end{std::chrono::steady_clock::now()};
+        free_ns[i] = elapsed_ns(start, end);
+    }
+    long const faults{minor_faults() - faults_before};
+
+    std::cout << "{\"load_us\": " << elapsed_ns(load_start, load_end) / 1000
+              << ", \"minor_faults\": " << faults << ", ";
+    print_percentiles("malloc", alloc_ns);
+    std::cout << ", ";
+    print_percentiles("free", free_ns);
+    std::cout << "}" << std::endl;
+
+    return 0;
+}
@@ -0,0 +1,92 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+sys.path.insert(0, PROJECT_DIR)
+
+from code_injector import BufferSize, CodeEntry, CodeEntryFactory, CodeInjector
+from shared_buffer import SharedBuffer
+
+DRIVER = os.path.join(BENCH_DIR, "attach_bench")
+
+# Name, prefault, hugepages
+VARIANTS: list[tuple[str, bool, bool]] = [
+    ("no-prefault", False, False),
+    ("prefault", True, False),
+    ("prefault-huge", True, True),
+]
+
+STATISTICS = ["p50", "p99", "p999", "max"]
+
+
+def build_variant(lib_path: str, prefault: bool, hugepages: bool, buffer_entries: int):
+    backtrace = CodeEntryFactory.backtrace_glibc(20)
+    code_entries: list[CodeEntry] = [
+        backtrace,
+        CodeEntryFactory.free_backtrace(backtrace),
+        CodeEntryFactory.buffer_sizes(BufferSize("w", buffer_entries), prefault, hugepages),
+        CodeEntryFactory.timestamp_chrono(),
+        CodeEntryFactory.thread_safe(True),
+    ]
+    CodeInjector.inject(code_entries, lib_path)
+
+
+def run_driver(lib_path: str, allocations: int) -> dict:
+    process = subprocess.Popen([DRIVER, lib_path, str(allocations)], stdout=subprocess.PIPE, text=True)
+    output, _ = process.communicate()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, DRIVER)
+
+    # Nobody reads the ring of the driver, remove it so runs don't add up
+    for path in (f"{SharedBuffer.HUGETLBFS_PREFIX}{process.pid}", f"{SharedBuffer.MOUNT_PREFIX}{process.pid}"):
+        if os.path.exists(path):
+            os.unlink(path)
+    return json.loads(output)
+
+
+def median(runs: list[dict], *keys: str) -> float:
+    values = []
+    for run in runs:
+        for key in keys:
+            run = run[key]
+        values.append(run)
+    return statistics.median(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the latency of the first hooked allocations after attach, with and without a prefaulted ring.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-a", "--allocations", type=int, default=40000, help="Allocations timed per run, each also freed.")
+    parser.add_argument("-r", "--runs", type=int, default=5, help="Fresh processes per variant, medians are reported.")
+    parser.add_argument("-se", "--shm-buffer-entries", type=int, default=100000, help="Ring size of the hooks.")
+    args = parser.parse_args()
+
+    subprocess.run(["make", "-C", BENCH_DIR], check=True)
+
+    rows: list[str] = []
+    with TemporaryDirectory() as build_dir:
+        for name, prefault, hugepages in VARIANTS:
+            lib_path = os.path.join(build_dir, f"hook-{name}.so")
+            build_variant(lib_path, prefault, hugepages, args.shm_buffer_entries)
+            runs = [run_driver(lib_path, args.allocations) for _ in range(args.runs)]
+
+            for op in ["malloc", "free"]:
+                load = f"{median(runs, 'load_us') / 1000:.1f}ms"
+                faults = f"{median(runs, 'minor_faults'):.0f}"
+                columns = "".join(f"{median(runs, op, key):>8.0f}ns" for key in STATISTICS)
+                rows.append(f"{name:<16}{load:>10}{faults:>8}{op:>8}{columns}")
+
+    # After the build output
+    print(f"{'variant':<16}{'load':>10}{'faults':>8}{'op':>8}" + "".join(f"{key:>10}" for key in STATISTICS))
+    print("\n".join(rows))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+sys.path.insert(0, PROJECT_DIR)
+
+from capture import CODECS, CaptureReader, CaptureWriter, PendingEvents
+from shared_buffer import TRACE_SIZE, Memtracker, SharedBuffer
+from shm_producer import generate_sequence
+
+
+def generate_events(args) -> list[PendingEvents]:
+    """Run a synthetic sequence through a Memtracker and take the events it queued for capture"""
+    sequence = generate_sequence(args.sequence_length, args.stack_depth, args.stacks, args.alloc_ratio, args.reuse, 0)
+    rng = np.random.default_rng(0)
+    memtracker = Memtracker(None, 1)
+    memtracker.capture = CaptureWriter(os.devnull)
+
+    timestamp = time.time_ns()
+    for start in range(0, args.events, len(sequence)):
+        records = sequence[: args.events - start].copy()
+        # Events a few microseconds apart, like a busy process
+        records["time"] = timestamp + np.cumsum(rng.integers(200, 5000, len(records)))
+        timestamp = int(records["time"][-1])
+        for batch in range(0, len(records), SharedBuffer.BATCH_RECORDS):
+            memtracker.add_batch(records[batch : batch + SharedBuffer.BATCH_RECORDS])
+
+    return memtracker.capture.take()
+
+
+def measure(taken: list[PendingEvents], codec: str, directory: str) -> dict:
+    path = os.path.join(directory, f"capture.{codec}")
+    writer = CaptureWriter(path, codec)
+
+    start = time.perf_counter()
+    writer.write(taken)
+    writer.close()
+    encode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reader = CaptureReader(path)
+    events = sum(len(block) for _, block in reader.events())
+    reader.close()
+    decode = time.perf_counter() - start
+
+    # Throughput is measured in bytes of the raw ring records the events came from
+    raw_bytes = events * TRACE_SIZE
+    return {
+        "codec": codec,
+        "events": events,
+        "bytes_per_event": os.path.getsize(path) / events,
+        "encode_mb_per_second": raw_bytes / encode / 10**6,
+        "decode_mb_per_second": raw_bytes / decode / 10**6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the size and speed of capture files against the raw ring layout.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-e", "--events", type=int, default=1_000_000, help="Events to capture.")
+    parser.add_argument("-l", "--sequence-length", type=int, default=1 << 16, help="Length of the generated sequence, repeated until enough events are made.")
+    parser.add_argument("-sd", "--stack-depth", type=int, default=12, help="Backtrace depth of each record.")
+    parser.add_argument("-s", "--stacks", type=int, default=256, help="Number of distinct call stacks.")
+    parser.add_argument("-a", "--alloc-ratio", type=float, default=0.5, help="Fraction of records that are allocations.")
+    parser.add_argument("-ru", "--reuse", default="lifo", choices=["lifo", "random", "none"], help="Address reuse pattern.")
+    parser.add_argument("-c", "--codecs", nargs="+", default=list(CODECS), choices=list(CODECS), help="Codecs to measure.")
+    args = parser.parse_args()
+
+    taken = generate_events(args)
+    print(f"raw    {TRACE_SIZE:>8.2f} bytes/event")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for codec in args.codecs:
+            result = measure(taken, codec, directory)
+            print(
+                f"{codec:<6} {result['bytes_per_event']:>8.2f} bytes/event  "
+                f"({TRACE_SIZE / result['bytes_per_event']:.1f}x smaller)  "
+                f"encode={result['encode_mb_per_second']:>7.1f}MB/s  "
+                f"decode={result['decode_mb_per_second']:>7.1f}MB/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+#include <algorithm>
+#include <atomic>
+#include <chrono>
+#include <cstdint>
+#include <cstdlib>
+#include <cstring>
+#include <dlfcn.h>
+#include <fcntl.h>
+#include <iostream>
+#include <string>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <thread>
+#include <unistd.h>
+#include <vector>
+
+#include "../../hook_lib/ring_layout.h"
+
+/*
+ * Measures the cost of a single allocation/free through the hooks.
+ *
+ * The hook library is loaded with dlopen and malloc_hook/free_hook are called
+ * directly, the same functions the PLT entries are redirected to when the
+ * profiler attaches. Passing "none" as library times plain malloc/free, which
+ * gives the baseline to compare against.
+ *
+ * Usage: hook_bench <hook.so|none> <threads> <iterations>
+ */
+
+size_t const ALLOC_SIZES[] = {16, 32, 64, 128, 256, 512, 1024, 4096, 65536, 1048576};
+size_t const NUM_SIZES{sizeof(ALLOC_SIZES) / sizeof(ALLOC_SIZES[0])};
+
+void* (*alloc_fn)(uint32_t) = nullptr;
+void (*free_fn)(void*) = nullptr;
+
+void* plain_malloc(uint32_t size) { return malloc(size); }
+void plain_free(void* ptr) { free(ptr); }
+
+struct Samples {
+    std::vector<uint32_t> alloc_ns;
+    std::vector<uint32_t> free_ns;
+};
+
+struct Percentiles {
+    double p50;
+    double p99;
+    double mean;
+};
+
+std::atomic<bool> running{true};
+std::atomic<size_t> ready{0};
+
+/* Stand in for the profiler: keep the ring empty so writes are not dropped */
+void drain_ring() {
+    // The hooks are loaded into this process, so they use our pid
+    std::string const name{"/mem_hook_" + std::to_string(getpid())};
+    int const fd{shm_open(name.c_str(), O_RDWR, 0666)};
+    if (fd == -1) {
+        return;
+    }
+
+    void* const memory{mmap(nullptr, HEAD_SIZE, PROT_READ | PROT_WRITE,
+                            MAP_SHARED, fd, 0)};
+    if (memory == MAP_FAILED) {
+        close(fd);
+        return;
+    }
+
+    uint32_t* const head{reinterpret_cast<uint32_t*>(memory)};
+    uint32_t* const tail{head + 1};
+
+    while (running.load(std::memory_order_relaxed)) {
+        __atomic_store_n(head, __atomic_load_n(tail, __ATOMIC_ACQUIRE),
+                         __ATOMIC_RELEASE);
+        std::this_thread::sleep_for(std::chrono::microseconds(500));
+    }
+
+    munmap(memory, HEAD_SIZE);
+    close(fd);
+}
+
+uint32_t elapsed_ns(std::chrono::steady_clock::time_point const& start,
+                    std::chrono::steady_clock::time_point const& end) {
+    return std::chrono::duration_cast<std::chrono::nanoseconds>(end - start)
+        .count();
+}
+
+void run_thread(size_t num_threads, size_t iterations,
+                std::vector<Samples>& samples) {
+    std::vector<void*> pointers(iterations);
+
+    // Warm up the allocator and the hook before measuring
+    for (size_t i = 0; i < iterations; i++) {
+        pointers[i] = alloc_fn(256);
+    }
+    for (void* const ptr : pointers) {
+        free_fn(ptr);
+    }
+
+    ready.fetch_add(1);
+    while (ready.load() < num_threads) {
+    }
+
+    for (size_t s = 0; s < NUM_SIZES; s++) {
+        size_t const size{ALLOC_SIZES[s]};
+        Samples& sample{samples[s]};
+
+        for (size_t i = 0; i < iterations; i++) {
+            auto const start{std::chrono::steady_clock::now()};
+            pointers[i] = alloc_fn(size);
+            auto const end{std::chrono::steady_clock::now()};
+            sample.alloc_ns[i] = elapsed_ns(start, end);
+        }
+
+        for (size_t i = 0; i < iterations; i++) {
+            auto const start{std::chrono::steady_clock::now()};
+            free_fn(pointers[i]);
+            auto const end{std::chrono::steady_clock::now()};
+            sample.free_ns[i] = elapsed_ns(start, end);
+        }
+    }
+}
+
+Percentiles percentiles(std::vector<uint32_t>& values) {
+    std::sort(values.begin(), values.end());
+    double sum{0};
+    for (uint32_t const value : values) {
+        sum += value;
+    }
+    return {static_cast<double>(values[values.size() / 2]),
+            static_cast<double>(values[values.size() * 99 / 100]),
+            sum / values.size()};
+}
+
+void print_percentiles(char const* name, Percentiles const& p) {
+    std::cout << "\"" << name << "\": {\"p50\": " << p.p50
+              << ", \"p99\": " << p.p99 << ", \"mean\": " << p.mean << "}";
+}
+
+int main(int argc, char* argv[]) {
+    if (argc < 4) {
+        std::cerr << "Usage: " << argv[0]
+                  << " <hook.so|none> <threads> <iterations>" << std::endl;
+        return 1;
+    }
+
+    std::string const library{argv[1]};
+    size_t const num_threads{std::stoul(argv[2])};
+    size_t const iterations{std::stoul(argv[3])};
+
+    if (library == "none") {
+        alloc_fn = plain_malloc;
+        free_fn = plain_free;
+    } else {
+        void* const handle{dlopen(library.c_str(), RTLD_NOW)};
+        if (!handle) {
+            std::cerr << "Failed to load " << library << ": " << dlerror()
+                      << std::endl;
+            return 1;
+        }
+        alloc_fn = reinterpret_cast<void* (*)(uint32_t)>(
+            dlsym(handle, "malloc_hook"));
+        free_fn = reinterpret_cast<void (*)(void*)>(dlsym(handle, "free_hook"));
+        if (!alloc_fn || !free_fn) {
+            std::cerr << "Failed to find hooks in " << library << std::endl;
+            return 1;
+        }
+    }
+
+    std::thread drainer{drain_ring};
+
+    std::vector<std::vector<Samples>> samples(
+        num_threads, std::vector<Samples>(NUM_SIZES));
+    for (auto& thread_samples : samples) {
+        for (Samples& sample : thread_samples) {
+            sample.alloc_ns.resize(iterations);
+            sample.free_ns.resize(iterations);
+        }
+    }
+
+    std::vector<std::thread> threads{};
+    for (size_t t = 0; t < num_threads; t++) {
+        threads.emplace_back(run_thread, num_threads, iterations,
+                             std::ref(samples[t]));
+    }
+    for (std::thread& thread : threads) {
+        thread.join();
+    }
+
+    running = false;
+    drainer.join();
+
+    // Merge the samples of all threads per size class
+    std::cout << "{";
+    for (size_t s = 0; s < NUM_SIZES; s++) {
+        std::vector<uint32_t> alloc_ns{};
+        std::vector<uint32_t> free_ns{};
+        for (auto const& thread_samples : samples) {
+            alloc_ns.insert(alloc_ns.end(), thread_samples[s].alloc_ns.begin(),
+                            thread_samples[s].alloc_ns.end());
+            free_ns.insert(free_ns.end(), thread_samples[s].free_ns.begin(),
+                           thread_samples[s].free_ns.end());
+        }
+
+        std::cout << (s ? ", " : "") << "\"" << ALLOC_SIZES[s] << "\": {";
+        print_percentiles("malloc", percentiles(alloc_ns));
+        std::cout << ", ";
+        print_percentiles("free", percentiles(free_ns));
+        std::cout << "}";
+    }
+    std::cout << "}" << std::endl;
+
+    return 0;
+}
@@ -0,0 +1,90 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+sys.path.insert(0, PROJECT_DIR)
+
+from capture import CAPTURE_DTYPE, CaptureReader, CaptureWriter, PendingEvents
+from query import CaptureQuery, Query
+
+PID = 1
+SECONDS = 3600  # Length of the synthetic run
+PHASES = 60  # Call sites and threads change every minute
+
+
+def write_capture(path: str, args) -> list[tuple[int, ...]]:
+    """A run of an hour where every minute has its own call sites and threads, sizes are heavy tailed"""
+    rng = np.random.default_rng(0)
+    stacks = [tuple(rng.integers(1 << 40, 1 << 41, args.stack_depth).tolist()) for _ in range(args.stacks)]
+    writer = CaptureWriter(path)
+    origin = time.time_ns()
+    batch = 1 << 20
+
+    for start in range(0, args.events, batch):
+        count = min(batch, args.events - start)
+        events = np.zeros(count, dtype=CAPTURE_DTYPE)
+        positions = np.arange(start, start + count)
+        events["time"] = origin + positions * (SECONDS * 10**9 // args.events)
+        events["address"] = rng.integers(0, 1 << 40, count)
+        events["size"] = np.minimum(rng.pareto(1.2, count) * 64, 1 << 30).astype(np.uint64)
+        events["type"] = rng.integers(0, 8, count)
+        phase = positions * PHASES // args.events
+        sites = args.stacks // PHASES
+        events["stack_id"] = phase * sites + rng.integers(0, sites, count)
+        events["tid"] = 1000 + phase * 4 + rng.integers(0, 4, count)
+        writer.write([PendingEvents(PID, 0 if start == 0 else len(stacks), stacks if start == 0 else [], events)])
+
+    writer.close()
+    return stacks
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time selective queries over a synthetic capture against a full scan.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-e", "--events", type=int, default=10_000_000, help="Events in the capture.")
+    parser.add_argument("-s", "--stacks", type=int, default=6000, help="Number of distinct call stacks.")
+    parser.add_argument("-sd", "--stack-depth", type=int, default=12, help="Frames per call stack.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "capture.zlib")
+        start = time.perf_counter()
+        stacks = write_capture(path, args)
+        print(f"Wrote {args.events} events ({os.path.getsize(path) / 10**6:.1f}MB) in {time.perf_counter() - start:.1f}s\n")
+
+        start = time.perf_counter()
+        reader = CaptureReader(path)
+        engine = CaptureQuery(reader)
+        print(f"open        {time.perf_counter() - start:>8.3f}s")
+
+        origin = int(engine.blocks["first_time"].min())
+        minute = 60 * 10**9
+        frame = hex(stacks[37 * (args.stacks // PHASES)][4])
+        queries = {
+            "minute": Query(start=origin + 37 * minute, end=origin + 38 * minute - 1),
+            "minute+size": Query(start=origin + 37 * minute, end=origin + 38 * minute - 1, min_size=2 << 20, max_size=8 << 20),
+            "thread": Query(tids=[1000 + 37 * 4]),
+            "frame": Query(frames=[frame]),
+            "size": Query(min_size=2 << 20, max_size=8 << 20),
+            "scan": Query(types=list(range(8))),
+        }
+        for name, query in queries.items():
+            matched = sum(len(events) for _, events in engine.run(query))
+            statistics = engine.statistics
+            print(
+                f"{name:<12}{statistics.seconds:>8.3f}s  {matched:>10} matches  "
+                f"{statistics.scanned_blocks:>5}/{statistics.blocks} blocks"
+            )
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+sys.path.insert(0, PROJECT_DIR)
+
+from metrics import Metrics
+from shared_buffer import Memtracker, SharedBuffer
+from shm_producer import SyntheticProducer
+
+PAGE_SIZE = resource.getpagesize()
+POLL_SECONDS = 0.001  # Wait after a read that found the ring empty, the producer keeps the CPU
+
+
+def get_rss() -> int:
+    with open("/proc/self/statm", "r") as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+def produce(args, rate: float, pid: int, ready, results):
+    producer = SyntheticProducer(
+        args.shm_buffer_entries, args.stack_depth, args.stacks, args.alloc_ratio, args.reuse, pid=pid
+    )
+    ready.set()
+    producer.run(rate, args.duration)
+    results.put((producer.written, producer.dropped))
+    producer.close()
+
+
+def measure(args, rate: float) -> dict:
+    """Run the producer at rate and drain it with SharedBuffer.read and Memtracker"""
+    ready = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    pid = os.getpid()
+    process = multiprocessing.Process(target=produce, args=(args, rate, pid, ready, results))
+    process.start()
+    ready.wait()
+
+    memtracker = Memtracker(None)
+    metrics = Metrics()
+    rss_start = get_rss()
+    wall_start = time.perf_counter()
+    # Only the reads that returned records count, the polls of an empty ring don't
+    read_seconds = 0.0
+    cpu = 0.0
+
+    def read():
+        nonlocal read_seconds, cpu
+        events = metrics.events
+        read_start = time.perf_counter()
+        cpu_start = time.process_time()
+        shared_buffer.read(memtracker)
+        if metrics.events == events:
+            return False
+        cpu += time.process_time() - cpu_start
+        read_seconds += time.perf_counter() - read_start
+        return True
+
+    with SharedBuffer(pid, "chrono", metrics) as shared_buffer:
+        while process.is_alive():
+            if not read():
+                time.sleep(POLL_SECONDS)
+        # Drain whatever was written after the last read
+        read()
+
+    wall = time.perf_counter() - wall_start
+    rss = get_rss() - rss_start
+    written, dropped = results.get()
+    process.join()
+
+    events = metrics.events
+    millions = max(events, 1) / 10**6
+    return {
+        "rate": rate,
+        "events": events,
+        "dropped": dropped,
+        "events_per_second": events / wall,
+        "read_events_per_second": events / read_seconds if read_seconds else 0.0,
+        "cpu_seconds_per_million": cpu / millions,
+        "rss_bytes_per_million": rss / millions,
+    }
+
+
+def print_result(result: dict):
+    print(
+        f"rate={result['rate']:>10.0f}/s  read={result['events_per_second']:>10.0f}/s  "
+        f"capacity={result['read_events_per_second']:>10.0f}/s  dropped={result['dropped']:>8}  cpu={result['cpu_seconds_per_million']:.2f}s/M  "
+        f"rss={result['rss_bytes_per_million'] / 2**20:.1f}MB/M"
+    )
+
+
+def sustained(result: dict) -> bool:
+    """The reader kept up if nothing was dropped and the ring did not build a backlog"""
+    return not result["dropped"] and result["events_per_second"] >= 0.95 * result["rate"]
+
+
+def find_max_rate(args) -> float:
+    """Double the rate until the reader falls behind, then narrow down the limit"""
+    low, high = 0.0, args.rate
+    while True:
+        result = measure(args, high)
+        print_result(result)
+        if not sustained(result):
+            break
+        low, high = high, high * 2
+
+    for _ in range(args.steps):
+        rate = (low + high) / 2
+        result = measure(args, rate)
+        print_result(result)
+        if not sustained(result):
+            high = rate
+        else:
+            low = rate
+
+    return low
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure how many records per second SharedBuffer.read and Memtracker sustain.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-r", "--rate", type=float, default=50000, help="Records per second (starting rate with --find-max).")
+    parser.add_argument("-d", "--duration", type=float, default=5, help="Seconds each measurement runs.")
+    parser.add_argument("-m", "--find-max", action="store_true", help="Search for the highest rate the reader sustains without overflow.")
+    parser.add_argument("-n", "--steps", type=int, default=4, help="Bisection steps when searching the maximum rate.")
+    parser.add_argument("-se", "--shm-buffer-entries", type=int, default=100000, help="Ring size in records.")
+    parser.add_argument("-sd", "--stack-depth", type=int, default=12, help="Backtrace depth of each record.")
+    parser.add_argument("-s", "--stacks", type=int, default=256, help="Number of distinct call stacks.")
+    parser.add_argument("-a", "--alloc-ratio", type=float, default=0.5, help="Fraction of records that are allocations.")
+    parser.add_argument("-ru", "--reuse", default="lifo", choices=["lifo", "random", "none"], help="Address reuse pattern.")
+    args = parser.parse_args()
+
+    if args.find_max:
+        rate = find_max_rate(args)
+        print(f"Maximum sustained rate: {rate:.0f} records/s")
+    else:
+        print_result(measure(args, args.rate))
+
+
+if __name__ == "__main__":
+    main()
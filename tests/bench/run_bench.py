@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+from itertools import product
+from tempfile import TemporaryDirectory
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+sys.path.insert(0, PROJECT_DIR)
+
+from code_injector import BufferSize, CodeEntry, CodeEntryFactory, CodeInjector
+
+DRIVER = os.path.join(BENCH_DIR, "hook_bench")
+BASELINE = "none"
+
+BACKTRACE_METHODS = ["fast", "glibc"]
+TIMESTAMP_METHODS = ["chrono", "rdtscp"]
+THREAD_SAFE = [False, True]
+
+
+def variant_name(backtrace_method: str, timestamp_method: str, thread_safe: bool) -> str:
+    return f"{backtrace_method}-{timestamp_method}-{'safe' if thread_safe else 'unsafe'}"
+
+
+def build_variant(
+    lib_path: str,
+    backtrace_method: str,
+    timestamp_method: str,
+    thread_safe: bool,
+    max_backtraces: int,
+    buffer_entries: int,
+):
+    code_entries: list[CodeEntry] = [
+        CodeEntryFactory.buffer_sizes(BufferSize("w", buffer_entries)),
+        CodeEntryFactory.thread_safe(thread_safe),
+    ]
+
+    if backtrace_method == "fast":
+        backtrace = CodeEntryFactory.backtrace_fast(max_backtraces)
+    else:
+        backtrace = CodeEntryFactory.backtrace_glibc(max_backtraces)
+    code_entries.append(backtrace)
+    code_entries.append(CodeEntryFactory.free_backtrace(backtrace))
+
+    if timestamp_method == "rdtscp":
+        code_entries.append(CodeEntryFactory.timestamp_rdtscp())
+    elif timestamp_method == "chrono":
+        code_entries.append(CodeEntryFactory.timestamp_chrono())
+
+    CodeInjector.inject(code_entries, lib_path)
+
+
+def run_driver(lib_path: str, threads: int, iterations: int) -> dict:
+    output = subprocess.run(
+        [DRIVER, lib_path, str(threads), str(iterations)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(output.stdout)
+
+
+def get_commit() -> str:
+    output = subprocess.run(
+        ["git", "-C", PROJECT_DIR, "rev-parse", "--short", "HEAD"],
+        capture_output=True,
+        text=True,
+    )
+    return output.stdout.strip()
+
+
+def compare(baseline: dict, result: dict):
+    """Print the change in p50/p99 for every measurement present in both runs"""
+    print(f"{'variant':<22}{'threads':>8}{'size':>9}{'op':>8}{'p50':>20}{'p99':>20}")
+
+    for variant, per_thread in result["results"].items():
+        for threads, per_size in per_thread.items():
+            for size, per_op in per_size.items():
+                for op, new in per_op.items():
+                    try:
+                        old = baseline["results"][variant][threads][size][op]
+                    except KeyError:
+                        continue
+
+                    columns = []
+                    for key in ["p50", "p99"]:
+                        change = (new[key] - old[key]) / old[key] * 100 if old[key] else 0
+                        columns.append(f"{old[key]:.0f}->{new[key]:.0f} ({change:+.0f}%)")
+
+                    print(f"{variant:<22}{threads:>8}{size:>9}{op:>8}{columns[0]:>20}{columns[1]:>20}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the per-allocation overhead of each hook.so configuration.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-t", "--threads", type=int, nargs="+", default=[1, 4], help="Thread counts to run.")
+    parser.add_argument("-i", "--iterations", type=int, default=10000, help="Allocations per size class and thread.")
+    parser.add_argument("-mb", "--max-backtraces", type=int, default=20, help="Backtrace depth of the hooks.")
+    parser.add_argument("-se", "--shm-buffer-entries", type=int, default=100000, help="Ring size of the hooks.")
+    parser.add_argument("-o", "--output", default="bench.json", help="File the JSON results are written to.")
+    parser.add_argument("-b", "--baseline", default=None, help="Earlier results to compare against.")
+    args = parser.parse_args()
+
+    subprocess.run(["make", "-C", BENCH_DIR], check=True)
+
+    results: dict[str, dict] = {BASELINE: {}}
+    for threads in args.threads:
+        print(f"Running {BASELINE} with {threads} thread(s)")
+        results[BASELINE][str(threads)] = run_driver(BASELINE, threads, args.iterations)
+
+    with TemporaryDirectory() as build_dir:
+        for backtrace_method, timestamp_method, thread_safe in product(
+            BACKTRACE_METHODS, TIMESTAMP_METHODS, THREAD_SAFE
+        ):
+            name = variant_name(backtrace_method, timestamp_method, thread_safe)
+            lib_path = os.path.join(build_dir, f"hook-{name}.so")
+            build_variant(
+                lib_path,
+                backtrace_method,
+                timestamp_method,
+                thread_safe,
+                args.max_backtraces,
+                args.shm_buffer_entries,
+            )
+
+            results[name] = {}
+            for threads in args.threads:
+                print(f"Running {name} with {threads} thread(s)")
+                results[name][str(threads)] = run_driver(lib_path, threads, args.iterations)
+
+    output = {
+        "commit": get_commit(),
+        "iterations": args.iterations,
+        "max_backtraces": args.max_backtraces,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+    print(f"Results written to '{args.output}'")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            compare(json.load(f), output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import argparse
+import mmap
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+sys.path.insert(0, PROJECT_DIR)
+
+from shared_buffer import HEAD_SIZE, MAX_BACKTRACES, TRACE_DTYPE, TRACE_SIZE, SharedBuffer, TraceType
+
+# Base of the fake heap and text segment the generated records point into
+HEAP_BASE = 0x5555_0000_0000
+TEXT_BASE = 0x7F00_0000_0000
+
+# Every call site belongs to one of these threads
+TID_BASE = 1000
+THREADS = 8
+
+
+def generate_sequence(
+    length: int,
+    stack_depth: int,
+    stacks: int,
+    alloc_ratio: float,
+    reuse: str,
+    seed: int,
+) -> np.ndarray:
+    """Generate a looped alloc/free sequence where every free matches an earlier allocation"""
+    rng = random.Random(seed)
+    sequence = np.zeros(length, dtype=TRACE_DTYPE)
+
+    call_sites = [
+        [TEXT_BASE + rng.randrange(0, 1 << 24) for _ in range(stack_depth)]
+        for _ in range(stacks)
+    ]
+    sizes = [16, 24, 32, 48, 64, 128, 256, 1024, 4096, 65536]
+
+    live: list[int] = []
+    freed: list[int] = []
+    next_address = HEAP_BASE
+
+    for i in range(length):
+        record = sequence[i]
+        if live and rng.random() >= alloc_ratio:
+            address = live.pop(rng.randrange(len(live)))
+            freed.append(address)
+            record["type"] = TraceType.FREE
+        else:
+            if reuse == "lifo" and freed:
+                address = freed.pop()
+            elif reuse == "random" and freed:
+                address = freed.pop(rng.randrange(len(freed)))
+            else:
+                address = next_address
+                next_address += 64
+            live.append(address)
+            record["type"] = TraceType.MALLOC
+            record["size"] = rng.choice(sizes)
+
+        record["address"] = address
+        record["backtrace_size"] = stack_depth
+        site = rng.randrange(stacks)
+        record["backtraces"][:stack_depth] = call_sites[site]
+        record["tid"] = TID_BASE + site % THREADS
+
+    return sequence
+
+
+class SyntheticProducer:
+    """
+    Writes generated Trace records into the shared memory ring the same way
+    the hook library does, so the reader can be exercised without a target
+    process or gdb.
+    """
+
+    def __init__(
+        self,
+        entries: int = 100000,
+        stack_depth: int = 12,
+        stacks: int = 256,
+        alloc_ratio: float = 0.5,
+        reuse: str = "lifo",
+        sequence_length: int = 1 << 16,
+        pid: int | None = None,
+        seed: int = 0,
+    ):
+        # The ring is named after the pid the reader is told to attach to
+        self.pid = os.getpid() if pid is None else pid
+        self.mount = SharedBuffer.mount(self.pid)
+        self.entries = entries
+        self.sequence = generate_sequence(
+            sequence_length, min(stack_depth, MAX_BACKTRACES), stacks, alloc_ratio, reuse, seed
+        )
+        self.position = 0
+        self.written = 0
+        self.dropped = 0
+
+        # Create the ring with the same layout as Buffer::Buffer
+        self.fd = os.open(self.mount, os.O_CREAT | os.O_RDWR, 0o666)
+        os.ftruncate(self.fd, HEAD_SIZE + entries * TRACE_SIZE)
+        self.mem = mmap.mmap(self.fd, HEAD_SIZE + entries * TRACE_SIZE)
+        self.header = np.frombuffer(self.mem, dtype="<u4", count=HEAD_SIZE // 4)
+        self.records = np.frombuffer(self.mem, dtype=TRACE_DTYPE, count=entries, offset=HEAD_SIZE)
+        self.header[:] = 0
+        self.header[4] = entries
+
+    def close(self):
+        del self.header
+        del self.records
+        self.mem.close()
+        os.close(self.fd)
+        os.unlink(self.mount)
+
+    def free_space(self) -> int:
+        head, tail = int(self.header[0]), int(self.header[1])
+        return (head - tail - 1) % self.entries
+
+    def write(self, count: int) -> int:
+        """Write up to count records, returns the number that fit in the ring"""
+        space = self.free_space()
+        if count > space:
+            self.dropped += count - space
+            self.header[2] += count - space
+            count = space
+
+        tail = int(self.header[1])
+        written = 0
+        while written < count:
+            chunk = min(
+                count - written,
+                self.entries - tail,
+                len(self.sequence) - self.position,
+            )
+            batch = self.records[tail : tail + chunk]
+            batch[:] = self.sequence[self.position : self.position + chunk]
+            batch["time"] = time.time_ns()
+
+            tail = (tail + chunk) % self.entries
+            self.position = (self.position + chunk) % len(self.sequence)
+            written += chunk
+
+        self.header[1] = tail
+        self.written += count
+        return count
+
+    def run(self, rate: float, duration: float, interval: float = 0.001):
+        """Produce rate records per second for duration seconds"""
+        start = time.perf_counter()
+        produced = 0
+
+        while (elapsed := time.perf_counter() - start) < duration:
+            due = int(rate * elapsed) - produced
+            if due > 0:
+                self.write(due)
+                produced += due
+            time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write synthetic allocation records into the profiler's shared memory ring.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-p", "--pid", type=int, default=None, help="Pid to name the ring after, defaults to our own.")
+    parser.add_argument("-r", "--rate", type=float, default=100000, help="Records per second.")
+    parser.add_argument("-d", "--duration", type=float, default=10, help="Seconds to produce for.")
+    parser.add_argument("-se", "--shm-buffer-entries", type=int, default=100000, help="Ring size in records.")
+    parser.add_argument("-sd", "--stack-depth", type=int, default=12, help="Backtrace depth of each record.")
+    parser.add_argument("-s", "--stacks", type=int, default=256, help="Number of distinct call stacks.")
+    parser.add_argument("-a", "--alloc-ratio", type=float, default=0.5, help="Fraction of records that are allocations.")
+    parser.add_argument(
+        "-ru",
+        "--reuse",
+        default="lifo",
+        choices=["lifo", "random", "none"],
+        help="How freed addresses are handed out again: most recently freed first, at random, or never.",
+    )
+    args = parser.parse_args()
+
+    producer = SyntheticProducer(
+        args.shm_buffer_entries, args.stack_depth, args.stacks, args.alloc_ratio, args.reuse, pid=args.pid
+    )
+    print(f"Writing to {producer.mount}")
+    try:
+        producer.run(args.rate, args.duration)
+    except KeyboardInterrupt:
+        pass
+    print(f"Written: {producer.written}, dropped: {producer.dropped}")
+    producer.close()
+
+
+if __name__ == "__main__":
+    main()
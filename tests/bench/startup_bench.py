@@ -0,0 +1,109 @@
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from tempfile import TemporaryDirectory
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+sys.path.insert(0, PROJECT_DIR)
+
+from code_injector import BufferSize, CodeEntry, CodeEntryFactory, CodeInjector
+from hook_manager import HookManager
+
+# Sleeps in a process with a large executable, the worst case for objdump
+TARGET = [sys.executable, "-c", "import time; time.sleep(600)"]
+
+
+def code_entries(buffer_entries: int) -> list[CodeEntry]:
+    backtrace = CodeEntryFactory.backtrace_glibc(20)
+    return [
+        backtrace,
+        CodeEntryFactory.free_backtrace(backtrace),
+        CodeEntryFactory.buffer_sizes(BufferSize("w", buffer_entries)),
+        CodeEntryFactory.timestamp_chrono(),
+        CodeEntryFactory.thread_safe(True),
+    ]
+
+
+def timed(func) -> float:
+    """Milliseconds func took"""
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) * 1000
+
+
+def analyze(pid: int) -> HookManager:
+    hook_manager = HookManager(pid, debug=False)
+    hook_manager.register_hook("malloc")
+    hook_manager.register_hook("free")
+    return hook_manager
+
+
+def attach(hook_manager: HookManager, lib_path: str):
+    hook_manager.inject(lib_path).close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the stages of attaching: building the hooks with and without the build cache, finding the GOT slots, and the gdb session.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-r", "--runs", type=int, default=3, help="Runs per stage, medians are reported.")
+    parser.add_argument("-se", "--shm-buffer-entries", type=int, default=100000, help="Ring size of the hooks.")
+    args = parser.parse_args()
+
+    rows: dict[str, float] = {}
+    with TemporaryDirectory() as cache_home:
+        # Builds go to a cache of their own, the one of the user is left alone
+        os.environ["XDG_CACHE_HOME"] = cache_home
+        entries = code_entries(args.shm_buffer_entries)
+        lib_path = os.path.join(cache_home, CodeInjector.LIB_NAME)
+
+        cold = []
+        for _ in range(args.runs):
+            shutil.rmtree(CodeInjector.get_cache_dir(), ignore_errors=True)
+            cold.append(timed(lambda: CodeInjector.inject(entries, lib_path)))
+        rows["build"] = statistics.median(cold)
+        rows["build, cached"] = statistics.median(
+            [timed(lambda: CodeInjector.inject(entries, lib_path)) for _ in range(args.runs)]
+        )
+
+        target = subprocess.Popen(TARGET)
+        try:
+            rows["analyze"] = statistics.median([timed(lambda: analyze(target.pid)) for _ in range(args.runs)])
+            rows["objdump -d"] = statistics.median(
+                [
+                    timed(lambda: subprocess.run(["objdump", "-d", target.args[0]], capture_output=True))
+                    for _ in range(args.runs)
+                ]
+            )
+
+            # Both gdb sessions, the one setting the hooks and the one restoring them
+            if shutil.which("gdb") and os.getuid() == 0:
+                hook_manager = analyze(target.pid)
+                rows["attach and detach"] = statistics.median(
+                    [timed(lambda: attach(hook_manager, lib_path)) for _ in range(args.runs)]
+                )
+        finally:
+            target.kill()
+            target.wait()
+
+    # After the build output
+    print(f"\n{'stage':<20}{'median':>12}")
+    for name, milliseconds in rows.items():
+        print(f"{name:<20}{milliseconds:>10.1f}ms")
+    if "attach and detach" not in rows:
+        print("gdb sessions not measured, they need gdb and root")
+
+    # The build and the analysis run side by side, gdb attaches after both, one of the two sessions
+    for build in ["build", "build, cached"]:
+        startup = max(rows[build], rows["analyze"]) + rows.get("attach and detach", 0) / 2
+        print(f"Startup with {build.replace(',', '')}: {startup:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
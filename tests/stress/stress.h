@@ -0,0 +1,284 @@
+#pragma once
+#include <atomic>
+#include <chrono>
+#include <cstdint>
+#include <cstdlib>
+#include <cstring>
+#include <dlfcn.h>
+#include <fcntl.h>
+#include <functional>
+#include <iostream>
+#include <new>
+#include <string>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <thread>
+#include <unistd.h>
+#include <vector>
+
+#include "../../hook_lib/ring_layout.h"
+
+/*
+ * Shared driver for the multi-threaded stress targets.
+ *
+ * Usage: <target> [threads] [iterations] [--hook path/to/hook.so]
+ *
+ * Without --hook the target uses the regular allocator and waits for Enter so
+ * the profiler can attach to it. With --hook the hooks are loaded with dlopen
+ * and called directly, and a consumer thread drains the shared memory ring so
+ * the number of records received can be checked against the calls made.
+ *
+ * Every target is built as <name>_fp and <name>_nofp. The 'fast' backtrace
+ * method follows the frame pointer chain, so the _nofp builds are expected to
+ * crash with it and should be run against a 'glibc' backtrace build.
+ */
+
+namespace stress {
+
+size_t const TRACE_SIZE{32 + 8 * 20};
+size_t const TYPE_OFFSET{24}; // uint16_t TraceType, followed by the uint16_t cpu
+uint16_t const FIRST_FREE_TYPE{4}; // TraceType::FREE, everything below is an allocation
+
+inline void* default_malloc(uint32_t size) { return std::malloc(size); }
+inline void default_free(void* ptr) { std::free(ptr); }
+inline void* default_new(uint32_t size) { return ::operator new(size); }
+inline void default_delete(void* ptr) { ::operator delete(ptr); }
+inline void* default_new_array(uint32_t size) { return ::operator new[](size); }
+inline void default_delete_array(void* ptr) { ::operator delete[](ptr); }
+
+struct Allocator {
+    void* (*malloc)(uint32_t) = default_malloc;
+    void (*free)(void*) = default_free;
+    void* (*new_object)(uint32_t) = default_new;
+    void (*delete_object)(void*) = default_delete;
+    void* (*new_array)(uint32_t) = default_new_array;
+    void (*delete_array)(void*) = default_delete_array;
+};
+
+inline Allocator allocator{};
+
+struct Counts {
+    uint64_t allocs{0};
+    uint64_t frees{0};
+};
+
+inline std::atomic<uint64_t> total_allocs{0};
+inline std::atomic<uint64_t> total_frees{0};
+inline thread_local Counts counts{};
+
+/* Allocation wrappers used by the workloads, they count every call */
+inline void* alloc_malloc(uint32_t size) {
+    counts.allocs++;
+    return allocator.malloc(size);
+}
+
+inline void release_malloc(void* ptr) {
+    counts.frees++;
+    allocator.free(ptr);
+}
+
+inline void* alloc_new(uint32_t size) {
+    counts.allocs++;
+    return allocator.new_object(size);
+}
+
+inline void release_new(void* ptr) {
+    counts.frees++;
+    allocator.delete_object(ptr);
+}
+
+inline void* alloc_new_array(uint32_t size) {
+    counts.allocs++;
+    return allocator.new_array(size);
+}
+
+inline void release_new_array(void* ptr) {
+    counts.frees++;
+    allocator.delete_array(ptr);
+}
+
+/* Must be called at the end of every worker thread */
+inline void publish_counts() {
+    total_allocs += counts.allocs;
+    total_frees += counts.frees;
+    counts = {};
+}
+
+template <typename T> T load_symbol(void* handle, char const* name) {
+    void* const symbol{dlsym(handle, name)};
+    if (!symbol) {
+        std::cerr << "Failed to find " << name << ": " << dlerror()
+                  << std::endl;
+        exit(1);
+    }
+    return reinterpret_cast<T>(symbol);
+}
+
+inline void load_hooks(std::string const& path) {
+    void* const handle{dlopen(path.c_str(), RTLD_NOW)};
+    if (!handle) {
+        std::cerr << "Failed to load " << path << ": " << dlerror()
+                  << std::endl;
+        exit(1);
+    }
+
+    allocator.malloc = load_symbol<void* (*)(uint32_t)>(handle, "malloc_hook");
+    allocator.free = load_symbol<void (*)(void*)>(handle, "free_hook");
+    allocator.new_object =
+        load_symbol<void* (*)(uint32_t)>(handle, "_Z8new_hookj");
+    allocator.delete_object =
+        load_symbol<void (*)(void*)>(handle, "_Z11delete_hookPv");
+    allocator.new_array =
+        load_symbol<void* (*)(uint32_t)>(handle, "_Z14array_new_hookj");
+    allocator.delete_array =
+        load_symbol<void (*)(void*)>(handle, "_Z17array_delete_hookPv");
+}
+
+/* Drains the ring like the profiler does and counts the records per kind */
+class RingConsumer {
+  public:
+    void start() {
+        // The hooks are loaded into this process, so they use our pid
+        std::string const name{"/mem_hook_" + std::to_string(getpid())};
+        int const fd{shm_open(name.c_str(), O_RDWR, 0666)};
+        if (fd == -1) {
+            perror("shm_open");
+            exit(1);
+        }
+
+        struct stat st {};
+        fstat(fd, &st);
+        size = st.st_size;
+        memory = reinterpret_cast<char*>(
+            mmap(nullptr, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0));
+        close(fd);
+        if (memory == MAP_FAILED) {
+            perror("mmap");
+            exit(1);
+        }
+        // The object may be rounded up to huge pages, the header has the ring size
+        entries = reinterpret_cast<uint32_t*>(memory)[4];
+
+        thread = std::thread{[this] { run(); }};
+    }
+
+    void stop() {
+        running = false;
+        thread.join();
+        drain();
+        overflow = header()[2];
+        munmap(memory, size);
+    }
+
+    uint64_t allocs{0};
+    uint64_t frees{0};
+    uint32_t overflow{0};
+
+  private:
+    uint32_t* header() { return reinterpret_cast<uint32_t*>(memory); }
+
+    void run() {
+        while (running.load(std::memory_order_relaxed)) {
+            drain();
+            std::this_thread::sleep_for(std::chrono::microseconds(100));
+        }
+    }
+
+    void drain() {
+        uint32_t head{__atomic_load_n(&header()[0], __ATOMIC_ACQUIRE)};
+        uint32_t const tail{__atomic_load_n(&header()[1], __ATOMIC_ACQUIRE)};
+
+        while (head != tail) {
+            uint16_t type{};
+            std::memcpy(&type,
+                        memory + HEAD_SIZE + head * TRACE_SIZE + TYPE_OFFSET,
+                        sizeof(type));
+            if (type < FIRST_FREE_TYPE) {
+                allocs++;
+            } else {
+                frees++;
+            }
+            head = (head + 1) % entries;
+        }
+
+        __atomic_store_n(&header()[0], head, __ATOMIC_RELEASE);
+    }
+
+    char* memory{nullptr};
+    size_t size{0};
+    size_t entries{0};
+    std::thread thread{};
+    std::atomic<bool> running{true};
+};
+
+/*
+ * Parse the arguments, run workload once per thread and report throughput.
+ * Returns the exit code of the target, 1 if hooked records went missing.
+ */
+inline int run(int argc, char* argv[], char const* name,
+               std::function<void(size_t, size_t, size_t)> const& workload) {
+    size_t num_threads{4};
+    size_t iterations{100000};
+    std::string hook_path{};
+
+    std::vector<std::string> positional{};
+    for (int i = 1; i < argc; i++) {
+        std::string const arg{argv[i]};
+        if (arg == "--hook" && i + 1 < argc) {
+            hook_path = argv[++i];
+        } else {
+            positional.push_back(arg);
+        }
+    }
+    if (positional.size() > 0) {
+        num_threads = std::stoul(positional[0]);
+    }
+    if (positional.size() > 1) {
+        iterations = std::stoul(positional[1]);
+    }
+
+    RingConsumer consumer{};
+    if (!hook_path.empty()) {
+        load_hooks(hook_path);
+        consumer.start();
+    } else {
+        std::cout << "Press Enter to start the test..." << std::endl;
+        std::cin.get();
+    }
+
+    auto const start{std::chrono::steady_clock::now()};
+    std::vector<std::thread> threads{};
+    for (size_t t = 0; t < num_threads; t++) {
+        threads.emplace_back(workload, t, num_threads, iterations);
+    }
+    for (std::thread& thread : threads) {
+        thread.join();
+    }
+    auto const end{std::chrono::steady_clock::now()};
+
+    double const seconds{std::chrono::duration<double>(end - start).count()};
+    uint64_t const calls{total_allocs + total_frees};
+
+    std::cout << name << ": threads=" << num_threads
+              << " allocs=" << total_allocs << " frees=" << total_frees
+              << " elapsed=" << seconds * 1000 << "ms"
+              << " throughput=" << static_cast<uint64_t>(calls / seconds)
+              << " calls/s" << std::endl;
+
+    if (hook_path.empty()) {
+        return 0;
+    }
+
+    consumer.stop();
+    bool const match{consumer.allocs == total_allocs &&
+                     consumer.frees == total_frees};
+
+    std::cout << name << ": received allocs=" << consumer.allocs
+              << " frees=" << consumer.frees
+              << " overflow=" << consumer.overflow << " "
+              << (match ? "OK" : "MISMATCH") << std::endl;
+
+    return match ? 0 : 1;
+}
+
+} // namespace stress
@@ -0,0 +1,31 @@
+#include "stress.h"
+#include <random>
+
+/* Short bursts of many allocations separated by idle periods */
+void workload(size_t id, size_t, size_t iterations) {
+    std::mt19937 gen(id);
+    std::uniform_int_distribution<uint32_t> size(8, 256);
+    std::uniform_int_distribution<size_t> burst(1, 4096);
+    std::vector<void*> live{};
+    live.reserve(4096);
+
+    size_t done{0};
+    while (done < iterations) {
+        size_t const count{std::min(burst(gen), iterations - done)};
+        for (size_t i = 0; i < count; i++) {
+            live.push_back(stress::alloc_malloc(size(gen)));
+        }
+        for (void* const ptr : live) {
+            stress::release_malloc(ptr);
+        }
+        live.clear();
+        done += count;
+
+        std::this_thread::sleep_for(std::chrono::milliseconds(1));
+    }
+    stress::publish_counts();
+}
+
+int main(int argc, char* argv[]) {
+    return stress::run(argc, argv, "bursty", workload);
+}
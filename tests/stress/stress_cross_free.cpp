@@ -0,0 +1,54 @@
+#include "stress.h"
+#include <mutex>
+#include <random>
+
+/*
+ * In each round every thread allocates a batch, then frees the batch its
+ * neighbour allocated.
+ */
+size_t const BATCH_SIZE{256};
+
+std::vector<std::vector<void*>> batches{};
+std::once_flag batches_sized{};
+std::atomic<size_t> arrived{0};
+std::atomic<size_t> generation{0};
+
+void wait_all(size_t num_threads) {
+    size_t const current{generation};
+    if (arrived.fetch_add(1) + 1 == num_threads) {
+        arrived = 0;
+        generation++;
+    } else {
+        while (generation == current) {
+        }
+    }
+}
+
+void workload(size_t id, size_t num_threads, size_t iterations) {
+    // One batch per thread, the others wait until the first sized them
+    std::call_once(batches_sized, [num_threads] {
+        batches.assign(num_threads, std::vector<void*>(BATCH_SIZE));
+    });
+
+    std::mt19937 gen(id);
+    std::uniform_int_distribution<uint32_t> size(8, 2048);
+    size_t const neighbour{(id + 1) % num_threads};
+    size_t const rounds{std::max<size_t>(1, iterations / BATCH_SIZE)};
+
+    for (size_t round = 0; round < rounds; round++) {
+        for (void*& ptr : batches[id]) {
+            ptr = stress::alloc_malloc(size(gen));
+        }
+        wait_all(num_threads);
+
+        for (void* const ptr : batches[neighbour]) {
+            stress::release_malloc(ptr);
+        }
+        wait_all(num_threads);
+    }
+    stress::publish_counts();
+}
+
+int main(int argc, char* argv[]) {
+    return stress::run(argc, argv, "cross_free", workload);
+}
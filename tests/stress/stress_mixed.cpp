@@ -0,0 +1,64 @@
+#include "stress.h"
+#include <array>
+#include <random>
+
+/* Interleaves malloc/free, new/delete and new[]/delete[] on every thread */
+enum class Kind { MALLOC, NEW, NEW_ARRAY };
+
+struct Allocation {
+    void* ptr{nullptr};
+    Kind kind{Kind::MALLOC};
+};
+
+void release(Allocation const& allocation) {
+    switch (allocation.kind) {
+    case Kind::MALLOC:
+        stress::release_malloc(allocation.ptr);
+        break;
+    case Kind::NEW:
+        stress::release_new(allocation.ptr);
+        break;
+    case Kind::NEW_ARRAY:
+        stress::release_new_array(allocation.ptr);
+        break;
+    }
+}
+
+void workload(size_t id, size_t, size_t iterations) {
+    std::mt19937 gen(id);
+    std::uniform_int_distribution<uint32_t> size(8, 512);
+    std::uniform_int_distribution<int> kind(0, 2);
+    std::uniform_int_distribution<size_t> slot(0, 127);
+    std::array<Allocation, 128> live{};
+
+    for (size_t i = 0; i < iterations; i++) {
+        Allocation& allocation{live[slot(gen)]};
+        if (allocation.ptr) {
+            release(allocation);
+        }
+
+        allocation.kind = static_cast<Kind>(kind(gen));
+        switch (allocation.kind) {
+        case Kind::MALLOC:
+            allocation.ptr = stress::alloc_malloc(size(gen));
+            break;
+        case Kind::NEW:
+            allocation.ptr = stress::alloc_new(size(gen));
+            break;
+        case Kind::NEW_ARRAY:
+            allocation.ptr = stress::alloc_new_array(size(gen));
+            break;
+        }
+    }
+
+    for (Allocation const& allocation : live) {
+        if (allocation.ptr) {
+            release(allocation);
+        }
+    }
+    stress::publish_counts();
+}
+
+int main(int argc, char* argv[]) {
+    return stress::run(argc, argv, "mixed", workload);
+}
@@ -0,0 +1,83 @@
+#include "stress.h"
+#include <condition_variable>
+#include <deque>
+#include <mutex>
+#include <random>
+
+/*
+ * The first half of the threads allocate and hand the pointers to the second
+ * half, which frees them. Every free happens on another thread than the
+ * allocation.
+ */
+std::mutex mtx{};
+std::condition_variable available{};
+std::deque<void*> queue{};
+std::atomic<size_t> active_producers{0};
+std::atomic<size_t> started{0};
+
+size_t num_producers(size_t num_threads) {
+    return std::max<size_t>(1, (num_threads + 1) / 2);
+}
+
+void produce(size_t id, size_t iterations) {
+    std::mt19937 gen(id);
+    std::uniform_int_distribution<uint32_t> size(8, 4096);
+
+    for (size_t i = 0; i < iterations; i++) {
+        void* const ptr{stress::alloc_malloc(size(gen))};
+        {
+            std::lock_guard<std::mutex> lock{mtx};
+            queue.push_back(ptr);
+        }
+        available.notify_one();
+    }
+}
+
+void consume() {
+    while (true) {
+        std::unique_lock<std::mutex> lock{mtx};
+        available.wait(lock, [] { return !queue.empty() || !active_producers; });
+        if (queue.empty()) {
+            return;
+        }
+        void* const ptr{queue.front()};
+        queue.pop_front();
+        lock.unlock();
+
+        stress::release_malloc(ptr);
+    }
+}
+
+void workload(size_t id, size_t num_threads, size_t iterations) {
+    size_t const producers{num_producers(num_threads)};
+    bool const producer{id < producers};
+
+    // Wait for every producer to register so consumers don't exit early
+    if (producer) {
+        active_producers++;
+    }
+    started++;
+    while (started < num_threads) {
+    }
+
+    if (producer) {
+        produce(id, iterations);
+        {
+            std::lock_guard<std::mutex> lock{mtx};
+            active_producers--;
+        }
+        available.notify_all();
+
+        // Without consumers the last producer frees everything itself
+        if (producers == num_threads) {
+            consume();
+        }
+    } else {
+        consume();
+    }
+    stress::publish_counts();
+}
+
+int main(int argc, char* argv[]) {
+    return stress::run(argc, argv, "producer_consumer", workload);
+}
@@ -0,0 +1,29 @@
+#include "stress.h"
+#include <array>
+#include <random>
+
+/* Every thread allocates and frees independently, only the hooks are shared */
+void workload(size_t id, size_t, size_t iterations) {
+    std::mt19937 gen(id);
+    std::uniform_int_distribution<uint32_t> size(8, 1024);
+    std::array<void*, 64> live{};
+
+    for (size_t i = 0; i < iterations; i++) {
+        void*& slot{live[i % live.size()]};
+        if (slot) {
+            stress::release_malloc(slot);
+        }
+        slot = stress::alloc_malloc(size(gen));
+    }
+
+    for (void* const ptr : live) {
+        if (ptr) {
+            stress::release_malloc(ptr);
+        }
+    }
+    stress::publish_counts();
+}
+
+int main(int argc, char* argv[]) {
+    return stress::run(argc, argv, "threads", workload);
+}
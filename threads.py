@@ -0,0 +1,182 @@
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from pointer_table import TOMBSTONE, PointerTable
+from stacks import StackTable
+
+NO_CPU: int = 0xFFFF  # Trace::NO_CPU, records without a cpu id
+
+
+@dataclass
+class ThreadSite:
+    backtraces: tuple[int, ...]
+    size: int
+    count: int
+
+
+@dataclass
+class ThreadStatistics:
+    tid: int
+    pid: int | None = None
+    live_bytes: int = 0
+    live_count: int = 0
+    alloc_bytes: int = 0
+    alloc_count: int = 0
+    free_bytes: int = 0
+    free_count: int = 0
+    remote_frees: int = 0  # Frees of allocations made by another thread
+    cpu: int = NO_CPU  # Last cpu the thread was seen on
+    sites: list[ThreadSite] = field(default_factory=list)
+
+
+@dataclass
+class ThreadReport:
+    threads: list[ThreadStatistics] = field(default_factory=list)
+    seen: int = 0  # Threads ever seen
+    retired: int = 0  # Of those, folded into the totals below
+    retired_alloc_bytes: int = 0
+    retired_alloc_count: int = 0
+
+    def merge(self, other: "ThreadReport", count: int):
+        self.threads = sorted(self.threads + other.threads, key=lambda thread: thread.live_bytes, reverse=True)[
+            :count
+        ]
+        self.seen += other.seen
+        self.retired += other.retired
+        self.retired_alloc_bytes += other.retired_alloc_bytes
+        self.retired_alloc_count += other.retired_alloc_count
+
+
+class ThreadTable:
+    """
+    Heap counters per thread id, in arrays indexed by a small thread index
+    that the pointer table stores with every live allocation. Once MAX_THREADS
+    indices are in use, threads without live allocations are retired: their
+    totals are kept in a single sum and their index is reused. Programs that
+    start thousands of short lived threads so only cost memory for the threads
+    that still own part of the heap.
+    """
+
+    INITIAL_CAPACITY: int = 64
+    MAX_THREADS: int = 4096
+    MAX_INDICES: int = 1 << 16  # The pointer table keeps thread indices as uint16
+    REPORT_THREADS: int = 5
+    REPORT_SITES: int = 3
+
+    def __init__(self):
+        self.index: dict[int, int] = {}
+        self.unused: list[int] = []
+        self.seen = 0
+        self.retired = 0
+        self.retired_alloc_bytes = 0
+        self.retired_alloc_count = 0
+        self._allocate(self.INITIAL_CAPACITY)
+        self.unused.extend(range(self.INITIAL_CAPACITY - 1, -1, -1))
+
+    def _allocate(self, capacity: int):
+        self.tids = np.zeros(capacity, dtype=np.uint32)
+        self.cpus = np.full(capacity, NO_CPU, dtype=np.uint16)
+        # live bytes, live count, alloc bytes, alloc count, free bytes, free count, remote frees
+        self.counters = np.zeros((capacity, 7), dtype=np.int64)
+
+    def _grow(self):
+        tids, cpus, counters = self.tids, self.cpus, self.counters
+        self._allocate(2 * len(tids))
+        self.tids[: len(tids)] = tids
+        self.cpus[: len(cpus)] = cpus
+        self.counters[: len(counters)] = counters
+        self.unused.extend(range(2 * len(tids) - 1, len(tids) - 1, -1))
+
+    def _retire(self, batch: set[int]):
+        """Free the indices of threads that own no live allocations, except those in the batch"""
+        idle = [tid for tid, index in self.index.items() if self.counters[index, 1] == 0 and tid not in batch]
+        for tid in idle:
+            index = self.index.pop(tid)
+            self.retired_alloc_bytes += int(self.counters[index, 2])
+            self.retired_alloc_count += int(self.counters[index, 3])
+            self.counters[index] = 0
+            self.cpus[index] = NO_CPU
+            self.unused.append(index)
+        self.retired += len(idle)
+
+    def _add(self, tid: int, batch: set[int]) -> int:
+        if not self.unused and len(self.index) >= self.MAX_THREADS:
+            self._retire(batch)
+        if not self.unused and len(self.tids) >= self.MAX_INDICES:
+            # Every index still owns live allocations, the thread owning the fewest hands its
+            # index and counters over
+            index = int(np.argmin(self.counters[:, 1]))
+            del self.index[int(self.tids[index])]
+            self.unused.append(index)
+        if not self.unused:
+            self._grow()
+        index = self.unused.pop()
+        self.index[tid] = index
+        self.tids[index] = tid
+        self.seen += 1
+        return index
+
+    def intern(self, tids: np.ndarray, cpus: np.ndarray) -> np.ndarray:
+        """Thread index of every record, a batch only holds a few distinct threads"""
+        unique, first, inverse = np.unique(tids, return_index=True, return_inverse=True)
+        batch = unique.tolist()
+        indices = np.empty(len(batch), dtype=np.int64)
+        for i, tid in enumerate(batch):
+            index = self.index.get(tid)
+            indices[i] = self._add(tid, set(batch)) if index is None else index
+        self.cpus[indices] = cpus[first]
+        return indices[inverse]
+
+    def add_allocations(self, threads: np.ndarray, sizes: np.ndarray):
+        np.add.at(self.counters[:, 0], threads, sizes)
+        np.add.at(self.counters[:, 1], threads, 1)
+        np.add.at(self.counters[:, 2], threads, sizes)
+        np.add.at(self.counters[:, 3], threads, 1)
+
+    def add_frees(self, allocating: np.ndarray, freeing: np.ndarray, sizes: np.ndarray):
+        """Live bytes go back to the allocating thread, the free is counted for the freeing one"""
+        np.add.at(self.counters[:, 0], allocating, -sizes)
+        np.add.at(self.counters[:, 1], allocating, -1)
+        np.add.at(self.counters[:, 4], freeing, sizes)
+        np.add.at(self.counters[:, 5], freeing, 1)
+        np.add.at(self.counters[:, 6], freeing, allocating != freeing)
+
+    def report(self, allocations: PointerTable, stacks: StackTable, pid: int | None = None) -> ThreadReport:
+        """The threads owning the most live bytes, with their top call stacks"""
+        report = ThreadReport(
+            seen=self.seen,
+            retired=self.retired,
+            retired_alloc_bytes=self.retired_alloc_bytes,
+            retired_alloc_count=self.retired_alloc_count,
+        )
+        if not self.index:
+            return report
+
+        indices = np.fromiter(self.index.values(), dtype=np.int64, count=len(self.index))
+        order = np.argsort(self.counters[indices, 0], kind="stable")[::-1]
+        top = indices[order[: self.REPORT_THREADS]]
+
+        # Live bytes per (thread, stack) of the top threads, from the live allocations
+        used = allocations.keys > TOMBSTONE
+        threads = allocations.threads[used]
+        chosen = np.isin(threads, top)
+        keys = (threads[chosen].astype(np.uint64) << np.uint64(32)) | allocations.stack_ids[used][chosen]
+        sites, inverse = np.unique(keys, return_inverse=True)
+        site_bytes = np.bincount(inverse, weights=allocations.sizes[used][chosen], minlength=len(sites))
+        site_counts = np.bincount(inverse, minlength=len(sites))
+        site_threads = (sites >> np.uint64(32)).astype(np.int64)
+        site_stacks = (sites & np.uint64(0xFFFFFFFF)).astype(np.int64)
+
+        for index in top.tolist():
+            counters = self.counters[index].tolist()
+            thread = ThreadStatistics(int(self.tids[index]), pid, *counters, cpu=int(self.cpus[index]))
+
+            own = np.flatnonzero(site_threads == index)
+            for site in own[np.argsort(site_bytes[own], kind="stable")[::-1][: self.REPORT_SITES]].tolist():
+                thread.sites.append(
+                    ThreadSite(stacks.stacks[site_stacks[site]], int(site_bytes[site]), int(site_counts[site]))
+                )
+            report.threads.append(thread)
+
+        return report